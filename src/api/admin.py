@@ -0,0 +1,110 @@
+"""api/admin.py
+
+VioletHawk API Admin Endpoints
+"""
+from fastapi import APIRouter, BackgroundTasks, HTTPException, status, Depends
+
+from config import settings
+from drivers.auth.utils import GetCurrentActiveUser
+from drivers.database.counters import RepairCounters
+from drivers.database.queries import QUERIES
+from models.user import User
+
+router = APIRouter()
+ROUTE = {
+    "router": router,
+    "prefix": "/admin",
+    "tags": ["Admin"]
+}
+
+
+async def GetAdminUser(user: User = Depends(GetCurrentActiveUser)):
+    """GetAdminUser - Only lets administrators through.
+    """
+    if not user.Admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+    return user
+
+# Database instrumentation
+
+
+@router.get("/database/metrics")
+async def read_database_metrics(user: User = Depends(GetAdminUser)):
+    """Returns latency histograms, row counts and consume times per
+    named query, slowest p99 first.
+    """
+    metrics = settings.DB.metrics.Snapshot()
+    metrics["Registry"] = QUERIES.Stats()
+    if settings.DB.cache is not None:
+        metrics["Cache"] = settings.DB.cache.Stats()
+    metrics["UserCache"] = settings.USER_CACHE.Stats()
+    return metrics
+
+
+@router.get("/auth/metrics")
+async def read_auth_metrics(user: User = Depends(GetAdminUser)):
+    """Returns the password hashing pool's queue depth, rejections and
+    hash/verify latencies, and how many tokens were authorized from their
+    claims.
+    """
+    return {"PasswordHasher": settings.PASSWORD_HASHER.Stats(),
+            "ClaimVersions": settings.CLAIM_VERSIONS.Stats()}
+
+
+@router.get("/database/profiles")
+async def read_database_profiles(name: str = None,
+                                 user: User = Depends(GetAdminUser)):
+    """Returns the newest PROFILE plan captured for each query.
+    """
+    profiles = settings.DB.metrics.profiles
+    if name:
+        if name not in profiles:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No plan captured for {name}."
+            )
+        return {name: profiles[name]}
+    return profiles
+
+
+@router.put("/database/profiles")
+async def update_database_profiling(sample_rate: float,
+                                    user: User = Depends(GetAdminUser)):
+    """Sets the fraction of requests run with PROFILE, 0 to stop.
+    """
+    if not 0 <= sample_rate <= 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="sample_rate must be between 0 and 1."
+        )
+    settings.DB.metrics.sample_rate = sample_rate
+    return {"SampleRate": sample_rate}
+
+
+@router.post("/database/cache/clear")
+async def clear_query_cache(user: User = Depends(GetAdminUser)):
+    if settings.DB.cache is not None:
+        settings.DB.cache.Clear()
+    return {"response": "Query cache was cleared."}
+
+
+@router.post("/database/metrics/reset")
+async def reset_database_metrics(user: User = Depends(GetAdminUser)):
+    settings.DB.metrics.Reset()
+    return {"response": "Database metrics were reset."}
+
+# Denormalized counters
+
+
+@router.post("/counters/repair")
+async def repair_counters(background: BackgroundTasks, wait: bool = False,
+                          user: User = Depends(GetAdminUser)):
+    """Recomputes CommentCount, PostCount and Subscribers in batches of
+    COUNTER_REPAIR_BATCH_SIZE. Runs after the response unless wait is set.
+    """
+    if wait:
+        return await RepairCounters(settings.DB,
+                                    settings.COUNTER_REPAIR_BATCH_SIZE)
+    background.add_task(RepairCounters, settings.DB,
+                        settings.COUNTER_REPAIR_BATCH_SIZE)
+    return {"response": "Counter repair started."}
@@ -2,21 +2,29 @@
 
 This file contains the CRUD operations for comments
 """
+import json
 import uuid
 from typing import Optional, List
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 
 # Import utils for database access & models
 from config import settings
-from drivers.auth.utils import GetCurrentActiveUser
+from drivers.auth.utils import GetCurrentActiveUser, GetCookieUserAllowGuest
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import (GetUnitOfWork, UnitOfWorkRoute,
+                                    EncodeCursor, DecodeCursor)
+from drivers.database.queries import COMMENT_TREE_MAX_DEPTH
 from models.user import User
-from models.comment import Comment
+from models.comment import Comment, CommentPage
 from models.file import File
 from api.file import create_file, delete_file
+from api.post import CastVote
 
 # Setup API Router
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 
 ROUTE = {
     "router": router,
@@ -24,37 +32,27 @@ ROUTE = {
     "tags": ["Comment"]
 }
 
+# Cursor keys of comment trees, as sorted by GetCommentReplies<Sort>
+COMMENT_SORTS = {
+    "top": lambda comment: comment.get("Votes") or 0,
+    "new": lambda comment: comment.get("CreatedDate"),
+    "old": lambda comment: comment.get("CreatedDate"),
+}
 
-def GetComment(UUID: str, GetAttached=False):
-    basic = f"""MATCH (comment:Comment) WHERE comment.UUID = "{UUID}" RETURN comment"""
 
-    if GetAttached:
-        cypher_search = """MATCH (comment:Comment {UUID: $uid})-[r:ATTACHES]->(f:File)
-        RETURN f, comment
-        """
-        files = []
-        comment = None
-        with settings.DB.session() as session:
-            res = session.run(query=cypher_search,
-                              parameters={"uid": UUID}).data()
-        if res:
-            comment = Comment(**res[0]["comment"])
-            for each in res:
-                if each["f"]:
-                    files.append(File(**each["f"]))
-        else:
-            with settings.DB.session() as session:
-                res = session.run(query=basic).data()
-                if res:
-                    comment = Comment(**res[0]["comment"])
+async def GetComment(db: UnitOfWork, UUID: str, GetAttached=False):
+    res = await db.Read("GetComment", {"uid": UUID})
+    comment = None
+    files = []
+    if res:
+        comment = Comment(**settings.VOTE_BUFFER.Apply("Comment", res[0]["comment"]))
+        for each in res:
+            if each["f"]:
+                files.append(File(**each["f"]))
 
+    if GetAttached:
         return {"Comment": comment, "Attachments": files}
-
-    else:
-        with settings.DB.session() as session:
-            res = session.run(query=basic).data()
-            if res:
-                return Comment(**res[0]["comment"])
+    return comment
 
 # Create a comment
 @router.post("/create", response_model=Comment)
@@ -67,7 +65,8 @@ async def create_comment(message: str,
                          # IDFK what that even means ¯\_(ツ)_/¯
                          linkedFiles: Optional[List[UploadFile]] = None,
                          published: Optional[bool] = True,
-                         user: User = Depends(GetCurrentActiveUser)):
+                         user: User = Depends(GetCurrentActiveUser),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
     UUID = str(uuid.uuid4())
     date = str(datetime.now(settings.TIMEZONE))
     attributes = {
@@ -80,40 +79,24 @@ async def create_comment(message: str,
         "CreatedDate": date,
         "ModifiedDate": date,
     }
-    cypher_matches = f"""MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-    MATCH (commentOn) WHERE commentOn.UUID = "{commentOn}"
-    """
-    cypher_creates = """
-    CREATE (comment:Comment $params)
-    CREATE (user)-[madeComment:OWNS]->(comment)
-    CREATE (comment)-[isOn:ON]->(commentOn)
-    """
+    files = []
     if linkedFiles:
-        files = []
         # Upload each file and attach to comment
-        i = 0
         for file in linkedFiles:
-            f = await create_file(file, user=user)
-            files.append(f.UUID)
+            f = await create_file(file, user=user, db=db)
             if f:
-                cypher_matches += f"""
-                MATCH (file{i}:File)
-                WHERE file{i}.UUID = "{f.UUID}"
-                """
-                cypher_creates += f"""
-                CREATE (comment)-[linksTofile{i}:ATTACHES]->(file{i})
-                """
-                i += 1
+                files.append(f.UUID)
         attributes["Files"] = files # So we don't HAVE to query relationships
-    cypher = cypher_matches + cypher_creates + " RETURN comment "
-    with settings.DB.session() as session:
-        res = session.run(query=cypher, parameters={
-                          "params": attributes}).data()
-        if res:
-            return Comment(**res[0]["comment"])
+    res = await db.Write("CreateComment", {"uid": user.UUID,
+                                           "commentOn": commentOn,
+                                           "files": files,
+                                           "params": attributes})
+    if res:
+        db.Invalidate(f"comments:{commentOn}", f"post:{res[0]['post']}")
+        return Comment(**res[0]["comment"])
     # Failed, delete uploads
-    for file in linkedFiles:
-        await delete_file(UUID=file.UUID, user=user)
+    for file in files:
+        await delete_file(UUID=file, user=user, db=db)
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
         detail=f"Object {commentOn} not found.",
@@ -122,27 +105,147 @@ async def create_comment(message: str,
 # List Comments
 
 
-@router.get("/list/{UUID}", response_model=List[Comment])
-async def list_comments(UUID: str):
-    """Returns all comments attached to an item
+@router.get("/list/{UUID}", response_model=CommentPage)
+async def list_comments(UUID: str, limit: int = 25,
+                        cursor: Optional[str] = None,
+                        db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Returns a page of the comments attached to an item, oldest first
     """
-    cypher = """MATCH (comment:Comment)-[r:ON]->(n {UUID: $uid})
-    RETURN comment
+    after, afterUUID = DecodeCursor(cursor)
+    # One extra row tells whether there is a next page
+    res = await db.Read("ListComments", {"uid": UUID,
+                                         "after": after,
+                                         "afterUUID": afterUUID,
+                                         "limit": limit + 1})
+    page = CommentPage()
+    for each in res[:limit]:
+        page.Comments.append(Comment(**settings.VOTE_BUFFER.Apply("Comment", each["comment"])))
+    if len(res) > limit:
+        last = res[limit - 1]["comment"]
+        page.Next = EncodeCursor(last["CreatedDate"], last["UUID"])
+    return page
+
+# Comment Trees
+
+
+async def GetCommentTree(db: UnitOfWork, UUID: str, depth: int = 5,
+                         limit: int = 25, replies: int = 5,
+                         sort: str = "top", cursor: Optional[str] = None):
+    """Returns an async generator of the NDJSON lines of the comment tree
+    under a post or comment, level by level:
+        {"Comment": {...}, "Parent": UUID, "Depth": 1}
+        {"More": {"Parent": UUID, "Depth": 2, "Count": 7, "Cursor": ...}}
+
+    Each reply level is one query, limited per parent in the database,
+    and is streamed as soon as it is read; a comment's parent is always
+    sent before it. A More line stands for Count collapsed replies of
+    Parent (unpublished ones included). Read them with the tree of
+    Parent and Cursor, or with no cursor when Cursor is None (the thread
+    continues past depth or COMMENT_TREE_MAX_COMMENTS).
+        depth: int - Reply levels returned
+        limit: int - Replies shown directly under UUID
+        replies: int - Replies shown under every deeper comment
+        sort: str - top, new or old
+        cursor: Optional[str] - Cursor of a More line of UUID
     """
-    comments = []
-    with settings.DB.session() as session:
-        res = session.run(query=cypher, parameters={"uid": UUID}).data()
-        for each in res:
-            comments.append(Comment(**each["comment"]))
+    largest = settings.COMMENT_TREE_MAX_COMMENTS
+    if (sort not in COMMENT_SORTS or not 1 <= depth <= COMMENT_TREE_MAX_DEPTH
+            or not 1 <= limit <= largest or not 1 <= replies <= largest):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot read comments by {sort} to depth {depth}."
+        )
+    after, afterUUID = DecodeCursor(cursor)
+    seen = 0
+    if cursor:
+        # The key is (sort key, replies shown on earlier pages)
+        try:
+            after, seen = after
+            seen = int(seen)
+        except (TypeError, ValueError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor."
+            ) from e
+    return _StreamCommentTree(db, sort, UUID, depth, limit, replies,
+                              after, afterUUID, seen)
+
+
+async def _StreamCommentTree(db: UnitOfWork, sort: str, UUID: str,
+                             depth: int, limit: int, replies: int,
+                             after, afterUUID: str, seen: int):
+    query = f"GetCommentReplies{sort.title()}"
+    key = COMMENT_SORTS[sort]
+    parents, sent = [UUID], 0
+    for level in range(1, depth + 2):
+        if not parents:
+            return
+        shown = limit if level == 1 else replies
+        room = 0
+        if level <= depth:
+            room = (settings.COMMENT_TREE_MAX_COMMENTS - sent) // shown
+        expanded, collapsed = parents[:room], parents[room:]
+        parents = []
+        if expanded:
+            # One extra reply per parent tells whether it has more
+            res = await db.Read(query, {"parents": expanded,
+                                        "after": after if level == 1 else None,
+                                        "afterUUID": afterUUID if level == 1 else None,
+                                        "limit": shown + 1})
+            skipped = seen if level == 1 else 0
+            for each in res:
+                comments = each["comments"][:shown]
+                more = None
+                if len(each["comments"]) > shown:
+                    last = comments[-1]
+                    more = EncodeCursor([key(last), skipped + shown],
+                                        last["UUID"])
+                for comment in comments:
+                    comment = settings.VOTE_BUFFER.Apply("Comment", comment)
+                    yield _Line({"Comment": Comment(**comment),
+                                 "Parent": each["parent"], "Depth": level})
+                    parents.append(comment["UUID"])
+                sent += len(comments)
+                if more:
+                    yield _Line({"More": {
+                        "Parent": each["parent"], "Depth": level,
+                        "Count": max(each["replies"] - skipped - shown, 1),
+                        "Cursor": more}})
+        if collapsed:
+            # Past depth or the size cap only reply counts are read
+            res = await db.Read(query, {"parents": collapsed, "after": None,
+                                        "afterUUID": None, "limit": 0})
+            for each in res:
+                if each["replies"]:
+                    yield _Line({"More": {"Parent": each["parent"],
+                                          "Depth": level,
+                                          "Count": each["replies"],
+                                          "Cursor": None}})
+
 
-    return comments
+def _Line(item: dict):
+    return json.dumps(jsonable_encoder(item)) + "\n"
+
+
+@router.get("/tree/{UUID}")
+async def read_comment_tree(UUID: str, depth: int = 5, limit: int = 25,
+                            replies: int = 5, sort: str = "top",
+                            cursor: Optional[str] = None,
+                            db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Streams the comment tree under a post or comment as newline
+    delimited JSON, see GetCommentTree.
+    """
+    lines = await GetCommentTree(db, UUID, depth=depth, limit=limit,
+                                 replies=replies, sort=sort, cursor=cursor)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
 
 # Read a comment
 
 
 @router.get("/read/{UUID}")
-async def read_comment(UUID: str, GetAttached: bool = True):
-    return GetComment(UUID=UUID, GetAttached=GetAttached)
+async def read_comment(UUID: str, GetAttached: bool = True,
+                       db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await GetComment(db, UUID=UUID, GetAttached=GetAttached)
 
 # Update Comment
 
@@ -152,7 +255,8 @@ async def update_comment(UUID: str, message: Optional[str] = None,
                          deleteFiles: Optional[List[str]] = None,
                          linkedFiles: Optional[List[UploadFile]] = None,
                          published: Optional[bool] = True,
-                         user: User = Depends(GetCurrentActiveUser)):
+                         user: User = Depends(GetCurrentActiveUser),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
     date = str(datetime.now(settings.TIMEZONE))
     attributes = {
         "Published": published,
@@ -160,7 +264,7 @@ async def update_comment(UUID: str, message: Optional[str] = None,
     }
     if message:
         attributes["Message"] = message
-    c = GetComment(UUID=UUID, GetAttached=True)
+    c = await GetComment(db, UUID=UUID, GetAttached=True)
     comment = c["Comment"]
     files = c["Attachments"]
     if not user.Admin and not comment.Creator:
@@ -172,42 +276,24 @@ async def update_comment(UUID: str, message: Optional[str] = None,
     if deleteFiles and files:
         for file in files:
             if file.UUID in deleteFiles:
-                await delete_file(UUID=file.UUID, user=user)
+                await delete_file(UUID=file.UUID, user=user, db=db)
             elif file.Filename in deleteFiles:
-                await delete_file(UUID=file.UUID, user=user)
-
-    cypher_matches = f"""MATCH (comment:Comment)
-    WHERE comment.UUID = "{UUID}"
-    """
-    cypher_creates = ""
+                await delete_file(UUID=file.UUID, user=user, db=db)
 
     # Handle file uploading
+    files = []
     if linkedFiles:
         # Upload each file and attach to comment
-        i = 0
         for file in linkedFiles:
-            f = await create_file(file, user=user)
+            f = await create_file(file, user=user, db=db)
             if f:
-                cypher_matches += f"""
-                MATCH (file{i}:File)
-                WHERE file{i}.UUID = "{f.UUID}"
-                """
-                cypher_creates += f"""
-                CREATE (comment)-[linksTofile{i}:ATTACHES]->(file{i})
-                """
-                i += 1
-    cypher = cypher_matches
-    cypher += cypher_creates
-    cypher += """ SET comment += $attributes
-    RETURN comment
-    """
-    print("CYUPHER: ", cypher)
+                files.append(f.UUID)
 
-    with settings.DB.session() as session:
-        res = session.run(query=cypher, parameters={
-                          "attributes": attributes}).data()
-        print(res)
-        return Comment(**res[0]["comment"])
+    res = await db.Write("UpdateComment", {"uid": UUID,
+                                           "files": files,
+                                           "attributes": attributes})
+    db.Invalidate(f"comment:{UUID}")
+    return Comment(**settings.VOTE_BUFFER.Apply("Comment", res[0]["comment"]))
 
 # Delete Comment
 
@@ -215,13 +301,14 @@ async def update_comment(UUID: str, message: Optional[str] = None,
 @router.post("/delete/{UUID}")
 async def delete_comment(UUID: str,
                          deleteLinked: bool = True,
-                         user: User = Depends(GetCurrentActiveUser)):
+                         user: User = Depends(GetCurrentActiveUser),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
     """delete_comment()
 
     UUID:str - Comment UUID
     deleteLinked - Whether to delete linked files
     """
-    c = GetComment(UUID=UUID, GetAttached=True)
+    c = await GetComment(db, UUID=UUID, GetAttached=True)
     comment = c["Comment"]
     files = c["Attachments"]
     if not comment:
@@ -236,15 +323,57 @@ async def delete_comment(UUID: str,
         )
     if deleteLinked and files != None:
         for file in files:
-            await delete_file(UUID=file.UUID, user=user)
-    cypher = f"""MATCH (comment:Comment)
-    WHERE comment.UUID = "{UUID}"
-    DETACH DELETE comment
-    """
-    with settings.DB.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
-    # rel should be empty, if not this _should_ return an error message
-    return rel or {
+            await delete_file(UUID=file.UUID, user=user, db=db)
+    res = await db.Write("DeleteComment", {"uid": UUID})
+    tags = [f"comment:{UUID}", f"comments:{UUID}"]
+    for each in res:
+        # The parent lists one comment less, the post counts fewer
+        if each["parent"]:
+            tags.append(f"comments:{each['parent']}")
+        if each["post"]:
+            tags.append(f"post:{each['post']}")
+    db.Invalidate(*tags)
+    return {
         "response": f"Comment was successfully deleted."
-    }
\ No newline at end of file
+    }
+
+# Vote on Comment
+
+
+async def VoteComment(db: UnitOfWork, UUID: str, user: User, vote: int,
+                      toggle: bool = True):
+    comment = await CastVote(db, "Comment", UUID, user, vote, toggle)
+    if not comment:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Comment not found."
+        )
+    return Comment(**comment)
+
+
+@router.post("/upvote/{UUID}", response_model=Comment)
+async def upvote_comment(UUID: str,
+                         user: User = Depends(GetCookieUserAllowGuest),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await VoteComment(db, UUID, user, 1)
+
+
+@router.post("/downvote/{UUID}", response_model=Comment)
+async def downvote_comment(UUID: str,
+                           user: User = Depends(GetCookieUserAllowGuest),
+                           db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await VoteComment(db, UUID, user, -1)
+
+
+@router.post("/vote/{UUID}", response_model=Comment)
+async def vote_comment(UUID: str, vote: int,
+                       user: User = Depends(GetCookieUserAllowGuest),
+                       db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Sets the user's vote to 1, -1 or 0. Repeating a vote changes nothing.
+    """
+    if vote not in (1, 0, -1):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="vote must be 1, 0 or -1."
+        )
+    return await VoteComment(db, UUID, user, vote, toggle=False)
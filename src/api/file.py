@@ -3,7 +3,6 @@
 This file handles CRUD functionality for files in the VioletHawk system
 """
 import uuid
-from tempfile import SpooledTemporaryFile
 from typing import Optional, List
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status
@@ -12,11 +11,16 @@ from fastapi import UploadFile
 
 from config import settings
 from drivers.auth.utils import GetCurrentActiveUser, GetCurrentActiveUserAllowGuest
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import (GetUnitOfWork, UnitOfWorkRoute,
+                                    EncodeCursor, DecodeCursor)
 from models.user import User
-from models.file import File as DBFile
+from models.file import File as DBFile, FilePage
+from drivers.storage.errors import FileTooLarge
+from drivers.storage.dedupe import RemoveBlob
 
 # Setup API Router
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 
 ROUTE = {
     "router": router,
@@ -25,134 +29,170 @@ ROUTE = {
 }
 
 
-def GetFileHash(file: SpooledTemporaryFile, block_size: int = 2**20):
-    hash = settings.HASH_FUNC()
-    while True:
-        data = file.read(block_size)
-        if not data:
-            break
-        hash.update(data)
-    return hash.hexdigest()
+async def GetFileFromDB(db: UnitOfWork, UUID: str):
+    res = await db.Read("GetFile", {"uid": UUID})
+    if not res:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"File: {UUID} not found.")
+    res = res[0]
+    f = DBFile(**res["file"])
+    return f
 
 
-def GetFileFromDB(UUID: str):
-    cypher = f"""MATCH (file:File)
-    WHERE file.UUID = "{UUID}" 
-    RETURN file
+def StorageName(dbFile: DBFile):
+    """StorageName - Name the file's content is stored under: its digest
+    when deduplicated, its UUID otherwise.
     """
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
-        if not res:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail=f"File: {UUID} not found.")
-        res = res[0]
-    f = DBFile(**res["file"])
-    return f
+    return dbFile.Blob or dbFile.UUID
+
 
+def DeleteFromStorage(filename: str):
+    """DeleteFromStorage - Deletes a stored file, if it is still there.
+    Run as a unit of work callback.
+    """
+    try:
+        settings.STORAGE_DRIVER.DeleteFile(filename)
+    except FileNotFoundError:
+        pass
 
-def ReadFileFromStorage(dbFile: DBFile):
+
+def ReadFileFromStorage(dbFile: DBFile,
+                        cache_control: str = settings.FILE_CACHE_CONTROL):
     if dbFile:
-        return settings.STORAGE_DRIVER.ReadFile(dbFile.UUID, dbFile.Filename)
+        try:
+            return settings.STORAGE_DRIVER.ReadFile(
+                StorageName(dbFile), dbFile.Filename, media_type=dbFile.Type,
+                etag=dbFile.Hash, cache_control=cache_control)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"File: {dbFile.UUID} content not found.")
+
 
 # Create
 
 
 @router.post("/create", response_model=DBFile)
-async def create_file(file: UploadFile, description: Optional[str] = None, user: User = Depends(GetCurrentActiveUser)):
+async def create_file(file: UploadFile, description: Optional[str] = None, user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
     date = str(datetime.now(settings.TIMEZONE))
     uid = str(uuid.uuid4())
     attributes = {
         "UUID": uid,
         "Filename": file.filename,
         "Type": file.content_type,
-        "SizeBytes": file.size,
         "Creator": user.UUID,
         "Modifier": user.UUID,
         "CreatedDate": date,
         "ModifiedDate": date,
     }
-    if settings.HASH_FILES:
-        attributes["Hash"] = await GetFileHash(file)
     if description:
         attributes["Description"] = description
 
-    # Upload file to storage
-    await settings.STORAGE_DRIVER.WriteFile(uid, file)
-
-    cypher = f"""MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-    CREATE (file:File $params)
-    CREATE (user)-[relationship:OWNS]->(file)
-    RETURN file
-    """
-    with settings.DB.session() as session:
-        res = session.run(query=cypher, parameters={"params": attributes})
-        f = res.data()[0]["file"]
+    # Upload file to storage, hashing and measuring it on the way
+    hashing = settings.HASH_FILES or settings.STORAGE_DEDUPE
+    try:
+        size, digest = await settings.STORAGE_DRIVER.WriteFile(
+            uid, file, max_bytes=settings.MAX_UPLOAD_BYTES,
+            hash_func=settings.HASH_FUNC if hashing else None)
+    except FileTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File {file.filename} is larger than {settings.MAX_UPLOAD_BYTES} bytes.")
+    attributes["SizeBytes"] = size
+    if digest:
+        attributes["Hash"] = digest
+
+    if settings.STORAGE_DEDUPE:
+        # Content stored just now is removed again unless the File is
+        # committed; RemoveBlob keeps it if other files share it
+        db.AfterRollback(lambda: RemoveBlob(settings.DB,
+                                            settings.STORAGE_DRIVER, digest))
+        # Other files may share the content, AttachBlob counts this one
+        res = await db.Write("CreateFile", {"uid": user.UUID,
+                                            "params": attributes})
+        res = await db.Write("AttachBlob", {"uid": uid, "hash": digest,
+                                            "size": size})
+        if not settings.STORAGE_DRIVER.Exists(digest):
+            # The last file sharing it was deleted since WriteFile found
+            # the content stored; holding the blob now, store it again
+            await settings.STORAGE_DRIVER.WriteFile(
+                uid, file, hash_func=settings.HASH_FUNC)
+    else:
+        # Removed again unless the File is committed
+        db.AfterRollback(lambda: DeleteFromStorage(uid))
+        res = await db.Write("CreateFile", {"uid": user.UUID,
+                                            "params": attributes})
+    f = res[0]["file"]
     return DBFile(**f)
 
 # Read
 
 
-@router.get("/read/")
+@router.api_route("/read/", methods=["GET", "HEAD"])
 async def read_file(download: bool = True,
                    UUID: Optional[str] = None,
                    filename: Optional[str] = None,
-                   user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    cypher = """MATCH (file:File)
-    """
+                   user: User = Depends(GetCurrentActiveUserAllowGuest),
+                   db: UnitOfWork = Depends(GetUnitOfWork)):
     if UUID:
-        cypher += f"""WHERE file.UUID = "{UUID}" """
+        res = await db.Read("GetFile", {"uid": UUID})
     elif filename:
-        cypher += f"""WHERE file.Filename = "{filename}" """
+        res = await db.Read("GetFileByName", {"filename": filename})
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="No UUID or filename provided.")
 
-    cypher += "RETURN file"
-
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
-        if not res:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail=f"File: {UUID} not found.")
-        res = res[0]
+    if not res:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"File: {UUID} not found.")
+    res = res[0]
     f = DBFile(**res["file"])
-    file = ReadFileFromStorage(f)
     if download:
-        return file
+        return ReadFileFromStorage(f, settings.FILE_CACHE_CONTROL if UUID
+                                   else settings.FILE_NAME_CACHE_CONTROL)
     return f
 
 # List
 
 
-@router.post("/list", response_model=List[DBFile])
+@router.post("/list", response_model=FilePage)
 async def list_file(limit: int = 25,
-                   user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    cypher = f"""MATCH (file:File) RETURN file LIMIT {limit}"""
-    files = []
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
-        for file in res:
-            files.append(DBFile(**file["file"]))
-    return files
+                   cursor: Optional[str] = None,
+                   user: User = Depends(GetCurrentActiveUserAllowGuest),
+                   db: UnitOfWork = Depends(GetUnitOfWork)):
+    after, _ = DecodeCursor(cursor)
+    # One extra row tells whether there is a next page
+    res = await db.Read("ListFiles", {"after": after, "limit": limit + 1})
+    page = FilePage()
+    for file in res[:limit]:
+        page.Files.append(DBFile(**file["file"]))
+    if len(res) > limit:
+        last = res[limit - 1]["file"]["UUID"]
+        page.Next = EncodeCursor(last, last)
+    return page
 
 
 @router.post("/delete/{UUID}")
 async def delete_file(UUID: str,
-                     user: User = Depends(GetCurrentActiveUser)):
-    cypher = f"""MATCH (file:File)
-    WHERE file.UUID = "{UUID}"
-    DETACH DELETE file
-    """
-    f = GetFileFromDB(UUID=UUID)
+                     user: User = Depends(GetCurrentActiveUser),
+                     db: UnitOfWork = Depends(GetUnitOfWork)):
+    f = await GetFileFromDB(db, UUID=UUID)
     if not f:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
     if not user.Admin and f.Creator != user.UUID:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="You are not allowed to delete this file.")
-    settings.STORAGE_DRIVER.DeleteFile(f.UUID)
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
+    blob = await db.Write("DetachBlob", {"uid": UUID})
+    if not blob:
+        # Kept until the delete has committed
+        db.AfterCommit(lambda: DeleteFromStorage(f.UUID))
+    elif blob[0]["references"] <= 0:
+        # Last reference; the content goes once the delete has committed
+        db.AfterCommit(lambda: RemoveBlob(settings.DB, settings.STORAGE_DRIVER,
+                                          blob[0]["hash"]))
+    res = await db.Write("DeleteFile", {"uid": UUID})
     return res or {
         "response": f"File {f.Filename} was successfully deleted."
     }
\ No newline at end of file
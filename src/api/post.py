@@ -9,13 +9,18 @@ from fastapi import APIRouter, Depends, HTTPException, status, UploadFile
 # Import utilities for database access & File model
 
 from config import settings
-from models.post import Post
+from models.post import Post, PostPage
 from drivers.auth.utils import GetCurrentActiveUser, GetCurrentActiveUserAllowGuest, GetCookieUserAllowGuest
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import (GetUnitOfWork, UnitOfWorkRoute,
+                                    EncodeCursor, DecodeCursor)
+from drivers.database.queries import POST_LIST_ORDERS
 from models.user import User
 from api.file import create_file
+from drivers.database.rankings import MODES, WINDOWS
 
 # Setup API Router
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 
 ROUTE = {
     "router": router,
@@ -24,65 +29,106 @@ ROUTE = {
 }
 
 
-def GetPostsOnSub(title: str, limit: int = 25, likes: bool = False, user: User = None):
-    """Returns all posts attached to a sub
+async def GetPostsOnSub(db: UnitOfWork, title: str, limit: int = 25,
+                        likes: bool = False, user: User = None,
+                        sort: str = "new", window: str = "all",
+                        cursor: Optional[str] = None):
+    """Returns a PostPage of the published posts on a sub in ranked order
+        sort: str - hot, top, new or controversial
+        window: str - hour, day, week, month, year or all (top and
+                      controversial only)
+        cursor: Optional[str] - Next of the previous page
     """
+    if sort not in MODES or window not in WINDOWS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot sort posts by {sort} over {window}."
+        )
+    score, afterUUID = DecodeCursor(cursor)
+    after = (score, afterUUID) if cursor else None
+    # One extra key tells whether there is a next page
+    keys = await settings.RANKINGS.Page(db, title, sort, after, limit + 1,
+                                        window)
+    page = PostPage()
+    if len(keys) > limit:
+        page.Next = EncodeCursor(*keys[limit - 1])
+    uuids = [uuid for _, uuid in keys[:limit]]
+    res = await db.Read("GetPostsByUUID", {"uuids": uuids})
+    for each in res:
+        page.Posts.append(Post(**settings.VOTE_BUFFER.Apply("Post", each["post"])))
     if likes and user:
-        cypher = """MATCH (post:Post)-[r:ON]->(n {Title:$title})
-        OPTIONAL  MATCH (user:User {UUID:$uid})-[l:LIKES]->(p {UUID: post.UUID})
-        OPTIONAL  MATCH (user2:User {UUID:$uid})-[d:DISLIKES]->(p2 {UUID: post.UUID})
-        RETURN post, l, d
-        ORDER BY post.ModifiedDate DESC
-        LIMIT $limit
-        """
-        print(cypher)
-        posts = []
-        with settings.DB.session() as session:
-            res = session.run(query=cypher, parameters={"title": title,
-                                                        "limit": limit,
-                                                        "uid": user.UUID}).data()
-            for each in res:
-                p = Post(**each["post"])
-                if each["l"]:
-                    p.LIKED = True
-                elif each["d"]:
-                    p.DISLIKED = True
-                posts.append(p)
-        return posts
-    else:
-        cypher = """MATCH (post:Post)-[r:ON]->(n {Title: $title})
-        RETURN post
-        ORDER BY post.ModifiedDate DESC
-        LIMIT $limit
-        """
-        posts = []
-        with settings.DB.session() as session:
-            res = session.run(query=cypher, parameters={
-                              "title": title, "limit": limit}).data()
-            for each in res:
-                posts.append(Post(**each["post"]))
-        return posts
-
-
-def GetPost(UUID: Optional[str] = None,
+        states = await GetVoteStates(db, user, uuids)
+        for post in page.Posts:
+            post.LIKED = states.get(post.UUID) == 1 or None
+            post.DISLIKED = states.get(post.UUID) == -1 or None
+    return page
+
+
+async def GetVoteStates(db: UnitOfWork, user: User, uuids: List[str]):
+    """Returns {UUID: vote} of the user's votes on posts, 1 for a like,
+    -1 for a dislike and 0 for none. Only uncached posts are looked up,
+    in one batched query.
+    """
+    states, missing = settings.VOTE_STATES.Get(user.UUID, uuids)
+    if missing:
+        res = await db.Read("GetPostVoteStates", {"uid": user.UUID,
+                                                  "uuids": missing})
+        fetched = {each["uuid"]: 1 if each["vote"] == "LIKES" else -1
+                   for each in res}
+        settings.VOTE_STATES.Put(user.UUID, missing, fetched)
+        states.update({uuid: fetched.get(uuid, 0) for uuid in missing})
+    return states
+
+
+async def GetHomeFeed(db: UnitOfWork, user: User, limit: int = 25,
+                      cursor: Optional[str] = None):
+    """Returns a PostPage of the newest posts in the subs a user
+    subscribes to
+        cursor: Optional[str] - Next of the previous page
+    """
+    time, afterUUID = DecodeCursor(cursor)
+    after = (time, afterUUID) if cursor else None
+    # One extra key tells whether there is a next page
+    keys = await settings.TIMELINES.Page(db, user.UUID, after, limit + 1)
+    page = PostPage()
+    if len(keys) > limit:
+        page.Next = EncodeCursor(*keys[limit - 1][:2])
+    subs = {uuid: sub for _, uuid, sub in keys[:limit]}
+    res = await db.Read("GetPostsByUUID", {"uuids": list(subs)})
+    for each in res:
+        post = Post(**settings.VOTE_BUFFER.Apply("Post", each["post"]))
+        # Timelines keep deleted and unpublished posts until they age out
+        if post.Published:
+            post.Sub = subs[post.UUID]
+            page.Posts.append(post)
+    states = await GetVoteStates(db, user, [post.UUID for post in page.Posts])
+    for post in page.Posts:
+        post.LIKED = states.get(post.UUID) == 1 or None
+        post.DISLIKED = states.get(post.UUID) == -1 or None
+    return page
+
+
+async def GetPost(db: UnitOfWork,
+            UUID: Optional[str] = None,
             title: Optional[str] = None,
             user: Optional[User] = None):
-    if UUID:
-        cypher_search = f"MATCH (post:Post) WHERE post.UUID = '{UUID}' "
-    elif title:
-        cypher_search = f"MATCH (post:Post) WHERE post.Title = '{title}'"
-
+    parameters = {"published": None, "owner": None}
     if not user:
-        cypher_search += "AND post.Published = True"
+        parameters["published"] = True
     elif not user.Admin:
-        cypher_search += f"AND post.Owner = '{user.UUID}'"
+        parameters["owner"] = user.UUID
 
-    cypher_search += " RETURN post"
+    if UUID:
+        parameters["uid"] = UUID
+        result = await db.Read("GetPost", parameters)
+    elif title:
+        parameters["title"] = title
+        result = await db.Read("GetPostByTitle", parameters)
+    else:
+        return None
 
-    with settings.DB.session() as session:
-        result = session.run(query=cypher_search).data()
-        if result:
-            return Post(**result[0]["post"])
+    if result:
+        return Post(**settings.VOTE_BUFFER.Apply("Post", result[0]["post"]))
 
 # Create
 
@@ -99,7 +145,8 @@ async def create_post(title: str, content: str,
                       # Removing gives the error: Did not find CR at end of boundary (59)
                       # IDFK what that even means ¯\_(ツ)_/¯
                       linkedFiles: Optional[List[UploadFile]] = None,
-                      user: User = Depends(GetCurrentActiveUser)):
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
     date = str(datetime.now(settings.TIMEZONE))
     attributes = {
         "UUID": str(uuid.uuid4()),
@@ -120,44 +167,25 @@ async def create_post(title: str, content: str,
     if keywords:
         attributes["Keywords"] = keywords
 
-    cypher_match = f"""MATCH (user:User)
-    WHERE user.UUID = "{user.UUID}"
-    """
-    cypher_create = """CREATE (post:Post $params)
-    CREATE (user)-[relationship:OWNS]->(post)
-    CREATE (user)-[relationship2:AUTHOR]->(post)
-    """
+    files = []
     if linkedFiles:
-        files = []
         # Upload each file and attach to post
-        i = 0
         for file in linkedFiles:
-            f = await create_file(file, user=user)
-            files.append(f.UUID)
+            f = await create_file(file, user=user, db=db)
             if f:
-                cypher_match += f"""
-                MATCH (file{i}:File)
-                WHERE file{i}.UUID = "{f.UUID}"
-                """
-                cypher_create += f"""
-                CREATE (post)-[linksTofile{i}:ATTACHES]->(file{i})
-                """
-                i += 1
+                files.append(f.UUID)
         attributes["Files"] = files # So we don't HAVE to query relationships
-    
-    if subTitle:
-        cypher_match += f"""MATCH (v:Sub)
-        WHERE v.Title = "{subTitle}"
-        """
-        cypher_create += """CREATE (post)-[relationship3:ON]->(v)
-        """
-
-    cypher = cypher_match + cypher_create + " RETURN post "
-    print(cypher)
-    with settings.DB.session() as session:
-        res = session.run(query=cypher, parameters={"params": attributes})
-        post = Post(**res.data()[0]["post"])
-    return post
+
+    res = await db.Write("CreatePost", {"uid": user.UUID,
+                                        "files": files,
+                                        "subTitle": subTitle,
+                                        "params": attributes})
+    post = res[0]["post"]
+    db.Invalidate("posts", f"sub:{subTitle}", "subs")
+    db.AfterCommit(lambda: settings.RANKINGS.Update(subTitle, post))
+    db.AfterCommit(lambda: settings.TIMELINES.Deliver(settings.DB, subTitle,
+                                                      post))
+    return Post(**post)
 
 # Read
 
@@ -165,37 +193,73 @@ async def create_post(title: str, content: str,
 @router.get("/read", response_model=Optional[Post])
 async def read_post(UUID: Optional[str] = None,
                     title: Optional[str] = None,
-                    user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    return GetPost(UUID=UUID, title=title, user=user)
+                    user: User = Depends(GetCurrentActiveUserAllowGuest),
+                    db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await GetPost(db, UUID=UUID, title=title, user=user)
+
+# List Posts on a Sub
+
+
+@router.get("/sub/{title}", response_model=PostPage)
+async def list_sub_posts(title: str,
+                         sort: str = "hot",
+                         window: str = "all",
+                         limit: int = 25,
+                         cursor: Optional[str] = None,
+                         user: User = Depends(GetCurrentActiveUserAllowGuest),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await GetPostsOnSub(db, title, limit=limit, likes=True,
+                               user=user, sort=sort, window=window,
+                               cursor=cursor)
+
+# Home Feed
+
+
+@router.get("/home", response_model=PostPage)
+async def list_home_posts(limit: int = 25,
+                          cursor: Optional[str] = None,
+                          user: User = Depends(GetCurrentActiveUser),
+                          db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await GetHomeFeed(db, user, limit=limit, cursor=cursor)
 
 # List
 
 
-@router.get("/list", response_model=List[Post])
+@router.get("/list", response_model=PostPage)
 async def list_posts(limit: int = 25,
                      order_by: Optional[str] = None,
-                     user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    if not user:
-        cypher = f"MATCH (post:Post) WHERE post.Published = True RETURN post LIMIT {limit}"
-    elif not user.Admin:
-        cypher = f"""MATCH (post:Post) WHERE post.Published = True
-        OR post.Owner = "{user.UUID}"
-        OR post.Creator = "{user.UUID}"
-        RETURN post
-        LIMIT {limit}
-        """
-    elif user.Admin == True:
-        cypher = "MATCH (post:Post) RETURN post LIMIT {limit}"
-
-    if order_by:
-        cypher += f" ORDER BY post.{order_by}"
-    posts = []
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
-        for each in res:
-            post = Post(**each["post"])
-            posts.append(post)
-    return posts
+                     cursor: Optional[str] = None,
+                     user: User = Depends(GetCurrentActiveUserAllowGuest),
+                     db: UnitOfWork = Depends(GetUnitOfWork)):
+    orderBy = order_by or "CreatedDate"
+    if orderBy not in POST_LIST_ORDERS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot order posts by {order_by}."
+        )
+    # Posts without the order_by property are left out
+    after, afterUUID = DecodeCursor(cursor)
+    if not cursor:
+        after, afterUUID = POST_LIST_ORDERS[orderBy], ""
+    parameters = {
+        "uid": user.UUID if user else None,
+        "after": after,
+        "afterUUID": afterUUID,
+        # One extra row tells whether there is a next page
+        "limit": limit + 1,
+    }
+    query = f"ListPostsBy{orderBy}"
+    if user and user.Admin:
+        query = f"ListAllPostsBy{orderBy}"
+    page = PostPage()
+    res = await db.Read(query, parameters)
+    if len(res) > limit:
+        last = res[limit - 1]["post"]
+        page.Next = EncodeCursor(last[orderBy], last["UUID"])
+    for each in res[:limit]:
+        post = Post(**settings.VOTE_BUFFER.Apply("Post", each["post"]))
+        page.Posts.append(post)
+    return page
 
 # Update
 
@@ -203,154 +267,137 @@ async def list_posts(limit: int = 25,
 @router.post("/update/{UUID}", response_model=Post)
 async def update_post(UUID: str,
                       attributes: dict,
-                      user: User = Depends(GetCurrentActiveUser)):
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
     date = str(datetime.now(settings.TIMEZONE))
-    post = GetPost(UUID=UUID, user=user)
+    post = await GetPost(db, UUID=UUID, user=user)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You do not have write read/write access to the post or it does not exist."
         )
-    cypher = f"""MATCH (post:Post)
-    WHERE post.UUID = "{UUID}"
-    SET post += $attributes
-    SET post.Modifier = "{user.UUID}"
-    SET post.ModifiedDate = "{date}"
-    """
-    if "Published" in attributes.keys():
-        if attributes["Published"]:
-            cypher += """SET post.Published = True
-            SET post.PublishedDate = "{date}"
-            """
-        else:
-            cypher += "SET post.Published = False"
-        del attributes["Published"]
-    cypher += "RETURN post"
-    for key in attributes.keys():
-        if key in settings.BASE_PROPERTIES:
-            del attributes[key]
-    with settings.DB.session() as session:
-        res = session.run(query=cypher, parameters={"attributes": attributes})
-        updated = Post(**res.data()[0]["post"])
-    return updated
+    published = attributes.pop("Published", None)
+    attributes = {key: value for key, value in attributes.items()
+                  if key not in settings.BASE_PROPERTIES}
+    res = await db.Write("UpdatePost", {"uid": UUID,
+                                        "attributes": attributes,
+                                        "modifier": user.UUID,
+                                        "date": date,
+                                        "published": published})
+    updated = settings.VOTE_BUFFER.Apply("Post", res[0]["post"])
+    sub = res[0]["sub"]
+    db.Invalidate("posts", f"post:{UUID}")
+    db.AfterCommit(lambda: settings.RANKINGS.Update(sub, updated))
+    if published and not post.Published:
+        db.AfterCommit(lambda: settings.TIMELINES.Deliver(settings.DB, sub,
+                                                          updated))
+    return Post(**updated)
 
 # Delete
 
 
 @router.post("/delete/{UUID}")
 async def delete_post(UUID: str,
-                      user: User = Depends(GetCurrentActiveUser)):
-    post = GetPost(UUID=UUID, user=user)
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
+    post = await GetPost(db, UUID=UUID, user=user)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You do not have write read/write access to the post, or it does not exist."
         )
-    cypher = f"""MATCH (post:Post)
-    WHERE post.UUID = "{UUID}"
-    DETACH DELETE post
-    """
-
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
-    return res or {
+    res = await db.Write("DeletePost", {"uid": UUID})
+    tags = ["posts", f"post:{UUID}"]
+    for each in res:
+        # The sub counts one post less
+        if each["sub"]:
+            tags += [f"sub:{each['sub']}", "subs"]
+    db.Invalidate(*tags)
+    db.AfterCommit(lambda: settings.RANKINGS.Remove(UUID))
+    return {
         "response": f"Post {UUID} was successfully deleted."
     }
 
 
-@router.post("/upvote/{UUID}", response_model=Post)
-async def upvote_post(UUID: str,
-                      user: User = Depends(GetCookieUserAllowGuest)):
-    post = GetPost(UUID=UUID)
+async def CastVote(db: UnitOfWork, label: str, UUID: str, user: User,
+                   vote: int, toggle: bool = True):
+    """CastVote - Applies a vote in a single write and returns the target's
+    properties with its new score, or None if the target does not exist.
+        label: str - Post or Comment
+        vote: int - 1 (like), -1 (dislike) or 0 (none)
+        toggle: bool - Repeating the current vote clears it
+
+    With VOTE_WRITE_BEHIND the write only records the vote relationship
+    and the counter delta is buffered once the request commits.
+    """
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You must be logged in to vote."
+        )
+    buffer = settings.VOTE_BUFFER
+    query = f"Record{label}Vote" if buffer.enabled else f"Vote{label}"
+    res = await db.Write(query, {"uid": user.UUID,
+                                 "target": UUID,
+                                 "vote": vote,
+                                 "toggle": toggle})
+    if not res:
+        return None
+    target = res[0]["target"]
+    previous, vote = res[0]["previous"], res[0]["vote"]
+    if buffer.enabled:
+        buffer.Apply(label, target)
+        delta = (vote - previous,
+                 (vote == 1) - (previous == 1),
+                 (vote == -1) - (previous == -1))
+        # Show this vote now, count it once it is committed
+        target["Votes"] = (target.get("Votes") or 0) + delta[0]
+        target["Likes"] = (target.get("Likes") or 0) + delta[1]
+        target["Dislikes"] = (target.get("Dislikes") or 0) + delta[2]
+        db.AfterCommit(lambda: buffer.Add(label, UUID, *delta))
+    db.Invalidate(f"{label.lower()}:{UUID}")
+    if label == "Post":
+        db.AfterCommit(lambda: settings.RANKINGS.Update(None, dict(target)))
+    db.AfterCommit(lambda: settings.VOTE_STATES.Set(user.UUID, UUID, vote))
+    target["LIKED"] = vote == 1
+    target["DISLIKED"] = vote == -1
+    return target
+
+
+async def VotePost(db: UnitOfWork, UUID: str, user: User, vote: int,
+                   toggle: bool = True):
+    post = await CastVote(db, "Post", UUID, user, vote, toggle)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Post not found."
         )
-    liked = False
-    disliked = False
-    with settings.DB.session() as session:
-        l = session.run(query=f"""MATCH (u:User)-[rel]->(p:Post) WHERE
-        u.UUID = "{user.UUID}" AND p.UUID = "{UUID}"
-        RETURN rel""").data()
-        print(l)
-        for each in l:
-            if "DISLIKES" in str(each):
-                disliked = True
-            if "LIKES" in str(each):
-                liked = True
-    if liked:
-        cypher = f"""
-        MATCH (user:User)-[likes:LIKES]->(post:Post) WHERE
-        user.UUID = "{user.UUID}" AND post.UUID = "{UUID}"
-        SET post.Votes = post.Votes - 1
-        DETACH DELETE likes
-        """
-    if disliked:
-        cypher = f"""MATCH (user:User)-[dislikes:DISLIKES]->(post:Post) WHERE
-        user.UUID = "{user.UUID}" AND post.UUID = "{UUID}"
-        CREATE (user)-[relationship:LIKES]->(post)
-        SET post.Votes = post.Votes + 2
-        DETACH DELETE dislikes
-        """
-    if not liked and not disliked:
-        cypher = f"""
-        MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-        MATCH (post:Post) WHERE post.UUID = "{UUID}"
-        CREATE (user)-[relationship:LIKES]->(post)
-        SET post.Votes = post.Votes + 1
-        """
-    cypher += " RETURN post"
-    print(cypher)
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
-        return Post(**res[0]["post"])
+    return Post(**post)
+
+
+@router.post("/upvote/{UUID}", response_model=Post)
+async def upvote_post(UUID: str,
+                      user: User = Depends(GetCookieUserAllowGuest),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await VotePost(db, UUID, user, 1)
 
 
 @router.post("/downvote/{UUID}", response_model=Post)
 async def downvote_post(UUID: str,
-                        user: User = Depends(GetCookieUserAllowGuest)):
-    post = GetPost(UUID=UUID)
-    if not post:
+                        user: User = Depends(GetCookieUserAllowGuest),
+                        db: UnitOfWork = Depends(GetUnitOfWork)):
+    return await VotePost(db, UUID, user, -1)
+
+
+@router.post("/vote/{UUID}", response_model=Post)
+async def vote_post(UUID: str, vote: int,
+                    user: User = Depends(GetCookieUserAllowGuest),
+                    db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Sets the user's vote to 1, -1 or 0. Repeating a vote changes nothing.
+    """
+    if vote not in (1, 0, -1):
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Post not found."
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="vote must be 1, 0 or -1."
         )
-    liked = False
-    disliked = False
-    with settings.DB.session() as session:
-        l = session.run(query=f"""MATCH (u:User)-[rel]->(p:Post) WHERE
-        u.UUID = "{user.UUID}" AND p.UUID = "{UUID}"
-        RETURN rel""").data()
-        print(l)
-        for each in l:
-            if "DISLIKES" in str(each):
-                disliked = True
-            if "LIKES" in str(each):
-                liked = True
-    if liked:
-        cypher = f"""
-        MATCH (user:User)-[likes:LIKES]->(post:Post) WHERE
-        user.UUID = "{user.UUID}" AND post.UUID = "{UUID}"
-        CREATE (user)-[relationship:DISLIKES]->(post)
-        SET post.Votes = post.Votes - 2
-        DETACH DELETE likes
-        """
-    if disliked:
-        cypher = f"""MATCH (user:User)-[dislikes:DISLIKES]->(post:Post) WHERE
-        user.UUID = "{user.UUID}" AND post.UUID = "{UUID}"
-        SET post.Votes = post.Votes + 1
-        DETACH DELETE dislikes
-        """
-    if not liked and not disliked:
-        cypher = f"""
-        MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-        MATCH (post:Post) WHERE post.UUID = "{UUID}"
-        CREATE (user)-[relationship:DISLIKES]->(post)
-        SET post.Votes = post.Votes - 1
-        """
-    cypher += " RETURN post"
-    print(cypher)
-    with settings.DB.session() as session:
-        res = session.run(query=cypher).data()
-        return Post(**res[0]["post"])
+    return await VotePost(db, UUID, user, vote, toggle=False)
@@ -1,10 +1,11 @@
-from api import file, sub, comment, post
+from api import file, sub, comment, post, admin
 
 routes = [
     file.ROUTE,
     sub.ROUTE,
     comment.ROUTE,
-    post.ROUTE
+    post.ROUTE,
+    admin.ROUTE
 ]
 
 
@@ -10,12 +10,15 @@ from fastapi import APIRouter, Depends, HTTPException, status, UploadFile
 # Import utilities for database access & Sub model
 from config import settings
 from drivers.auth.utils import GetCurrentActiveUser
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import (GetUnitOfWork, UnitOfWorkRoute,
+                                    EncodeCursor, DecodeCursor)
 from models.user import User
-from models.sub import Sub
+from models.sub import Sub, SubPage
 from api.file import create_file
 
 # Setup API Router
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 ROUTE = {
     "router": router,
     "prefix": "/v",
@@ -23,13 +26,10 @@ ROUTE = {
 }
 
 
-def GetSub(title):
-    cypher_search = f"MATCH (v:Sub) WHERE v.Title = '{title}' RETURN v"
-
-    with settings.DB.session() as session:
-        result = session.run(query=cypher_search).data()
-        if result:
-            return Sub(**result[0]["v"])
+async def GetSub(db: UnitOfWork, title):
+    result = await db.Read("GetSub", {"title": title})
+    if result:
+        return Sub(**result[0]["v"])
 
 
 @router.post("/create", response_model=Sub)
@@ -38,11 +38,12 @@ async def create_sub(title: str, headline: str,
                       keywords: Optional[List[str]] = None,
                       private: Optional[bool] = False,
                       banner: Optional[UploadFile] = None,
-                      user: User = Depends(GetCurrentActiveUser)
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)
                       ):
     """create_sub - Creates a new sub"""
     # Check that Sub does not exist
-    if GetSub(title=title):
+    if await GetSub(db, title=title):
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Operation not permitted. Sub with title '{title}' already exists.",
@@ -57,36 +58,29 @@ async def create_sub(title: str, headline: str,
         "Owner": user.UUID,
         "Private": private,
         "CreatedDate": date,
-        "Subscribers":1,
     }
     if description:
         attributes["Description"] = description
     if banner:
         # Upload file
         bannerImage = await create_file(file=banner,description="Banner Image",
-                    user=user)
+                    user=user, db=db)
         attributes["BannerImage"] = bannerImage.UUID
     if keywords:
         attributes["Keywords"] = keywords
 
-    cypher = f"""MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-    CREATE (v:Sub $params)
-    CREATE (user)-[relationship:OWNS]->(v)
-    RETURN v"""
-
-    with settings.DB.session() as session:
-        res = session.run(query=cypher, parameters={"params": attributes})
-        print(res)
-        sub = res.data()[0]
-        sub = sub["v"]
-    print(sub)
+    res = await db.Write("CreateSub", {"uid": user.UUID,
+                                       "params": attributes})
+    db.Invalidate(f"sub:{title}", "subs")
+    sub = res[0]
+    sub = sub["v"]
     return Sub(**sub)
 
 # Read Subs
 
 @router.post("/read/", response_model=Sub)
-async def read_sub(title):
-    p = GetSub(title=title)
+async def read_sub(title, db: UnitOfWork = Depends(GetUnitOfWork)):
+    p = await GetSub(db, title=title)
     if not p:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -96,17 +90,57 @@ async def read_sub(title):
 
 # List Subs
 
-@router.get("/list/subs", response_model=List[Sub])
-async def list_subs(limit: int = 25):
-    cypher = f"MATCH (v:Sub) return v LIMIT {limit}"
-    out = []
-    with settings.DB.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
-        print(rel[0]["v"])
-        for sub in rel:
-            out.append(Sub(**sub["v"]))
-    return out
+@router.get("/list/subs", response_model=SubPage)
+async def list_subs(limit: int = 25, cursor: Optional[str] = None,
+                    db: UnitOfWork = Depends(GetUnitOfWork)):
+    after, _ = DecodeCursor(cursor)
+    # One extra row tells whether there is a next page
+    rel = await db.Read("ListSubs", {"after": after, "limit": limit + 1})
+    page = SubPage()
+    for sub in rel[:limit]:
+        page.Subs.append(Sub(**sub["v"]))
+    if len(rel) > limit:
+        last = rel[limit - 1]["v"]["Title"]
+        page.Next = EncodeCursor(last, last)
+    return page
+
+# Subscriptions
+
+
+@router.post("/subscribe/{title}", response_model=Sub)
+async def subscribe_sub(title: str,
+                        user: User = Depends(GetCurrentActiveUser),
+                        db: UnitOfWork = Depends(GetUnitOfWork)):
+    date = str(datetime.now(settings.TIMEZONE))
+    res = await db.Write("SubscribeSub", {"uid": user.UUID,
+                                          "title": title,
+                                          "date": date})
+    if not res:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Nothing found for v/{title}"
+        )
+    db.Invalidate(f"sub:{title}", "subs")
+    sub = Sub(**res[0]["v"])
+    # Large subs are merged into the home feed when it is read
+    if res[0]["subscribed"] and sub.Subscribers <= settings.TIMELINES.fanout_limit:
+        await settings.TIMELINES.Backfill(db, user.UUID, title)
+    return sub
+
+
+@router.post("/unsubscribe/{title}", response_model=Sub)
+async def unsubscribe_sub(title: str,
+                          user: User = Depends(GetCurrentActiveUser),
+                          db: UnitOfWork = Depends(GetUnitOfWork)):
+    res = await db.Write("UnsubscribeSub", {"uid": user.UUID,
+                                            "title": title})
+    db.Invalidate(f"sub:{title}", "subs")
+    if not res:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Nothing found for v/{title}"
+        )
+    return Sub(**res[0]["v"])
 
 # Update Subs
 
@@ -114,45 +148,39 @@ async def list_subs(limit: int = 25):
 @router.put("/update/{title}", response_model=Sub)
 async def update_sub(title: str,
                       attributes: dict,
-                      user: User = Depends(GetCurrentActiveUser)):
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
     time = str(datetime.now(settings.TIMEZONE))
-    sub = GetSub(title)
+    sub = await GetSub(db, title)
     if sub and not sub.Owner == user.UUID:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"You do not have write access to v/{title}.",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    cypher = f"""MATCH (v:Sub) WHERE v.TITLE = "{title}"
-    SET v += $attributes
-    SET v.Modifier = "{user.UUID}"
-    SET v.ModifiedDate = "{time}"
-    RETURN v
-    """
-    for key in attributes.keys():
-        if key in settings.BASE_PROPERTIES:
-            del attributes[key]
-    with settings.DB.session() as session:
-        if not user.Admin:
-            relate = session.run(query=f"""MATCH (user:User)-[relationship]->(v:Sub)
-            WHERE user.UUID = "{user.UUID}" AND sub.Title = "{title}"
-            RETURN relationship
-            """).data()[0]
-            if relate:
-                if "OWNS" not in str(relate) and "CanModify" not in str(relate):
-                    raise HTTPException(
-                        status_code=status.HTTP_401_UNAUTHORIZED,
-                        detail=f"You do not have write access to v/{title}.",
-                        headers={"WWW-Authenticate": "Bearer"}
-                    )
-            else:
+    attributes = {key: value for key, value in attributes.items()
+                  if key not in settings.BASE_PROPERTIES}
+    if not user.Admin:
+        relate = await db.Read("GetSubRelationship",
+                               {"uid": user.UUID, "title": title})
+        if relate:
+            if "OWNS" not in str(relate) and "CanModify" not in str(relate):
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail=f"You do not have write access to v/{title}.",
                     headers={"WWW-Authenticate": "Bearer"}
                 )
-        update = session.run(query=cypher, parameters={
-                             "attributes": attributes}).data()[0]
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail=f"You do not have write access to v/{title}.",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+    update = (await db.Write("UpdateSub", {"title": title,
+                                           "attributes": attributes,
+                                           "modifier": user.UUID,
+                                           "date": time}))[0]
+    db.Invalidate(f"sub:{title}", "subs")
     return Sub(**update["v"])
 
 # Delete Sub
@@ -160,20 +188,17 @@ async def update_sub(title: str,
 
 @router.post("/delete/{title}")
 async def delete_sub(title: str,
-                      user: User = Depends(GetCurrentActiveUser)):
-    sub = GetSub(title)
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
+    sub = await GetSub(db, title)
     if sub and not sub.Owner == user.UUID:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"You do not have write access to v/{title}.",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    cypher = f"""MATCH (v:Sub) WHERE v.Title = "{title}"
-    DETACH DELETE sub
-    """
-    with settings.DB.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
+    rel = await db.Write("DeleteSub", {"title": title})
+    db.Invalidate(f"sub:{title}", "subs")
     # rel should be empty, if not this _should_ return an error message
     return rel or {
         "response": f"Sub {title} was successfully deleted."
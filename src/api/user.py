@@ -5,12 +5,15 @@ VioletHawk API User Endpoints
 from fastapi import APIRouter, HTTPException, status, Request, Depends
 
 from config import settings
-from drivers.auth.utils import GetCurrentActiveUser, GetUser
+from drivers.auth.utils import GetCurrentActiveUser, GetUser, InvalidateUser
+from drivers.auth.utils import RevokeUserRefreshTokens, InvalidateClaims
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import GetUnitOfWork, UnitOfWorkRoute
 from models.user import User
 from api.file import create_file, delete_file
 from datetime import datetime
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 ROUTE = {
     "router":router,
     "prefix":"/user",
@@ -21,43 +24,39 @@ ROUTE = {
 @router.put("/update/{UUID}", response_model=User)
 async def update_user(attributes: dict,
                       UUID:str=None,
-                      user: User = Depends(GetCurrentActiveUser)):
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
     uId = user.UUID
     if UUID:
         if not user.Admin:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
         uId = UUID
-    cypher = f"""MATCH (user:User) WHERE user.UUID = "{uId}"
-    SET user += $attributes
-    RETURN user
-    """
-    with settings.DB.session() as session:
-        res= session.run(query=cypher, parameters={"attributes":attributes})
-        return User(**res[0]["user"])
+    res = await db.Write("UpdateUser", {"uid":uId,
+                                        "attributes":attributes})
+    InvalidateUser(db, uId)
+    InvalidateClaims(db, uId, res[0]["user"]["SecurityVersion"])
+    if {"HashedPassword", "Disabled", "Banned"} & set(attributes):
+        await RevokeUserRefreshTokens(db, uId)
+    return User(**res[0]["user"])
     
 @router.get("/delete")
 @router.get("/delete/{UUID}")
 async def delete_user(attributes: dict,
                       UUID:str=None,
-                      user: User = Depends(GetCurrentActiveUser)):
+                      user: User = Depends(GetCurrentActiveUser),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
     uId = user.UUID
     if UUID:
         if not user.Admin and not user.UUID == UUID:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
         uId = UUID
-    cypher = f"""MATCH (user:User) WHERE user.UUID = "{uId}"
-    MATCH (comment:Comment) WHERE comment.Creator = "{uId}"
-    MATCH (post:Post) WHERE post.Owner = "{uId}"
-    MATCH (sub:Sub) WHERE sub.Owner = "{uId}"
-    MATCH (file:File) WHERE file.Creator = "{uId}"
-    DETACH DELETE user, comment, post
-    RETURN file
-    """
-    with settings.DB.session() as session:
-        res= session.run(query=cypher).data()
-        for each in res:
-            # Delete files
-            delete_file(each["file"])
+    res = await db.Write("DeleteUser", {"uid":uId})
+    InvalidateUser(db, uId)
+    InvalidateClaims(db, uId)
+    await RevokeUserRefreshTokens(db, uId)
+    for each in res:
+        # Delete files
+        await delete_file(UUID=each["file"]["UUID"], user=user, db=db)
 
     return res or {
         "response": f"User was successfully deleted."
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+"""check_offload.py
+
+Handy script for checking the download offload headers (see
+STORAGE_OFFLOAD) without a proxy in front: stores a file in a temporary
+upload directory and prints the response headers a download of it gets.
+
+usage:
+    ./check_offload.py                               # Settings' mode
+    ./check_offload.py --mode x-accel-redirect --path /_uploads
+    ./check_offload.py --mode x-sendfile --path /srv/violethawk/uploads
+
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import sys
+import tempfile
+from config import settings
+from drivers.storage.storage import StorageDriver, OFFLOAD_HEADERS
+
+
+async def Download(response, headers: dict = None, method: str = "GET"):
+    """Download - Runs a response as an ASGI app, returning the status,
+    headers and body it sends.
+    """
+    sent = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": "/api/file/read/",
+             "headers": [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                         for k, v in (headers or {}).items()]}
+    await response(scope, receive, send)
+    sent_headers = {k.decode("latin-1"): v.decode("latin-1")
+                    for k, v in sent[0]["headers"]}
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return sent[0]["status"], sent_headers, body
+
+
+async def Check(mode: str, path: str):
+    data = b"VioletHawk offload check\n" * 64
+    with tempfile.TemporaryDirectory() as upload_dir:
+        storage = StorageDriver(upload_dir, offload=mode, offload_path=path,
+                                shard_depth=settings.STORAGE_SHARD_DEPTH)
+        _, digest = await storage.WriteFile("check-offload", io.BytesIO(data),
+                                            hash_func=hashlib.sha256)
+        response = storage.ReadFile("check-offload", db_name="check.txt",
+                                    media_type="text/plain", etag=digest,
+                                    cache_control=settings.FILE_CACHE_CONTROL)
+        code, headers, body = await Download(response)
+        for name, value in headers.items():
+            print(f"{name}: {value}")
+
+        failures = []
+        header = OFFLOAD_HEADERS[mode].lower()
+        expected = storage.Offload(storage.Locate("check-offload"))
+        if code != 200:
+            failures.append(f"status {code}, expected 200")
+        if headers.get(header) != expected:
+            failures.append(f"{header} is {headers.get(header)!r}, "
+                            f"expected {expected!r}")
+        if body:
+            failures.append(f"sent a {len(body)} byte body")
+        for name in ("content-type", "content-disposition", "etag",
+                     "cache-control"):
+            if name not in headers:
+                failures.append(f"no {name} header")
+        # Revalidations are answered here, without sending the proxy
+        code, headers, _ = await Download(
+            response, {"If-None-Match": headers.get("etag", "")})
+        if code != 304 or header in headers:
+            failures.append(f"revalidation got {code}, expected 304")
+        return failures
+
+
+if __name__ in '__main__':
+    parser = argparse.ArgumentParser(description="VioletHawk download offload check")
+    parser.add_argument("--mode", choices=sorted(OFFLOAD_HEADERS),
+                        default=settings.STORAGE_OFFLOAD or "x-accel-redirect",
+                        help="Offload mode to check")
+    parser.add_argument("--path", default=settings.STORAGE_OFFLOAD_PATH,
+                        help="Internal location or proxy-side upload path")
+    args = parser.parse_args()
+    failures = asyncio.run(Check(args.mode, args.path))
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"{args.mode} headers OK.")
@@ -6,14 +6,21 @@ import os
 import hashlib
 from datetime import timezone
 from drivers.storage.storage import StorageDriver
+from drivers.storage.responses import DownloadGZipMiddleware
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
-from neo4j import GraphDatabase
+from drivers.database.database import Database
+from drivers.database.cache import QueryCache
+from drivers.auth.cache import UserCache, ClaimVersions
+from drivers.auth.hashing import PasswordHasher
+from drivers.database.memory import MemoryDatabase
+from drivers.database.votes import VoteBuffer, VoteStateCache
+from drivers.database.rankings import Rankings
+from drivers.database.timelines import Timelines
 
 # Main Application Settings
 APP_NAME = "VioletHawk"
@@ -58,6 +65,14 @@ PWD_CONTEXT = CryptContext(schemes=PASSWORD_SCHEMES,
 # Password complexity
 # Must have:
 #   8 chars, 1 Uppercase, 1 Lowercase, 1 Number, 1 Special Char
+# bcrypt runs on a dedicated pool so it never blocks the event loop
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 4))
+# Logins allowed to wait for a hashing worker before answering 503
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get("PASSWORD_HASH_QUEUE_LIMIT", 64))
+PASSWORD_HASH_RETRY_AFTER_SECONDS = int(
+    os.environ.get("PASSWORD_HASH_RETRY_AFTER_SECONDS", 1))
+# Hash in worker processes instead of threads
+PASSWORD_HASH_PROCESSES = os.environ.get("PASSWORD_HASH_PROCESSES", "false").lower() == "true"
 PASSWORD_COMPLEXITY_PATTERN = "^(?=.*?[A-Z])(?=.*?[a-z])(?=.*?[0-9])(?=.*?[#?!@$%^&*-]).{8,}$"
 # RFC 5322 Regex Email Pattern
 EMAIL_VALIDATE_PATTERN = "(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|\"(?:[\\x01-\\x08\\x0b\\x0c\\x0e-\\x1f\\x21\\x23-\\x5b\\x5d-\\x7f]|\\\\[\\x01-\\x09\\x0b\\x0c\\x0e-\\x7f])*\")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\\[(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?|[a-z0-9-]*[a-z0-9]:(?:[\\x01-\\x08\\x0b\\x0c\\x0e-\\x1f\\x21-\\x5a\\x53-\\x7f]|\\\\[\\x01-\\x09\\x0b\\x0c\\x0e-\\x7f])+)\\])"
@@ -69,13 +84,101 @@ JWT_ALGORITHM = "HS256"
 TOKEN_LIFETIME_MINUTES = 15
 ENABLE_ACCOUNT_CREATION = True
 ENABLE_BEARER_AUTH = True
+# Authorize requests from the claims in access tokens instead of looking
+# the user up. Changes made through another worker reach this one when
+# the token is renewed, within TOKEN_LIFETIME_MINUTES
+TOKEN_CLAIMS_ENABLED = os.environ.get("TOKEN_CLAIMS_ENABLED", "true").lower() == "true"
+# Recently changed users whose older tokens are looked up
+CLAIM_VERSIONS_SIZE = int(os.environ.get("CLAIM_VERSIONS_SIZE", 10000))
+# Long-lived, rotating refresh tokens renew access tokens without a
+# password check
+REFRESH_ENDPOINT = AUTH_ENDPOINT + "/refresh"
+REFRESH_TOKEN_LIFETIME_DAYS = int(os.environ.get("REFRESH_TOKEN_LIFETIME_DAYS", 30))
+REFRESH_TOKEN_BYTES = 32
+# Seconds a rotated refresh token is still accepted from concurrent
+# requests before reusing it revokes every token of the session
+REFRESH_TOKEN_REUSE_GRACE_SECONDS = float(
+    os.environ.get("REFRESH_TOKEN_REUSE_GRACE_SECONDS", 30))
 OAUTH2_SCHEME = OAuth2PasswordBearer(tokenUrl=TOKEN_ENDPOINT,
                                      auto_error=False)
 
 # Database Settings
+# "neo4j" for a Neo4j server, "memory" for the in-process graph
+# used by tests and benchmarks
+DATABASE_BACKEND = os.environ.get("DATABASE_BACKEND", "neo4j")
 DATABASE_URL = os.environ.get("DATABASE_URL", "neo4j://localhost:7687")
 DATABASE_USER = os.environ.get("DATABASE_USER", "neo4j")
 DATABASE_PASS = os.environ.get("DATABASE_PASS", "password")
+DATABASE_NAME = os.environ.get("DATABASE_NAME", None)  # None uses the server default
+# Connection pool tuning
+DATABASE_MAX_POOL_SIZE = int(os.environ.get("DATABASE_MAX_POOL_SIZE", 100))
+# Seconds to wait for a free pooled connection before failing
+DATABASE_ACQUISITION_TIMEOUT = float(
+    os.environ.get("DATABASE_ACQUISITION_TIMEOUT", 60))
+# Seconds before a pooled connection is closed and replaced
+DATABASE_MAX_CONNECTION_LIFETIME = float(
+    os.environ.get("DATABASE_MAX_CONNECTION_LIFETIME", 3600))
+# Seconds a managed transaction is retried on transient errors
+DATABASE_MAX_RETRY_TIME = float(os.environ.get("DATABASE_MAX_RETRY_TIME", 30))
+# "cluster" sends read transactions to followers/read replicas (requires
+# a neo4j:// URL), "leader" sends every transaction to the leader
+DATABASE_ROUTING = os.environ.get("DATABASE_ROUTING", "cluster")
+# Users whose causal-consistency bookmarks are kept for read-your-writes
+DATABASE_BOOKMARK_CACHE_SIZE = int(
+    os.environ.get("DATABASE_BOOKMARK_CACHE_SIZE", 10000))
+# Fraction of requests whose queries are run with PROFILE (0 disables)
+DATABASE_PROFILE_SAMPLE_RATE = float(
+    os.environ.get("DATABASE_PROFILE_SAMPLE_RATE", 0))
+# Queries slower than this many milliseconds are logged as warnings
+DATABASE_SLOW_QUERY_MS = float(os.environ.get("DATABASE_SLOW_QUERY_MS", 250))
+# Cache the results of hot reads (see drivers.database.cache.TAGS)
+QUERY_CACHE_ENABLED = os.environ.get("QUERY_CACHE_ENABLED", "true").lower() == "true"
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES",
+                                           64 * 1024 * 1024))
+# Bounds how long writes made by other workers can go unseen
+QUERY_CACHE_TTL_SECONDS = float(os.environ.get("QUERY_CACHE_TTL_SECONDS", 30))
+# Apply pending schema migrations (constraints & indexes) at startup
+DATABASE_MIGRATE_ON_STARTUP = True
+
+# Votes
+# Buffer vote counter deltas in memory and flush them in batches instead
+# of locking the voted post on every vote
+VOTE_WRITE_BEHIND = os.environ.get("VOTE_WRITE_BEHIND", "false").lower() == "true"
+VOTE_FLUSH_INTERVAL_SECONDS = float(
+    os.environ.get("VOTE_FLUSH_INTERVAL_SECONDS", 1))
+VOTE_FLUSH_BATCH_SIZE = int(os.environ.get("VOTE_FLUSH_BATCH_SIZE", 1000))
+# Per-user cache of which posts a user liked/disliked, used by feeds
+VOTE_STATE_CACHE_USERS = int(os.environ.get("VOTE_STATE_CACHE_USERS", 10000))
+VOTE_STATE_CACHE_TTL_SECONDS = float(
+    os.environ.get("VOTE_STATE_CACHE_TTL_SECONDS", 300))
+
+# Rankings
+# Seconds before a sub's hot/top/new/controversial indexes are rebuilt
+# from the database (drops posts deleted through other workers)
+RANKING_MAX_AGE_SECONDS = float(os.environ.get("RANKING_MAX_AGE_SECONDS", 300))
+# Seconds between reads of the posts created, published or voted on
+# through other workers
+RANKING_SYNC_SECONDS = float(os.environ.get("RANKING_SYNC_SECONDS", 5))
+# Subs whose indexes are kept in memory, least recently read dropped first
+RANKING_MAX_SUBS = int(os.environ.get("RANKING_MAX_SUBS", 1000))
+
+# Authenticated users kept in memory, and for how long
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", 60))
+
+# Nodes recomputed per write by the admin counter repair job
+COUNTER_REPAIR_BATCH_SIZE = int(os.environ.get("COUNTER_REPAIR_BATCH_SIZE", 500))
+
+# Comments sent per comment tree request; further replies are collapsed
+# into More lines
+COMMENT_TREE_MAX_COMMENTS = int(os.environ.get("COMMENT_TREE_MAX_COMMENTS", 500))
+
+# Home timelines
+# Posts kept in each user's home timeline
+TIMELINE_SIZE = int(os.environ.get("TIMELINE_SIZE", 500))
+# Subs with more subscribers than this are merged into home feeds at
+# read time instead of being pushed into every subscriber's timeline
+TIMELINE_FANOUT_LIMIT = int(os.environ.get("TIMELINE_FANOUT_LIMIT", 10000))
 
 # Used to filter out dangerous query parameters
 BASE_PROPERTIES = ["User"]
@@ -92,7 +195,35 @@ TEMPLATES = Jinja2Templates(directory=TEMPLATE_DIR)
 HASH_FILES = False
 HASH_FUNC = hashlib.sha256
 UPLOAD_DIR = "uploads"
-STORAGE_DRIVER = StorageDriver(UPLOAD_DIR)
+# Largest accepted upload
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 64 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", 2**20))
+# fsync uploads before they become visible
+UPLOAD_FSYNC = os.environ.get("UPLOAD_FSYNC", "true").lower() == "true"
+# Store identical uploads once, keyed by their HASH_FUNC digest.
+# Run ./dedupe.py after turning it on to convert existing uploads
+STORAGE_DEDUPE = os.environ.get("STORAGE_DEDUPE", "false").lower() == "true"
+# Directory levels uploads are spread over (0 for one flat directory).
+# Run ./reshard.py after changing it to move existing uploads
+STORAGE_SHARD_DEPTH = int(os.environ.get("STORAGE_SHARD_DEPTH", 2))
+# Files are served by UUID and never change, so browsers and proxies may
+# keep them; lookups by filename are revalidated with their ETag instead
+FILE_CACHE_CONTROL = os.environ.get("FILE_CACHE_CONTROL",
+                                    "public, max-age=31536000, immutable")
+FILE_NAME_CACHE_CONTROL = "no-cache"
+# Let a fronting proxy send downloads: "x-accel-redirect" (nginx) or
+# "x-sendfile" (lighttpd, Apache). Empty sends them from the app
+STORAGE_OFFLOAD = os.environ.get("STORAGE_OFFLOAD", "") or None
+# Internal nginx location aliased to UPLOAD_DIR, or UPLOAD_DIR's path as
+# seen by the X-Sendfile proxy (defaults to its absolute path)
+STORAGE_OFFLOAD_PATH = os.environ.get("STORAGE_OFFLOAD_PATH", None)
+# Downloads are sent as stored, never gzipped by the app
+GZIP_EXCLUDE_PATHS = ["/api/file/read"]
+STORAGE_DRIVER = StorageDriver(UPLOAD_DIR, chunk_size=UPLOAD_CHUNK_BYTES,
+                               fsync=UPLOAD_FSYNC, dedupe=STORAGE_DEDUPE,
+                               shard_depth=STORAGE_SHARD_DEPTH,
+                               offload=STORAGE_OFFLOAD,
+                               offload_path=STORAGE_OFFLOAD_PATH)
 
 # App Middleware
 MIDDLEWARE = [{
@@ -100,8 +231,9 @@ MIDDLEWARE = [{
     "allowed_hosts": ALLOWED_HOSTS
 },
     {
-        "root": GZipMiddleware,
-        "minimum_size": 500
+        "root": DownloadGZipMiddleware,
+        "minimum_size": 500,
+        "exclude": GZIP_EXCLUDE_PATHS
 }
 ]
 
@@ -117,7 +249,56 @@ if CORS_ENABLED:
 if FORCE_SSL:
     MIDDLEWARE.append({"root": HTTPSRedirectMiddleware})
 
-# Neo4j Database Driver for convenience
-DB = GraphDatabase.driver(DATABASE_URL,
-                          auth=(DATABASE_USER,
-                                DATABASE_PASS))
+# Pending vote counter deltas
+VOTE_BUFFER = VoteBuffer(enabled=VOTE_WRITE_BEHIND,
+                         interval=VOTE_FLUSH_INTERVAL_SECONDS,
+                         batch_size=VOTE_FLUSH_BATCH_SIZE)
+
+# Users' votes on the posts they viewed
+VOTE_STATES = VoteStateCache(max_users=VOTE_STATE_CACHE_USERS,
+                             ttl=VOTE_STATE_CACHE_TTL_SECONDS)
+
+# Ranked post indexes per sub
+RANKINGS = Rankings(buffer=VOTE_BUFFER, max_age=RANKING_MAX_AGE_SECONDS,
+                    sync_interval=RANKING_SYNC_SECONDS,
+                    max_subs=RANKING_MAX_SUBS)
+
+# Subscription home feeds
+TIMELINES = Timelines(RANKINGS, size=TIMELINE_SIZE,
+                      fanout_limit=TIMELINE_FANOUT_LIMIT)
+
+# Password hashing & verification pool
+PASSWORD_HASHER = PasswordHasher(PWD_CONTEXT,
+                                 workers=PASSWORD_HASH_WORKERS,
+                                 queue_limit=PASSWORD_HASH_QUEUE_LIMIT,
+                                 retry_after=PASSWORD_HASH_RETRY_AFTER_SECONDS,
+                                 processes=PASSWORD_HASH_PROCESSES)
+
+# Resolved users of authenticated requests
+USER_CACHE = UserCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+# Security versions of changed users, for tokens' authorization claims
+CLAIM_VERSIONS = ClaimVersions(max_size=CLAIM_VERSIONS_SIZE)
+
+# Query result cache
+QUERY_CACHE = None
+if QUERY_CACHE_ENABLED:
+    QUERY_CACHE = QueryCache(max_bytes=QUERY_CACHE_MAX_BYTES,
+                             ttl=QUERY_CACHE_TTL_SECONDS)
+
+# Async data-access layer for convenience
+if DATABASE_BACKEND == "memory":
+    DB = MemoryDatabase(slow_query_ms=DATABASE_SLOW_QUERY_MS,
+                        cache=QUERY_CACHE)
+else:
+    DB = Database(DATABASE_URL, DATABASE_USER, DATABASE_PASS,
+                  database=DATABASE_NAME,
+                  max_pool_size=DATABASE_MAX_POOL_SIZE,
+                  acquisition_timeout=DATABASE_ACQUISITION_TIMEOUT,
+                  max_connection_lifetime=DATABASE_MAX_CONNECTION_LIFETIME,
+                  max_retry_time=DATABASE_MAX_RETRY_TIME,
+                  routing=DATABASE_ROUTING,
+                  bookmark_cache_size=DATABASE_BOOKMARK_CACHE_SIZE,
+                  profile_sample_rate=DATABASE_PROFILE_SAMPLE_RATE,
+                  slow_query_ms=DATABASE_SLOW_QUERY_MS,
+                  cache=QUERY_CACHE)
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+"""dedupe.py
+
+Handy script for converting existing uploads to deduplicated,
+content-addressed storage. Safe to run while the server is up, and to
+run again after an interruption.
+
+usage:
+    ./dedupe.py                   # Deduplicate every stored file
+    ./dedupe.py --batch-size 500  # Files listed per database read
+
+"""
+import argparse
+import asyncio
+from config import settings
+from drivers.storage.dedupe import DedupeUploads
+
+
+async def main(args):
+    try:
+        summary = await DedupeUploads(settings.DB, settings.STORAGE_DRIVER,
+                                      settings.HASH_FUNC,
+                                      batch_size=args.batch_size)
+        print(f"Checked {summary['Checked']} files: "
+              f"{summary['Deduplicated']} duplicates removed, "
+              f"{summary['Missing']} missing, "
+              f"{summary['BytesFreed']} bytes freed.")
+        if not settings.STORAGE_DEDUPE:
+            print("STORAGE_DEDUPE is off, new uploads are not deduplicated.")
+    finally:
+        await settings.DB.Close()
+
+if __name__ in '__main__':
+    parser = argparse.ArgumentParser(description="VioletHawk upload deduplication")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Files listed per database read")
+    asyncio.run(main(parser.parse_args()))
@@ -10,11 +10,13 @@ from typing import Optional
 
 from config import settings
 from drivers.auth import utils
-from models.auth import Token, TokenData
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import GetUnitOfWork, UnitOfWorkRoute
+from models.auth import Token, TokenData, RefreshRequest
 from models.user import User, UserRegister
 from datetime import datetime, timedelta
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 ROUTE = {
     "router":router,
     "prefix":settings.AUTH_ENDPOINT,
@@ -24,7 +26,8 @@ ROUTE = {
 # Registration Endpoint
 
 @router.post("/register")
-async def register_user(request:Request, user:UserRegister):
+async def register_user(request:Request, user:UserRegister,
+                        db: UnitOfWork = Depends(GetUnitOfWork)):
     if not settings.ENABLE_ACCOUNT_CREATION:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -46,7 +49,7 @@ async def register_user(request:Request, user:UserRegister):
     salt, saltPos = utils.CreateSalt(len(user.password))
     salted = utils.SaltPassword(user.password, salt, saltPos)
     # Hash the password
-    phash = utils.CreatePasswordHash(salted)
+    phash = await utils.CreatePasswordHash(salted)
     attributes = {
         "UUID":str(uuid.uuid4()),
         "ScreenName":user.screenName,
@@ -62,29 +65,29 @@ async def register_user(request:Request, user:UserRegister):
         "Salt": salt,
         "SaltPos": saltPos
     }
-    cypher = "CREATE (user:User $params) RETURN user"
-    with settings.DB.session() as session:
-        if utils.GetUser(user.UUID):
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=f"Operation not permitted, user with email: {user.email} already exists.",
-                headers={"WWW-Authenticate": "Bearer"}
-            )
-        # Otherwise, create a new user
-        response = session.run(query=cypher, parameters={
-            'params': attributes
-        })
-        user_data = response.data()[0]['user']
+    if await utils.GetUserByEmail(db, user.email):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Operation not permitted, user with email: {user.email} already exists.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    # Otherwise, create a new user
+    response = await db.Write("CreateUser", {
+        'params': attributes
+    })
+    user_data = response[0]['user']
+    db.Bind(user_data["UUID"])
 
     return User(**user_data)
 
 @router.post("/token", response_model=Token)
-async def login_access_token(request:Request, form_data: OAuth2PasswordRequestForm = Depends(), expires: Optional[timedelta] = None):
+async def login_access_token(request:Request, form_data: OAuth2PasswordRequestForm = Depends(), expires: Optional[timedelta] = None,
+                             db: UnitOfWork = Depends(GetUnitOfWork)):
     if not settings.ENABLE_BEARER_AUTH:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="Token Authentication Has Been Disabled")
 
-    user = utils.AuthenticateUser(form_data.username, form_data.password)
+    user = await utils.AuthenticateUser(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -93,7 +96,43 @@ async def login_access_token(request:Request, form_data: OAuth2PasswordRequestFo
         )
     if expires:
         token = utils.CreateAccessToken(
-            data={"UUID": user.UUID, "IP":request.client.host}, expires_delta=expires)
+            data=utils.TokenClaims(user, request.client.host), expires_delta=expires)
     else:
-        token = utils.CreateAccessToken(data={"UUID": user.UUID, "IP":request.client.host})
-    return {"access_token": token, "token_type": "bearer"}
\ No newline at end of file
+        token = utils.CreateAccessToken(data=utils.TokenClaims(user, request.client.host))
+    refresh = await utils.CreateRefreshToken(db, user.UUID)
+    return {"access_token": token, "token_type": "bearer",
+            "refresh_token": refresh}
+
+# Refresh Endpoints
+
+@router.post("/refresh", response_model=Token)
+async def refresh_access_token(request:Request, body: RefreshRequest,
+                               db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Exchanges a refresh token for a new access token and the next
+    refresh token. The presented refresh token stops working.
+    """
+    if not settings.ENABLE_BEARER_AUTH:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="Token Authentication Has Been Disabled")
+    uid, refresh = await utils.RotateRefreshToken(db, body.refresh_token)
+    user = None
+    if refresh:
+        db.Bind(uid)
+        user = await utils.GetAuthenticatedUser(db, uid)
+    if not user or user.Disabled or user.Banned:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    token = utils.CreateAccessToken(data=utils.TokenClaims(user, request.client.host))
+    return {"access_token": token, "token_type": "bearer",
+            "refresh_token": refresh}
+
+@router.post("/revoke")
+async def revoke_refresh_token(body: RefreshRequest,
+                               db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Ends the session a refresh token belongs to.
+    """
+    await utils.RevokeRefreshToken(db, body.refresh_token)
+    return {"response": "Refresh token revoked."}
\ No newline at end of file
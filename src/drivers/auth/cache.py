@@ -0,0 +1,161 @@
+"""auth/cache.py
+
+VioletHawk authenticated-user cache
+
+Every authenticated request resolves its user from the token's UUID.
+UserCache keeps the resolved active users in memory so that lookup is a
+dictionary hit instead of a GetUser round trip. Changes to a user call
+InvalidateUser(), which drops the entry once the change has committed.
+
+Access tokens also carry the user's authorization claims and security
+version, so most requests need no lookup at all. ClaimVersions remembers
+the newest security version of recently changed users; tokens issued
+before the change fall back to the lookup.
+"""
+import math
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """UserCache is a bounded LRU of active users keyed by UUID.
+
+        max_size: int - Users kept, least recently used dropped first
+        ttl: float - Seconds a user is served for; bounds how long changes
+                     made through other workers go unseen
+
+        Usage:
+            tick = USER_CACHE.Tick()
+            user = USER_CACHE.Get(uid)
+            if user is None:
+                user = await GetUser(db, uid)
+                USER_CACHE.Put(user, tick)
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.users = OrderedDict()  # UUID -> (expires, UserInDB)
+        # A user read before it was invalidated must not be cached
+        self.tick = 0
+        self.invalidated = OrderedDict()  # UUID -> tick
+        self.forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def Tick(self):
+        """Tick - Marks the start of a lookup that may be cached."""
+        return self.tick
+
+    def Get(self, uid: str):
+        """Get - Returns a copy of the cached user, or None on a miss.
+        """
+        entry = self.users.get(uid)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            self.users.pop(uid, None)
+            return None
+        self.hits += 1
+        self.users.move_to_end(uid)
+        return entry[1].copy()
+
+    def Put(self, user, tick: int):
+        """Put - Caches a user looked up since tick. Disabled and banned
+        users are not cached, so they are always checked again.
+        """
+        if user.Disabled or user.Banned:
+            return
+        if self.forgotten > tick or self.invalidated.get(user.UUID, -1) > tick:
+            return
+        self.users[user.UUID] = (time.monotonic() + self.ttl, user.copy())
+        self.users.move_to_end(user.UUID)
+        while len(self.users) > self.max_size:
+            self.users.popitem(last=False)
+            self.evictions += 1
+
+    def Invalidate(self, *uids: str):
+        """Invalidate - Drops cached users.
+        """
+        self.tick += 1
+        for uid in uids:
+            self.users.pop(uid, None)
+            self.invalidated[uid] = self.tick
+            self.invalidated.move_to_end(uid)
+        while len(self.invalidated) > self.max_size:
+            _, self.forgotten = self.invalidated.popitem(last=False)
+
+    def Stats(self):
+        """Stats - Returns hit, miss and eviction counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "Entries": len(self.users),
+            "MaxSize": self.max_size,
+            "TTL": self.ttl,
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "HitRatio": self.hits / lookups if lookups else 0,
+            "Evictions": self.evictions,
+        }
+
+
+class ClaimVersions:
+    """ClaimVersions is a bounded table of the minimum security version a
+    token's claims must carry to be trusted, per user.
+
+        max_size: int - Users remembered. Tokens issued before the newest
+                        forgotten entry are never trusted
+
+        Usage:
+            if CLAIM_VERSIONS.Current(uid, claims.Ver, claims.iat):
+                # Authorize from the claims alone
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.versions = OrderedDict()  # UUID -> version
+        self.forgotten = 0  # time.time() of the newest dropped entry
+        self.trusted = 0
+        self.stale = 0
+
+    def Current(self, uid: str, version: int, issued: float):
+        """Current - Whether claims at version, issued at the given Unix
+        time, are still up to date.
+        """
+        current = (issued > self.forgotten
+                   and version >= self.versions.get(uid, 0))
+        if current:
+            self.trusted += 1
+        else:
+            self.stale += 1
+        return current
+
+    def Set(self, uid: str, version: int = None):
+        """Set - Records a user's new security version. None distrusts
+        every token of the user, e.g. once it is deleted.
+        """
+        self.versions[uid] = math.inf if version is None else version
+        self.versions.move_to_end(uid)
+        while len(self.versions) > self.max_size:
+            self.versions.popitem(last=False)
+            self.forgotten = time.time()
+
+    def Observe(self, uid: str, version: int):
+        """Observe - Raises a user's version to one read from the database,
+        picking up changes made through other workers.
+        """
+        if version > self.versions.get(uid, 0):
+            self.Set(uid, version)
+
+    def Stats(self):
+        """Stats - Returns how many tokens were trusted and looked up.
+        """
+        checked = self.trusted + self.stale
+        return {
+            "Entries": len(self.versions),
+            "MaxSize": self.max_size,
+            "Trusted": self.trusted,
+            "Stale": self.stale,
+            "TrustedRatio": self.trusted / checked if checked else 0,
+        }
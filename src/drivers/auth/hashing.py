@@ -0,0 +1,146 @@
+"""auth/hashing.py
+
+VioletHawk password hashing pool
+
+bcrypt is deliberately slow. Hashing or verifying a password inside a
+request handler blocks the worker's event loop for the whole computation,
+stalling every other request it is serving. PasswordHasher runs that work
+on a small, dedicated pool of threads (or processes) and turns requests
+away with 503 once too many are waiting, instead of queueing without
+bound.
+"""
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from drivers.database.metrics import QueryStats
+
+LOGGER = logging.getLogger("violethawk.auth")
+
+# CryptContext of a process pool worker, see _Init()
+_CONTEXT = None
+
+
+def _Init(config: str):
+    global _CONTEXT
+    _CONTEXT = CryptContext.from_string(config)
+
+
+def _Call(context, method: str, *args):
+    """_Call - Runs a CryptContext method on a worker and returns its
+    result with the milliseconds it took.
+    """
+    started = time.perf_counter()
+    result = getattr(context or _CONTEXT, method)(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+class PasswordHasher:
+    """PasswordHasher runs CryptContext hashing and verification on a
+    bounded worker pool.
+
+        context: CryptContext - settings.PWD_CONTEXT
+        workers: int - Passwords hashed at once
+        queue_limit: int - Further passwords allowed to wait for a worker
+        retry_after: int - Seconds clients are told to wait when saturated
+        processes: bool - Use worker processes instead of threads
+
+        Usage:
+            phash = await PASSWORD_HASHER.Hash(salted)
+            if await PASSWORD_HASHER.Verify(salted, phash):
+                # Password matches
+    """
+
+    def __init__(self, context: CryptContext, workers: int = 4,
+                 queue_limit: int = 64, retry_after: int = 1,
+                 processes: bool = False):
+        self.context = context
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.retry_after = retry_after
+        self.processes = processes
+        self.executor = None
+        self.pending = 0
+        self.peak = 0
+        self.rejected = 0
+        self.stats = {"Hash": QueryStats(), "Verify": QueryStats()}
+        self.waits = QueryStats()
+
+    def _Executor(self):
+        if self.executor is None:
+            if self.processes:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_Init,
+                    initargs=(self.context.to_string(),))
+            else:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="PasswordHasher")
+        return self.executor
+
+    async def _Run(self, kind: str, method: str, *args):
+        if self.pending >= self.workers + self.queue_limit:
+            self.rejected += 1
+            LOGGER.warning(json.dumps({"Event": "PasswordHasherSaturated",
+                                       "Kind": kind,
+                                       "Pending": self.pending}))
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many sign-ins in progress, try again shortly.",
+                headers={"Retry-After": str(self.retry_after)}
+            )
+        self.pending += 1
+        self.peak = max(self.peak, self.pending)
+        queued = time.perf_counter()
+        stats = self.stats[kind]
+        try:
+            # Process workers build their own context in _Init()
+            context = None if self.processes else self.context
+            result, ms = await asyncio.get_running_loop().run_in_executor(
+                self._Executor(), _Call, context, method, *args)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            self.pending -= 1
+        total = (time.perf_counter() - queued) * 1000
+        stats.Add(ms, 0, 0)
+        self.waits.Add(max(total - ms, 0), 0, 0)
+        return result
+
+    async def Hash(self, pword: str):
+        """Hash - Returns the hash of a (salted) password.
+        """
+        return await self._Run("Hash", "hash", pword)
+
+    async def Verify(self, pword: str, phash: str):
+        """Verify - Checks a (salted) password against its hash.
+        """
+        return await self._Run("Verify", "verify", pword, phash)
+
+    def Close(self):
+        """Close - Shuts the worker pool down.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def Stats(self):
+        """Stats - Returns queue depth, rejections and hash latencies.
+        """
+        return {
+            "Workers": self.workers,
+            "Processes": self.processes,
+            "QueueLimit": self.queue_limit,
+            "Pending": self.pending,
+            "QueueDepth": max(self.pending - self.workers, 0),
+            "PeakPending": self.peak,
+            "Rejected": self.rejected,
+            "WaitMs": self.waits.Summary(),
+            "Hash": self.stats["Hash"].Summary(),
+            "Verify": self.stats["Verify"].Summary(),
+        }
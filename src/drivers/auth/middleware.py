@@ -0,0 +1,41 @@
+"""auth/middleware.py
+
+VioletHawk authentication middleware
+"""
+from starlette.responses import Response
+
+from drivers.auth.utils import SetAuthCookies
+
+
+class RenewedCookieMiddleware:
+    """RenewedCookieMiddleware sends the auth cookies renewed while
+    serving a request (see GetCookieUserAllowGuest), since views return
+    their own responses. It is plain ASGI, so responses sent with server
+    extensions (see StoredFileResponse) pass through untouched.
+
+        Usage:
+            app.add_middleware(RenewedCookieMiddleware)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def SendWithCookies(message):
+            if message["type"] == "http.response.start":
+                # request.state lives in scope["state"]
+                cookies = (scope.get("state") or {}).get("auth_cookies")
+                if cookies:
+                    carrier = Response()
+                    SetAuthCookies(carrier, cookies)
+                    message = dict(message, headers=(
+                        list(message.get("headers", []))
+                        + [h for h in carrier.raw_headers
+                           if h[0] == b"set-cookie"]))
+            await send(message)
+
+        await self.app(scope, receive, SendWithCookies)
@@ -4,6 +4,10 @@ VioletHawk API Authentication Utilities
 
 """
 import re
+import json
+import uuid
+import hashlib
+import logging
 import secrets
 import string
 from jose import JWTError, jwt
@@ -12,9 +16,13 @@ from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status, Request
 
 from config import settings
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import GetUnitOfWork
 from models.user import User, UserInDB
 from models.auth import TokenData
 
+LOGGER = logging.getLogger("violethawk.auth")
+
 # Password Stuff
 
 def CreateSalt(plen: int):
@@ -46,26 +54,30 @@ def SaltPassword(pword:str, salt:str, saltPos:int):
         return False
     return pword[:saltPos] + salt + pword[saltPos:]
 
-def CreatePasswordHash(pword: str):
-    """CreatePasswordHash - Generates a hash of a password string.
+async def CreatePasswordHash(pword: str):
+    """CreatePasswordHash - Generates a hash of a password string on the
+    password hashing pool.
         pword: str
 
         Usage:
-            hash = CreatePasswordhash('password') 
+            hash = await CreatePasswordHash('password')
     """
-    return settings.PWD_CONTEXT.hash(pword)
+    return await settings.PASSWORD_HASHER.Hash(pword)
 
-def VerifyPassword(user:User, plain: str):
-    """VerifyPassword - Verifies a plaintext password.
+async def VerifyPassword(user:User, plain: str):
+    """VerifyPassword - Verifies a plaintext password on the password
+    hashing pool.
         user: User - use GetUser()
         plain: str - The plaintext password
 
         Usage:
-            if(VerifyPassword(user, password)):
+            if await VerifyPassword(user, password):
                 # Authenticated successfully
     """
     salted = SaltPassword(plain, user.Salt, user.SaltPos)
-    return settings.PWD_CONTEXT.verify(salted, user.HashedPassword)
+    if not salted:
+        return False
+    return await settings.PASSWORD_HASHER.Verify(salted, user.HashedPassword)
 
 def ValidatePasswordComplexity(pword: str):
     """ValidatePasswordComplexity
@@ -92,73 +104,95 @@ def ValidateEmail(email: str):
     return False
 
 
-def GetUser(uid: str):
+async def GetUser(db: UnitOfWork, uid: str):
     """GetUser - Retrieves a user by email.
+        db: UnitOfWork - use GetUnitOfWork()
         uid: user.UUID
 
         Usage:
-            user = GetUser(uid)
+            user = await GetUser(db, uid)
             if user:
                 # User found!
     """
-    cypher_search = f"MATCH (user:User) WHERE user.UUID = '{uid}' RETURN user"
-    with settings.DB.session() as session:
-        user = session.run(query=cypher_search)
-        data = user.data()
-        if len(data) > 0:
-            user_data = data[0]['user']
-            print(user_data)
-            return UserInDB(**user_data)
+    data = await db.Read("GetUser", {"uid": uid})
+    if len(data) > 0:
+        user_data = data[0]['user']
+        return UserInDB(**user_data)
     return None
 
-def GetUserByEmail(email: str):
+async def GetAuthenticatedUser(db: UnitOfWork, uid: str):
+    """GetAuthenticatedUser - GetUser for the user named by a token,
+    served from settings.USER_CACHE when possible.
+        db: UnitOfWork - use GetUnitOfWork()
+        uid: user.UUID
+    """
+    cache = settings.USER_CACHE
+    tick = cache.Tick()
+    user = cache.Get(uid)
+    if user is None:
+        user = await GetUser(db, uid)
+        if user is not None:
+            cache.Put(user, tick)
+            settings.CLAIM_VERSIONS.Observe(uid, user.SecurityVersion or 0)
+    return user
+
+def InvalidateUser(db: UnitOfWork, *uids: str):
+    """InvalidateUser - Drops users from settings.USER_CACHE once db has
+    committed. Call it whenever a user node changes.
+    """
+    db.AfterCommit(lambda: settings.USER_CACHE.Invalidate(*uids))
+
+def InvalidateClaims(db: UnitOfWork, uid: str, version: int = None):
+    """InvalidateClaims - Stops trusting the claims of a user's existing
+    access tokens once db has committed.
+        uid: user.UUID
+        version: int - The user's new SecurityVersion, None once deleted
+    """
+    db.AfterCommit(lambda: settings.CLAIM_VERSIONS.Set(uid, version))
+
+async def GetUserByEmail(db: UnitOfWork, email: str):
     """GetUserByEmail - Retrieves a user by email.
+        db: UnitOfWork - use GetUnitOfWork()
         email: email
 
         Usage:
-            user = GetUser(email)
+            user = await GetUserByEmail(db, email)
             if user:
                 # User found!
     """
-    cypher_search = f"MATCH (user:User) WHERE user.Email = '{email}' RETURN user"
-    with settings.DB.session() as session:
-        user = session.run(query=cypher_search)
-        data = user.data()
-        if len(data) > 0:
-            user_data = data[0]['user']
-            return UserInDB(**user_data)
+    data = await db.Read("GetUserByEmail", {"email": email})
+    if len(data) > 0:
+        user_data = data[0]['user']
+        return UserInDB(**user_data)
     return None
 
-def BlockUser(currentId:str, blockId:str):
+async def BlockUser(db: UnitOfWork, currentId:str, blockId:str):
     """BlockUser - Blocks a user.
+    db: UnitOfWork - use GetUnitOfWork()
     currentId: User.UUID
     blockId: User.UUID
     """
-    cypher = f"""MATCH (user:User)
-    WHERE user.UUID = "{currentId}"
-    MATCH (blocked:User)
-    WHERE blocked.UUID = "{blockId}"
-    SET user.Blocked += "{blockId}"
-    CREATE (user)-[rel:BLOCKED]->(blocked)
-    RETURN user
-    """
-    with settings.DB.session() as session:
-        res = session.run(query=cypher)
-        return res.data()[0]["user"]
-
-def AuthenticateUser(email: str, pword: str):
+    res = await db.Write("BlockUser", {"uid": currentId,
+                                       "blocked": blockId})
+    InvalidateUser(db, currentId)
+    if res:
+        InvalidateClaims(db, currentId, res[0]["user"]["SecurityVersion"])
+    return res[0]["user"]
+
+async def AuthenticateUser(db: UnitOfWork, email: str, pword: str):
     """AuthenticateUser - Authenticates a user and returns an instance of it.
+        db: UnitOfWork - use GetUnitOfWork()
         email: str
         pword: str
 
         Usage:
-            user = AuthenticateUser('email@email.com', 'password')
+            user = await AuthenticateUser(db, 'email@email.com', 'password')
             if user:
                 # Authentication success!
     """
-    user = GetUserByEmail(email)
+    user = await GetUserByEmail(db, email)
     if user:
-        return user if VerifyPassword(user, pword) else False
+        return user if await VerifyPassword(user, pword) else False
     return False
 
 
@@ -170,7 +204,7 @@ def CreateAccessToken(data:dict, expires_delta: Optional[timedelta] = None):
         expires_delta: Optional[timedelta] - Overrides server timeout
 
         Usage:
-            access_token = CreateAccessToken(data={"UUID":user.UUID, "IP":"ip_address"})
+            access_token = CreateAccessToken(data=TokenClaims(user, "ip_address"))
     """
     to_encode = data.copy()
     expire = datetime.now(settings.TIMEZONE)
@@ -179,15 +213,158 @@ def CreateAccessToken(data:dict, expires_delta: Optional[timedelta] = None):
     else:
         expire += timedelta(minutes=settings.TOKEN_LIFETIME_MINUTES)
     to_encode["exp"] = expire
+    to_encode["iat"] = datetime.now(settings.TIMEZONE)
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
 
+def TokenClaims(user: User, ip: str):
+    """TokenClaims - Returns the access token data of a user: its UUID,
+    the client IP and the claims ClaimsUser() authorizes requests from.
+        user: User
+        ip: str - request.client.host
+
+        Usage:
+            access_token = CreateAccessToken(data=TokenClaims(user, request.client.host))
+    """
+    return {
+        "UUID": user.UUID,
+        "IP": ip,
+        "Name": user.ScreenName,
+        "Email": user.Email,
+        "Admin": user.Admin,
+        "Disabled": user.Disabled,
+        "Banned": user.Banned,
+        "Blocked": user.Blocked or [],
+        "Ver": user.SecurityVersion or 0,
+    }
+
+def ClaimsUser(token_data: TokenData):
+    """ClaimsUser - Builds the user from an access token's claims, or
+    returns None when they may be out of date (the user changed since the
+    token was issued) and the user has to be looked up.
+        token_data: TokenData - use ReadToken()
+    """
+    if not settings.TOKEN_CLAIMS_ENABLED or token_data.Ver is None:
+        return None
+    if not settings.CLAIM_VERSIONS.Current(token_data.UUID, token_data.Ver,
+                                           token_data.iat or 0):
+        return None
+    return User(UUID=token_data.UUID,
+                ScreenName=token_data.Name,
+                Email=token_data.Email,
+                Admin=token_data.Admin,
+                Disabled=token_data.Disabled,
+                Banned=token_data.Banned,
+                Blocked=token_data.Blocked,
+                SecurityVersion=token_data.Ver)
+
+# Refresh tokens
+
+def _RefreshDigest(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _RefreshParams(token: str):
+    now = datetime.now(settings.TIMEZONE)
+    return {
+        "Hash": _RefreshDigest(token),
+        "Created": now,
+        "Expires": now + timedelta(days=settings.REFRESH_TOKEN_LIFETIME_DAYS),
+    }
+
+async def CreateRefreshToken(db: UnitOfWork, uid: str):
+    """CreateRefreshToken - Starts a new session for a user and returns
+    its first refresh token.
+        db: UnitOfWork - use GetUnitOfWork()
+        uid: str - User UUID
+
+        Usage:
+            refresh = await CreateRefreshToken(db, user.UUID)
+    """
+    token = secrets.token_urlsafe(settings.REFRESH_TOKEN_BYTES)
+    params = _RefreshParams(token)
+    params.update({"User": uid, "Family": str(uuid.uuid4())})
+    await db.Write("CreateRefreshToken", {"params": params,
+                                          "now": params["Created"]})
+    return token
+
+async def RotateRefreshToken(db: UnitOfWork, token: str):
+    """RotateRefreshToken - Exchanges a refresh token for the next one of
+    its session. Returns (user UUID, new refresh token). The new token is
+    None when a concurrent request already rotated this one, and both are
+    None when the token is unknown, expired or revoked. Presenting a token
+    that was rotated earlier revokes the whole session; that revocation is
+    committed at once, as the caller then fails the request.
+        db: UnitOfWork - use GetUnitOfWork()
+        token: str - Refresh token
+
+        Usage:
+            uid, refresh = await RotateRefreshToken(db, token)
+    """
+    renewed = secrets.token_urlsafe(settings.REFRESH_TOKEN_BYTES)
+    params = _RefreshParams(renewed)
+    now = params["Created"]
+    since = now - timedelta(seconds=settings.REFRESH_TOKEN_REUSE_GRACE_SECONDS)
+    res = await db.Write("RotateRefreshToken", {"hash": _RefreshDigest(token),
+                                                "params": params,
+                                                "now": now, "since": since})
+    if not res:
+        return None, None
+    if res[0]["valid"]:
+        return res[0]["user"], renewed
+    if res[0]["raced"]:
+        return res[0]["user"], None
+    if res[0]["rotated"]:
+        await RevokeRefreshToken(db, token)
+        await db.Commit()
+        LOGGER.warning(json.dumps({"Event": "RefreshTokenReuse",
+                                   "User": res[0]["user"]}))
+    return None, None
+
+async def RevokeRefreshToken(db: UnitOfWork, token: str):
+    """RevokeRefreshToken - Ends the session a refresh token belongs to.
+        db: UnitOfWork - use GetUnitOfWork()
+        token: str - Refresh token
+    """
+    await db.Write("RevokeRefreshFamily", {
+        "hash": _RefreshDigest(token),
+        "now": datetime.now(settings.TIMEZONE)
+    })
+
+async def RevokeUserRefreshTokens(db: UnitOfWork, uid: str):
+    """RevokeUserRefreshTokens - Ends every session of a user.
+        db: UnitOfWork - use GetUnitOfWork()
+        uid: str - User UUID
+    """
+    await db.Write("RevokeUserRefreshTokens", {
+        "uid": uid,
+        "now": datetime.now(settings.TIMEZONE)
+    })
+
+def SetAuthCookies(response, cookies: dict):
+    """SetAuthCookies - Sets (or, for None values, deletes) the "JWT" and
+    "Refresh" cookies on a response.
+        cookies: dict - Cookie name -> token
+
+        Usage:
+            SetAuthCookies(response, {"JWT": token, "Refresh": refresh})
+    """
+    for key, value in cookies.items():
+        if value is None:
+            response.delete_cookie(key)
+        elif key == "Refresh":
+            response.set_cookie(key=key, value=value, httponly=True,
+                                samesite="lax",
+                                max_age=settings.REFRESH_TOKEN_LIFETIME_DAYS * 86400)
+        else:
+            response.set_cookie(key=key, value=value, httponly=True,
+                                samesite="lax")
+
 def ReadToken(token: str):
     """ReadToken returns the token data.
     """
     cred_except = HTTPException(
         status_code = status.HTTP_401_UNAUTHORIZED,
         detail = "Could not validate credentials.",
-        headers = {"WWW-Authenticate", "Bearer"}
+        headers = {"WWW-Authenticate": "Bearer"}
     )
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
@@ -195,18 +372,21 @@ def ReadToken(token: str):
         ip: str = payload.get("IP")
         if uid is None or ip is None:
             raise cred_except
-        token_data = TokenData(UUID=uid,IP=ip)
+        token_data = TokenData(**payload)
     except JWTError as e:
         raise cred_except from e
     return token_data, cred_except
 
-async def GetCurrentUser(token: str = Depends(settings.OAUTH2_SCHEME)):
+async def GetCurrentUser(token: str = Depends(settings.OAUTH2_SCHEME),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
     """GetCurrentUser - Used to decrypt & return auth tokens.
     """
     if not token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
     token_data, cred_except = ReadToken(token=token)
-    user = GetUser(token_data.UUID)
+    db.Bind(token_data.UUID)
+    user = (ClaimsUser(token_data)
+            or await GetAuthenticatedUser(db, token_data.UUID))
     if user is None:
         raise cred_except
     return user
@@ -220,12 +400,15 @@ async def GetCurrentActiveUser(current: User = Depends(GetCurrentUser)):
         raise HTTPException(status_code=400, detail="User Banned.")
     return current
 
-async def GetCurrentActiveUserAllowGuest(token: str = Depends(settings.OAUTH2_SCHEME)):
+async def GetCurrentActiveUserAllowGuest(token: str = Depends(settings.OAUTH2_SCHEME),
+                                         db: UnitOfWork = Depends(GetUnitOfWork)):
     """GetCurrentUserAllowGuest """
     if not token:
         return None
     token_data, _ = ReadToken(token=token)
-    current = GetUser(token_data.UUID)
+    db.Bind(token_data.UUID)
+    current = (ClaimsUser(token_data)
+               or await GetAuthenticatedUser(db, token_data.UUID))
     if not current:
         return None
     if current.Disabled:
@@ -234,21 +417,46 @@ async def GetCurrentActiveUserAllowGuest(token: str = Depends(settings.OAUTH2_SC
         raise HTTPException(status_code=400, detail="User Banned.")
     return current
 
-async def GetCurrentCookieUser(request: Request):
+async def GetCurrentCookieUser(request: Request,
+                               db: UnitOfWork = Depends(GetUnitOfWork)):
     """GetCurrentCookieUser - Used to authenticate users via cookie
     """
     if "JWT" in request.cookies:
-        return await GetCurrentUser(token=request.cookies["JWT"])
+        return await GetCurrentUser(token=request.cookies["JWT"], db=db)
     return None
 
-async def GetCookieUserAllowGuest(request: Request):
+async def GetCookieUserAllowGuest(request: Request,
+                                  db: UnitOfWork = Depends(GetUnitOfWork)):
     """GetCookieUserAllowGuest - Used to authenticate users via cookie
     while allowing guest access
     """
 
     if "JWT" in request.cookies:
         try:
-            return await GetCurrentActiveUserAllowGuest(token=request.cookies["JWT"])
+            return await GetCurrentActiveUserAllowGuest(token=request.cookies["JWT"],
+                                                        db=db)
         except HTTPException as e:
-            return None
+            if e.status_code != status.HTTP_401_UNAUTHORIZED:
+                return None
+    if "Refresh" in request.cookies:
+        return await RefreshCookieUser(request, db)
     return None
+
+async def RefreshCookieUser(request: Request, db: UnitOfWork):
+    """RefreshCookieUser - Renews an expired "JWT" cookie from the
+    "Refresh" cookie, without checking the password again.
+    """
+    uid, refresh = await RotateRefreshToken(db, request.cookies["Refresh"])
+    if uid is None:
+        request.state.auth_cookies = {"JWT": None, "Refresh": None}
+        return None
+    db.Bind(uid)
+    user = await GetAuthenticatedUser(db, uid)
+    if not user or user.Disabled or user.Banned:
+        return None
+    cookies = {"JWT": CreateAccessToken(data=TokenClaims(user,
+                                                         request.client.host))}
+    if refresh:
+        cookies["Refresh"] = refresh
+    request.state.auth_cookies = cookies
+    return user
@@ -0,0 +1,171 @@
+"""drivers/database/cache.py
+
+Read-through cache of named query results.
+
+Results of the queries in TAGS are kept per (query name, parameters)
+and tagged with the entities they were read from, e.g. "sub:pics" or
+"post:<UUID>". Mutations call UnitOfWork.Invalidate(tag), which drops
+every entry carrying the tag once the write has committed. Entries are
+evicted least recently used first once max_bytes is exceeded, and expire
+after ttl seconds so writes made by other workers show up eventually.
+"""
+import copy
+import json
+import time
+from collections import OrderedDict
+
+
+def _Tags(prefix: str, key: str, records: list, field: str):
+    return [f"{prefix}:{each[field][key]}" for each in records
+            if each.get(field)]
+
+
+# Query name -> function(parameters, records) returning the entry's tags
+TAGS = {
+    "GetSub": lambda p, r: [f"sub:{p['title']}"],
+    "ListSubs": lambda p, r: ["subs"] + _Tags("sub", "Title", r, "v"),
+    "GetPost": lambda p, r: [f"post:{p['uid']}"],
+    "GetPostByTitle": lambda p, r: (["posts"]
+                                    + _Tags("post", "UUID", r, "post")),
+    "GetComment": lambda p, r: [f"comment:{p['uid']}"],
+    "ListComments": lambda p, r: ([f"comments:{p['uid']}"]
+                                  + _Tags("comment", "UUID", r, "comment")),
+}
+
+# Invalidation ticks remembered per tag
+MAX_INVALIDATED_TAGS = 10000
+
+
+class QueryCache:
+    """QueryCache is a tagged, size-bounded LRU cache of query results.
+
+        max_bytes: int - Approximate size of every cached result together
+        ttl: float - Seconds an entry is served for
+
+        Usage:
+            tick = cache.Tick()
+            records = cache.Get("GetSub", {"title": title})
+            if records is None:
+                records = await RunQuery(...)
+                cache.Put("GetSub", {"title": title}, records, tick)
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 30):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        # key -> (expires, size, records, tags)
+        self.entries = OrderedDict()
+        self.tags = {}  # tag -> set of keys
+        # A result read before its tag was invalidated must not be cached
+        self.tick = 0
+        self.invalidated = OrderedDict()  # tag -> tick
+        self.forgotten = 0  # Newest tick dropped from invalidated
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _Key(name: str, parameters: dict):
+        return name, json.dumps(parameters or {}, sort_keys=True, default=str)
+
+    def Tick(self):
+        """Tick - Marks the start of a read that may be cached."""
+        return self.tick
+
+    def Get(self, name: str, parameters: dict):
+        """Get - Returns a copy of the cached records, or None on a miss.
+        """
+        if name not in TAGS:
+            return None
+        key = self._Key(name, parameters)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.monotonic():
+            self.expirations += 1
+            self.misses += 1
+            self._Drop(key)
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        # Callers update records in place (e.g. VOTE_BUFFER.Apply)
+        return copy.deepcopy(entry[2])
+
+    def Put(self, name: str, parameters: dict, records: list, tick: int):
+        """Put - Caches the records of a query that started at tick.
+        """
+        if name not in TAGS:
+            return
+        tags = TAGS[name](parameters, records)
+        if self.forgotten > tick or any(
+                self.invalidated.get(tag, -1) > tick for tag in tags):
+            return
+        key = self._Key(name, parameters)
+        size = len(key[1]) + len(json.dumps(records, default=str))
+        if size > self.max_bytes:
+            return
+        self._Drop(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size,
+                             copy.deepcopy(records), tags)
+        self.bytes += size
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while self.bytes > self.max_bytes:
+            self._Drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _Drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[1]
+        for tag in entry[3]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def Invalidate(self, *tags: str):
+        """Invalidate - Drops every entry carrying one of the tags.
+        """
+        self.tick += 1
+        for tag in tags:
+            self.invalidated[tag] = self.tick
+            self.invalidated.move_to_end(tag)
+            for key in list(self.tags.get(tag, ())):
+                self._Drop(key)
+                self.invalidations += 1
+        while len(self.invalidated) > MAX_INVALIDATED_TAGS:
+            _, self.forgotten = self.invalidated.popitem(last=False)
+
+    def Clear(self):
+        """Clear - Drops every entry. Results read before the call are
+        not cached afterwards either.
+        """
+        self.tick += 1
+        self.forgotten = self.tick
+        self.invalidations += len(self.entries)
+        for key in list(self.entries):
+            self._Drop(key)
+
+    def Stats(self):
+        """Stats - Returns hit, miss and eviction counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "Entries": len(self.entries),
+            "Bytes": self.bytes,
+            "MaxBytes": self.max_bytes,
+            "TTL": self.ttl,
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "HitRatio": self.hits / lookups if lookups else 0,
+            "Evictions": self.evictions,
+            "Expirations": self.expirations,
+            "Invalidations": self.invalidations,
+        }
@@ -0,0 +1,48 @@
+"""drivers/database/counters.py
+
+Repair of denormalized counters.
+
+Post.CommentCount, Sub.PostCount and Sub.Subscribers are kept up to date
+in the same write that creates or deletes what they count, so feed cards
+and sub pages never count relationships at read time. Bulk deletes (e.g.
+DeleteUser) and writes made before the counters existed leave them off;
+RepairCounters recomputes them from the graph in small batches.
+"""
+import json
+import logging
+
+LOGGER = logging.getLogger("violethawk.database")
+
+# (Query, Label) of every counter repair, run in this order
+REPAIRS = [
+    ("RepairPostCounters", "Post"),
+    ("RepairSubCounters", "Sub"),
+]
+
+
+async def RepairCounters(db, batch_size: int = 500):
+    """RepairCounters - Recomputes every counter, batch_size nodes per
+    write transaction, and returns the number checked and repaired per
+    label.
+        db: Database - settings.DB
+
+        Usage:
+            summary = await RepairCounters(settings.DB)
+    """
+    summary = {}
+    for query, label in REPAIRS:
+        after, checked, repaired = None, 0, 0
+        while True:
+            res = (await db.Write(query, {"after": after,
+                                          "limit": batch_size}))[0]
+            checked += res["checked"]
+            repaired += res["repaired"]
+            if res["checked"] < batch_size:
+                break
+            after = res["last"]
+        summary[label] = {"Checked": checked, "Repaired": repaired}
+    # Cached posts and subs still carry the old counts
+    if db.cache is not None and any(s["Repaired"] for s in summary.values()):
+        db.cache.Clear()
+    LOGGER.info(json.dumps({"Event": "CounterRepair", "Summary": summary}))
+    return summary
@@ -0,0 +1,343 @@
+"""drivers/database/database.py
+
+VioletHawk asynchronous Neo4j data-access layer.
+
+All database access goes through a Database instance (settings.DB) so that
+handlers never block the event loop while waiting on a round trip.
+"""
+import time
+import inspect
+from collections import OrderedDict
+from neo4j import AsyncGraphDatabase, READ_ACCESS, WRITE_ACCESS
+from drivers.database.queries import QUERIES
+from drivers.database.metrics import QueryMetrics
+from drivers.database.cache import QueryCache
+
+# Routing modes
+ROUTING_CLUSTER = "cluster"  # Reads go to followers/read replicas
+ROUTING_LEADER = "leader"    # Every transaction goes to the leader
+
+
+async def _RunQuery(tx, name: str, parameters: dict,
+                    metrics: QueryMetrics, profile: bool = False):
+    """_RunQuery - Runs a named query inside a transaction, records its
+    timings and returns the records as a list of dictionaries.
+    """
+    query = QUERIES.queries[name]
+    start = time.perf_counter()
+    try:
+        result = await tx.run("PROFILE " + query if profile else query,
+                              parameters)
+        ready = time.perf_counter()
+        records = await result.data()
+        done = time.perf_counter()
+        if profile:
+            summary = await result.consume()
+            metrics.Profile(name, summary.profile)
+    except Exception as e:
+        metrics.RecordError(name, e)
+        raise
+    metrics.Record(name, latency=(done - start) * 1000, rows=len(records),
+                   consume=(done - ready) * 1000)
+    return records
+
+
+async def _RunCallbacks(callbacks: list):
+    for callback in callbacks:
+        result = callback()
+        if inspect.isawaitable(result):
+            await result
+
+
+class BookmarkStore:
+    """BookmarkStore keeps the newest causal-consistency bookmarks for each
+    user, so a user's next request waits until whichever cluster member
+    serves it has caught up with their own writes.
+
+    Bookmarks are held in process memory and the least recently written
+    users are dropped once max_size is reached; a dropped user simply
+    reads without a bookmark.
+
+        max_size: int - Maximum number of users tracked
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.bookmarks = OrderedDict()
+
+    def Get(self, uid: str):
+        """Get - Returns the stored bookmarks for a user, or None.
+        """
+        return self.bookmarks.get(uid)
+
+    def Update(self, uid: str, bookmarks):
+        """Update - Replaces a user's bookmarks with newer ones.
+        """
+        self.bookmarks[uid] = bookmarks
+        self.bookmarks.move_to_end(uid)
+        while len(self.bookmarks) > self.max_size:
+            self.bookmarks.popitem(last=False)
+
+
+class UnitOfWork:
+    """UnitOfWork holds a single, lazily opened session for one request.
+
+    Reads are grouped into one explicit read transaction. The first write
+    commits that transaction and opens a write transaction, which also
+    serves every later read so the request sees its own changes. Commit()
+    then makes every write visible at once; Rollback() discards them.
+
+    With cluster routing, read transactions run in a READ session that
+    the driver routes to a follower or read replica, and writes run in a
+    WRITE session on the leader. Once Bind() has named the current user,
+    every session starts from that user's stored bookmarks and a
+    committed write stores the new ones.
+
+    With a QueryCache, reads are served from it until the first write;
+    after that the request reads its own changes from the database.
+    Invalidate() drops cached results once the writes have committed.
+
+    A UnitOfWork must not be shared between concurrently running tasks.
+
+        Usage:
+            db = settings.DB.Session()
+            try:
+                user = await db.Read("GetUser", {"uid": uid})
+                await db.Write("UpdateUser", {"uid": uid, "attributes": {}})
+                await db.Commit()
+            finally:
+                await db.Close()
+    """
+
+    def __init__(self, db: "Database"):
+        self.db = db
+        self.session = None
+        self.tx = None
+        self.writing = False
+        self.uid = None
+        self.bookmarks = None
+        self.profile = db.metrics.Sample()
+        self.callbacks = []
+        self.rollbacks = []
+
+    def Bind(self, uid: str):
+        """Bind - Ties the unit of work to a user for causal consistency.
+        Must be called before the first query to take effect on reads.
+        """
+        self.uid = uid
+        if self.session is None:
+            self.bookmarks = self.db.bookmarks.Get(uid)
+
+    def AfterCommit(self, callback):
+        """AfterCommit - Registers a callable to run once this unit of
+        work has committed. Nothing runs if it is rolled back. A callable
+        returning an awaitable is awaited.
+        """
+        self.callbacks.append(callback)
+
+    def AfterRollback(self, callback):
+        """AfterRollback - Registers a callable to run if this unit of
+        work is rolled back, or closed without committing, e.g. to clean
+        up what was stored outside the database. Nothing runs once it has
+        committed.
+        """
+        self.rollbacks.append(callback)
+
+    def Invalidate(self, *tags: str):
+        """Invalidate - Drops cached results with any of the tags once
+        this unit of work has committed.
+            Usage:
+                db.Invalidate(f"sub:{title}", "subs")
+        """
+        if self.db.cache is not None:
+            self.AfterCommit(lambda: self.db.cache.Invalidate(*tags))
+
+    async def _Begin(self, writing: bool):
+        if self.session is not None and self.db.routing == ROUTING_CLUSTER:
+            # Access mode is fixed per session, continue from the
+            # read session's bookmarks on the leader
+            self.bookmarks = await self.session.last_bookmarks()
+            await self.session.close()
+            self.session = None
+        if self.session is None:
+            mode = WRITE_ACCESS
+            if not writing and self.db.routing == ROUTING_CLUSTER:
+                mode = READ_ACCESS
+            self.session = self.db.driver.session(
+                database=self.db.database,
+                default_access_mode=mode,
+                bookmarks=self.bookmarks)
+        self.tx = await self.session.begin_transaction()
+        self.writing = writing
+
+    async def Read(self, name: str, parameters: dict = None):
+        """Read - Runs a named query in the current transaction, opening a
+        read transaction if none is open yet.
+        """
+        cache = None if self.writing else self.db.cache
+        if cache is not None:
+            tick = cache.Tick()
+            records = cache.Get(name, parameters)
+            if records is not None:
+                return records
+        if self.tx is None:
+            await self._Begin(writing=False)
+        QUERIES.Get(name)
+        records = await _RunQuery(self.tx, name, parameters or {},
+                                  self.db.metrics, self.profile)
+        if cache is not None:
+            cache.Put(name, parameters, records, tick)
+        return records
+
+    async def Write(self, name: str, parameters: dict = None):
+        """Write - Runs a named query in the request's write transaction.
+        """
+        if not self.writing:
+            if self.tx is not None:
+                # Nothing to keep from the read transaction
+                await self.tx.commit()
+            await self._Begin(writing=True)
+        QUERIES.Get(name)
+        return await _RunQuery(self.tx, name, parameters or {},
+                               self.db.metrics, self.profile)
+
+    async def Commit(self):
+        """Commit - Commits the open transaction, if any. A transaction
+        that fails to commit is dropped; Close() then runs the
+        AfterRollback callbacks.
+        """
+        if self.tx is not None:
+            tx, self.tx = self.tx, None
+            await tx.commit()
+            if self.writing and self.uid:
+                self.db.bookmarks.Update(self.uid,
+                                         await self.session.last_bookmarks())
+        self.writing = False
+        self.rollbacks = []
+        callbacks, self.callbacks = self.callbacks, []
+        await _RunCallbacks(callbacks)
+
+    async def Rollback(self):
+        """Rollback - Discards the open transaction, if any.
+        """
+        if self.tx is not None:
+            await self.tx.rollback()
+            self.tx = None
+        self.writing = False
+        self.callbacks = []
+        rollbacks, self.rollbacks = self.rollbacks, []
+        await _RunCallbacks(rollbacks)
+
+    async def Close(self):
+        """Close - Rolls back anything uncommitted and returns the
+        session's connection to the pool.
+        """
+        await self.Rollback()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class Database:
+    """Database wraps the neo4j AsyncDriver and its connection pool.
+
+        url: str - Bolt/Neo4j connection URL
+        user: str - Database user
+        password: str - Database password
+        database: Optional[str] - Database name, None for the server default
+        max_pool_size: int - Maximum connections held by the pool
+        acquisition_timeout: float - Seconds to wait for a free connection
+        max_connection_lifetime: float - Seconds before a connection is recycled
+        max_retry_time: float - Seconds a managed transaction may be retried
+        routing: str - ROUTING_CLUSTER or ROUTING_LEADER
+        bookmark_cache_size: int - Users tracked by the BookmarkStore
+        profile_sample_rate: float - Fraction of requests run with PROFILE
+        slow_query_ms: float - Latency above which a query is logged as slow
+        cache: Optional[QueryCache] - Result cache used by UnitOfWork reads
+
+        Usage:
+            records = await settings.DB.Read("GetUser", {"uid": uid})
+    """
+
+    def __init__(self, url: str, user: str, password: str,
+                 database: str = None,
+                 max_pool_size: int = 100,
+                 acquisition_timeout: float = 60.0,
+                 max_connection_lifetime: float = 3600.0,
+                 max_retry_time: float = 30.0,
+                 routing: str = ROUTING_CLUSTER,
+                 bookmark_cache_size: int = 10000,
+                 profile_sample_rate: float = 0.0,
+                 slow_query_ms: float = 250,
+                 cache: QueryCache = None):
+        if routing not in (ROUTING_CLUSTER, ROUTING_LEADER):
+            raise ValueError(f"Unknown routing mode {routing}.")
+        self.name = "NEO4J DRIVER"
+        self.database = database
+        self.routing = routing
+        self.bookmarks = BookmarkStore(bookmark_cache_size)
+        self.metrics = QueryMetrics(profile_sample_rate, slow_query_ms)
+        self.cache = cache
+        self.driver = AsyncGraphDatabase.driver(
+            url,
+            auth=(user, password),
+            max_connection_pool_size=max_pool_size,
+            connection_acquisition_timeout=acquisition_timeout,
+            max_connection_lifetime=max_connection_lifetime,
+            max_transaction_retry_time=max_retry_time,
+        )
+
+    async def Read(self, name: str, parameters: dict = None):
+        """Read - Runs a named read-only query in a managed (retried)
+        transaction.
+            name: str - Query name in drivers.database.queries
+            parameters: dict - Query parameters
+
+            Usage:
+                res = await settings.DB.Read("GetUser", {"uid": uid})
+        """
+        QUERIES.Get(name)
+        profile = self.metrics.Sample()
+        async with self.driver.session(database=self.database) as session:
+            if self.routing == ROUTING_LEADER:
+                return await session.execute_write(_RunQuery, name,
+                                                   parameters or {},
+                                                   self.metrics, profile)
+            return await session.execute_read(_RunQuery, name,
+                                              parameters or {},
+                                              self.metrics, profile)
+
+    async def Write(self, name: str, parameters: dict = None):
+        """Write - Runs a named mutating query in a managed (retried)
+        transaction.
+            name: str - Query name in drivers.database.queries
+            parameters: dict - Query parameters
+
+            Usage:
+                res = await settings.DB.Write("CreateSub", {"uid": uid,
+                                                            "params": attributes})
+        """
+        QUERIES.Get(name)
+        profile = self.metrics.Sample()
+        async with self.driver.session(database=self.database) as session:
+            return await session.execute_write(_RunQuery, name,
+                                               parameters or {},
+                                               self.metrics, profile)
+
+    def Session(self):
+        """Session - Returns a new UnitOfWork on this database.
+        """
+        return UnitOfWork(self)
+
+    async def RunSchema(self, statement: str):
+        """RunSchema - Runs a schema (DDL) statement in its own
+        auto-commit transaction. Used by drivers.database.schema only.
+        """
+        async with self.driver.session(database=self.database) as session:
+            result = await session.run(statement)
+            await result.consume()
+
+    async def Close(self):
+        """Close - Closes every pooled connection.
+        """
+        await self.driver.close()
@@ -0,0 +1,1119 @@
+"""drivers/database/memory.py
+
+In-process graph backend that stands in for Neo4j.
+
+MemoryDatabase implements the same interface as Database, but instead of
+sending Cypher to a server it runs a Python handler registered under the
+same query name. Nodes live in dictionaries with hash indexes on the keys
+the application looks up, so tests and benchmarks can exercise every
+request path without any external service.
+
+Select it with DATABASE_BACKEND = "memory".
+"""
+import time
+import inspect
+from collections import defaultdict
+from drivers.database.queries import QUERIES, POST_LIST_ORDERS
+from drivers.database.metrics import QueryMetrics
+from drivers.database.cache import QueryCache
+
+# Properties kept in a hash index per label
+INDEXED = {
+    "User": ("UUID", "Email"),
+    "Sub": ("Title",),
+    "Post": ("UUID", "Title", "Owner"),
+    "Comment": ("UUID", "Creator"),
+    "File": ("UUID", "Filename", "Creator"),
+    "Timeline": ("User",),
+    "RefreshToken": ("Hash", "Family", "User"),
+    "Blob": ("Hash",),
+    "SchemaMigration": ("Version",),
+}
+
+
+def _Copy(props: dict):
+    """_Copy - Returns a copy of a property map, the way a driver
+    would hand back a fresh record.
+    """
+    return {k: list(v) if isinstance(v, list) else v for k, v in props.items()}
+
+
+class MemoryGraph:
+    """MemoryGraph is a dict/index-backed labelled property graph.
+
+    Every node has exactly one label. Relationships are typed and stored
+    in adjacency sets in both directions.
+
+    While journal is a list, every mutation appends a callable that
+    undoes it, so a unit of work can roll its writes back.
+    """
+
+    def __init__(self):
+        self.nextId = 0
+        self.nodes = {}                     # id -> properties
+        self.labels = {}                    # id -> label
+        self.byLabel = defaultdict(dict)    # label -> {id: None}, insertion ordered
+        self.indexes = defaultdict(lambda: defaultdict(set))  # (label, prop) -> value -> ids
+        self.out = defaultdict(lambda: defaultdict(set))  # id -> type -> target ids
+        self.inc = defaultdict(lambda: defaultdict(set))  # id -> type -> source ids
+        self.journal = None                 # undo callables, see MemoryUnitOfWork
+
+    # Nodes
+
+    def _Index(self, nid: int, props: dict, add: bool = True):
+        label = self.labels[nid]
+        for prop in INDEXED.get(label, ()):
+            value = props.get(prop)
+            if value is None or isinstance(value, list):
+                continue
+            ids = self.indexes[(label, prop)][value]
+            if add:
+                ids.add(nid)
+            else:
+                ids.discard(nid)
+
+    def Create(self, label: str, props: dict):
+        """Create - Creates a node and returns its id.
+        """
+        nid = self.nextId
+        self.nextId += 1
+        self.labels[nid] = label
+        self.nodes[nid] = {k: v for k, v in props.items() if v is not None}
+        self.byLabel[label][nid] = None
+        self._Index(nid, self.nodes[nid])
+        if self.journal is not None:
+            self.journal.append(lambda: self.Delete(nid))
+        return nid
+
+    def Set(self, nid: int, props: dict):
+        """Set - Merges properties into a node (SET n += props).
+        None values remove the property.
+        """
+        node = self.nodes[nid]
+        if self.journal is not None:
+            old = {key: node.get(key) for key in props}
+            self.journal.append(lambda: self.Set(nid, old))
+        self._Index(nid, node, add=False)
+        for key, value in props.items():
+            if value is None:
+                node.pop(key, None)
+            else:
+                node[key] = value
+        self._Index(nid, node)
+
+    def Delete(self, nid: int):
+        """Delete - Removes a node and every relationship touching it
+        (DETACH DELETE).
+        """
+        if self.journal is not None:
+            label, props = self.labels[nid], self.nodes[nid]
+            out = [(rtype, set(targets)) for rtype, targets in self.out[nid].items()]
+            inc = [(rtype, set(sources)) for rtype, sources in self.inc[nid].items()]
+            self.journal.append(lambda: self._Restore(nid, label, props, out, inc))
+        for rtype, targets in self.out.pop(nid, {}).items():
+            for target in targets:
+                self.inc[target][rtype].discard(nid)
+        for rtype, sources in self.inc.pop(nid, {}).items():
+            for source in sources:
+                self.out[source][rtype].discard(nid)
+        self._Index(nid, self.nodes[nid], add=False)
+        del self.byLabel[self.labels[nid]][nid]
+        del self.nodes[nid]
+        del self.labels[nid]
+
+    def _Restore(self, nid: int, label: str, props: dict, out: list, inc: list):
+        """_Restore - Undoes Delete: recreates a node under its old id
+        with its relationships.
+        """
+        self.labels[nid] = label
+        self.nodes[nid] = props
+        # Back into creation order
+        self.byLabel[label][nid] = None
+        self.byLabel[label] = dict.fromkeys(sorted(self.byLabel[label]))
+        self._Index(nid, props)
+        for rtype, targets in out:
+            for target in targets & self.nodes.keys():
+                self.Relate(nid, rtype, target)
+        for rtype, sources in inc:
+            for source in sources & self.nodes.keys():
+                self.Relate(source, rtype, nid)
+
+    def Find(self, label: str, prop: str, value):
+        """Find - Returns the ids of nodes with label where prop = value.
+        """
+        if prop in INDEXED.get(label, ()):
+            return sorted(self.indexes[(label, prop)].get(value, ()))
+        return [nid for nid in self.byLabel[label]
+                if self.nodes[nid].get(prop) == value]
+
+    def One(self, label: str, prop: str, value):
+        """One - Returns the first matching node id, or None.
+        """
+        ids = self.Find(label, prop, value)
+        return ids[0] if ids else None
+
+    def All(self, label: str):
+        """All - Returns every node id with a label, in creation order.
+        """
+        return list(self.byLabel[label])
+
+    def Props(self, nid: int):
+        """Props - Returns a copy of a node's properties.
+        """
+        return _Copy(self.nodes[nid])
+
+    # Relationships
+
+    def Relate(self, source: int, rtype: str, target: int):
+        """Relate - Creates (source)-[:rtype]->(target).
+        """
+        if self.journal is not None and not self.Related(source, rtype, target):
+            self.journal.append(lambda: self.Unrelate(source, rtype, target))
+        self.out[source][rtype].add(target)
+        self.inc[target][rtype].add(source)
+
+    def Unrelate(self, source: int, rtype: str, target: int):
+        """Unrelate - Deletes (source)-[:rtype]->(target).
+        """
+        if self.journal is not None and self.Related(source, rtype, target):
+            self.journal.append(lambda: self.Relate(source, rtype, target))
+        self.out[source][rtype].discard(target)
+        self.inc[target][rtype].discard(source)
+
+    def Related(self, source: int, rtype: str, target: int):
+        """Related - Whether (source)-[:rtype]->(target) exists.
+        """
+        return source in self.out and target in self.out[source].get(rtype, ())
+
+    def Outgoing(self, nid: int, rtype: str):
+        if nid not in self.out:
+            return []
+        return sorted(self.out[nid].get(rtype, ()))
+
+    def Incoming(self, nid: int, rtype: str):
+        if nid not in self.inc:
+            return []
+        return sorted(self.inc[nid].get(rtype, ()))
+
+    def Types(self, source: int, target: int):
+        """Types - Returns every relationship type from source to target.
+        """
+        if source not in self.out:
+            return []
+        return sorted(rtype for rtype, targets in self.out[source].items()
+                      if target in targets)
+
+    def Relationship(self, source: int, rtype: str, target: int):
+        """Relationship - Serializes a relationship the way
+        neo4j's Result.data() does: (start, type, end).
+        """
+        return (self.Props(source), rtype, self.Props(target))
+
+
+# Query handlers, keyed by the same names as drivers.database.queries
+
+HANDLERS = {}
+
+
+def Handler(name: str):
+    """Handler - Registers the in-memory implementation of a named query.
+    """
+    def register(func):
+        if name not in QUERIES.queries:
+            raise KeyError(f"Query {name} is not registered.")
+        HANDLERS[name] = func
+        return func
+    return register
+
+
+def _Target(g: MemoryGraph, uid: str):
+    """Returns the Post or Comment with a UUID."""
+    nid = g.One("Post", "UUID", uid)
+    if nid is None:
+        nid = g.One("Comment", "UUID", uid)
+    return nid
+
+
+def _Attach(g: MemoryGraph, nid: int, files: list):
+    for fileUUID in files or []:
+        fid = g.One("File", "UUID", fileUUID)
+        if fid is not None:
+            g.Relate(nid, "ATTACHES", fid)
+
+
+def _Vote(g: MemoryGraph, label: str, uid: str, target: str, vote: int,
+          toggle: bool, counters: bool = True):
+    user = g.One("User", "UUID", uid)
+    node = g.One(label, "UUID", target)
+    if user is None or node is None or g.nodes[node].get("Published") is not True:
+        return []
+    previous = 0
+    if g.Related(user, "LIKES", node):
+        previous = 1
+    elif g.Related(user, "DISLIKES", node):
+        previous = -1
+    if toggle and previous == vote:
+        vote = 0
+    if vote != previous:
+        g.Unrelate(user, "LIKES", node)
+        g.Unrelate(user, "DISLIKES", node)
+        if vote:
+            g.Relate(user, "LIKES" if vote == 1 else "DISLIKES", node)
+    if counters:
+        _AddVotes(g, node, vote - previous, (vote == 1) - (previous == 1),
+                  (vote == -1) - (previous == -1))
+    return [{"target": g.Props(node), "previous": previous, "vote": vote}]
+
+
+def _Timestamp():
+    """Cypher's timestamp(): milliseconds since the epoch."""
+    return int(time.time() * 1000)
+
+
+def _AddVotes(g: MemoryGraph, nid: int, votes: int, likes: int, dislikes: int):
+    props = g.nodes[nid]
+    g.Set(nid, {
+        "Votes": props.get("Votes", 0) + votes,
+        "Likes": props.get("Likes", 0) + likes,
+        "Dislikes": props.get("Dislikes", 0) + dislikes,
+        "RankedAt": _Timestamp(),
+    })
+
+
+def _ApplyVoteDeltas(g: MemoryGraph, label: str, deltas: list):
+    applied = 0
+    for delta in deltas:
+        nid = g.One(label, "UUID", delta["uuid"])
+        if nid is not None:
+            _AddVotes(g, nid, delta["votes"], delta["likes"], delta["dislikes"])
+            applied += 1
+    return [{"applied": applied}]
+
+
+def _Count(g: MemoryGraph, nid: int, prop: str, delta: int):
+    g.Set(nid, {prop: g.nodes[nid].get(prop, 0) + delta})
+
+
+def _RootPost(g: MemoryGraph, nid: int):
+    """Returns the post a comment is on, following replies up."""
+    while nid is not None and g.labels[nid] != "Post":
+        parents = g.Outgoing(nid, "ON")
+        nid = parents[0] if parents else None
+    return nid
+
+
+def _Replies(g: MemoryGraph, nid: int):
+    """Returns every comment below nid, at any depth."""
+    out, level = [], [nid]
+    while level:
+        level = [n for parent in level for n in g.Incoming(parent, "ON")
+                 if g.labels[n] == "Comment"]
+        out.extend(level)
+    return out
+
+
+def _Keyset(g: MemoryGraph, nodes: list, prop: str, tie: str, after,
+            afterTie, limit: int):
+    """_Keyset - Sorts nodes by (prop, tie), skips everything up to and
+    including (after, afterTie) and returns the next limit nodes.
+    """
+    keyed = sorted((g.nodes[n].get(prop), g.nodes[n].get(tie), n)
+                   for n in nodes if g.nodes[n].get(prop) is not None)
+    if after is not None:
+        keyed = [k for k in keyed if (k[0], k[1]) > (after, afterTie)]
+    return [n for _, _, n in keyed[:limit]]
+
+
+# Users
+
+@Handler("GetUser")
+def _GetUser(g, uid):
+    return [{"user": g.Props(n)} for n in g.Find("User", "UUID", uid)]
+
+
+@Handler("GetUserByEmail")
+def _GetUserByEmail(g, email):
+    return [{"user": g.Props(n)} for n in g.Find("User", "Email", email)]
+
+
+@Handler("CreateUser")
+def _CreateUser(g, params):
+    return [{"user": g.Props(g.Create("User", params))}]
+
+
+@Handler("UpdateUser")
+def _UpdateUser(g, uid, attributes):
+    out = []
+    for n in g.Find("User", "UUID", uid):
+        g.Set(n, attributes)
+        g.Set(n, {"SecurityVersion": g.nodes[n].get("SecurityVersion", 0) + 1})
+        out.append({"user": g.Props(n)})
+    return out
+
+
+@Handler("DeleteUser")
+def _DeleteUser(g, uid):
+    user = g.One("User", "UUID", uid)
+    if user is None:
+        return []
+    files = [g.Props(n) for n in g.Find("File", "Creator", uid)]
+    for n in g.Find("Comment", "Creator", uid) + g.Find("Post", "Owner", uid):
+        g.Delete(n)
+    g.Delete(user)
+    return [{"file": f} for f in files]
+
+
+@Handler("BlockUser")
+def _BlockUser(g, uid, blocked):
+    user = g.One("User", "UUID", uid)
+    other = g.One("User", "UUID", blocked)
+    if user is None or other is None:
+        return []
+    g.Set(user, {"Blocked": g.nodes[user].get("Blocked", []) + [blocked],
+                 "SecurityVersion": g.nodes[user].get("SecurityVersion", 0) + 1})
+    g.Relate(user, "BLOCKED", other)
+    return [{"user": g.Props(user)}]
+
+
+# Refresh tokens
+
+@Handler("CreateRefreshToken")
+def _CreateRefreshToken(g, params, now):
+    for n in g.Find("RefreshToken", "User", params["User"]):
+        if g.nodes[n]["Expires"] < now:
+            g.Delete(n)
+    return [{"token": g.Props(g.Create("RefreshToken", params))}]
+
+
+@Handler("RotateRefreshToken")
+def _RotateRefreshToken(g, hash, params, now, since):
+    token = g.One("RefreshToken", "Hash", hash)
+    if token is None:
+        return []
+    props = g.nodes[token]
+    revoked = props.get("Revoked")
+    valid = revoked is None and props["Expires"] > now
+    rotated = props.get("ReplacedBy") is not None
+    raced = rotated and revoked > since
+    if revoked is None:
+        g.Set(token, {"Revoked": now})
+    if valid:
+        g.Set(token, {"ReplacedBy": params["Hash"]})
+        g.Create("RefreshToken", dict(params, User=props["User"],
+                                      Family=props["Family"]))
+    return [{"user": props["User"], "valid": valid, "rotated": rotated,
+             "raced": raced}]
+
+
+@Handler("RevokeRefreshFamily")
+def _RevokeRefreshFamily(g, hash, now):
+    token = g.One("RefreshToken", "Hash", hash)
+    if token is None:
+        return []
+    revoked = 0
+    for n in g.Find("RefreshToken", "Family", g.nodes[token]["Family"]):
+        if g.nodes[n].get("Revoked") is None:
+            g.Set(n, {"Revoked": now})
+            revoked += 1
+    return [{"revoked": revoked}]
+
+
+@Handler("RevokeUserRefreshTokens")
+def _RevokeUserRefreshTokens(g, uid, now):
+    revoked = 0
+    for n in g.Find("RefreshToken", "User", uid):
+        if g.nodes[n].get("Revoked") is None:
+            g.Set(n, {"Revoked": now})
+            revoked += 1
+    return [{"revoked": revoked}]
+
+
+# Subs
+
+@Handler("GetSub")
+def _GetSub(g, title):
+    return [{"v": g.Props(n)} for n in g.Find("Sub", "Title", title)]
+
+
+@Handler("CreateSub")
+def _CreateSub(g, uid, params):
+    user = g.One("User", "UUID", uid)
+    if user is None:
+        return []
+    sub = g.Create("Sub", params)
+    g.Relate(user, "OWNS", sub)
+    g.Relate(user, "SUBSCRIBES", sub)
+    g.Set(sub, {"Subscribers": 1, "PostCount": 0})
+    return [{"v": g.Props(sub)}]
+
+
+@Handler("ListSubs")
+def _ListSubs(g, after, limit):
+    return [{"v": g.Props(n)} for n in
+            _Keyset(g, g.All("Sub"), "Title", "Title", after, after, limit)]
+
+
+@Handler("GetSubRelationship")
+def _GetSubRelationship(g, uid, title):
+    user = g.One("User", "UUID", uid)
+    sub = g.One("Sub", "Title", title)
+    if user is None or sub is None:
+        return []
+    return [{"relationship": g.Relationship(user, rtype, sub)}
+            for rtype in g.Types(user, sub)]
+
+
+@Handler("UpdateSub")
+def _UpdateSub(g, title, attributes, modifier, date):
+    out = []
+    for n in g.Find("Sub", "Title", title):
+        g.Set(n, attributes)
+        g.Set(n, {"Modifier": modifier, "ModifiedDate": date})
+        out.append({"v": g.Props(n)})
+    return out
+
+
+@Handler("DeleteSub")
+def _DeleteSub(g, title):
+    for n in g.Find("Sub", "Title", title):
+        g.Delete(n)
+    return []
+
+
+# Subscriptions
+
+@Handler("SubscribeSub")
+def _SubscribeSub(g, uid, title, date):
+    user = g.One("User", "UUID", uid)
+    sub = g.One("Sub", "Title", title)
+    if user is None or sub is None:
+        return []
+    subscribed = not g.Related(user, "SUBSCRIBES", sub)
+    if subscribed:
+        g.Relate(user, "SUBSCRIBES", sub)
+        g.Set(sub, {"Subscribers": g.nodes[sub].get("Subscribers", 0) + 1})
+    return [{"v": g.Props(sub), "subscribed": subscribed}]
+
+
+@Handler("UnsubscribeSub")
+def _UnsubscribeSub(g, uid, title):
+    user = g.One("User", "UUID", uid)
+    sub = g.One("Sub", "Title", title)
+    if user is None or sub is None:
+        return []
+    unsubscribed = g.Related(user, "SUBSCRIBES", sub)
+    if unsubscribed:
+        g.Unrelate(user, "SUBSCRIBES", sub)
+        g.Set(sub, {"Subscribers": g.nodes[sub].get("Subscribers", 1) - 1})
+    t = g.One("Timeline", "User", uid)
+    if t is not None:
+        props = g.nodes[t]
+        keep = [i for i, each in enumerate(props.get("Subs", []))
+                if each != title]
+        g.Set(t, {key: [props[key][i] for i in keep]
+                  for key in ("Posts", "Times", "Subs")})
+    return [{"v": g.Props(sub), "unsubscribed": unsubscribed}]
+
+
+# Timelines
+
+def _PushTimeline(g: MemoryGraph, uid: str, entries: list, size: int):
+    t = g.One("Timeline", "User", uid)
+    if t is None:
+        t = g.Create("Timeline", {"User": uid})
+    props = g.nodes[t]
+    rows = set(zip(props.get("Posts", []), props.get("Times", []),
+                   props.get("Subs", [])))
+    rows.update((e["post"], e["time"], e["sub"]) for e in entries)
+    rows = sorted(rows, key=lambda row: (-row[1], row[0]))[:size]
+    g.Set(t, {"Posts": [row[0] for row in rows],
+              "Times": [row[1] for row in rows],
+              "Subs": [row[2] for row in rows]})
+
+
+@Handler("PushTimeline")
+def _PushTimelineHandler(g, uid, entries, size):
+    if g.One("User", "UUID", uid) is None:
+        return [{"timelines": 0}]
+    _PushTimeline(g, uid, entries, size)
+    return [{"timelines": 1}]
+
+
+@Handler("FanOutPost")
+def _FanOutPost(g, title, entries, size, fanoutLimit):
+    sub = g.One("Sub", "Title", title)
+    if sub is None or g.nodes[sub].get("Subscribers", 0) > fanoutLimit:
+        return [{"timelines": 0}]
+    users = g.Incoming(sub, "SUBSCRIBES")
+    for user in users:
+        _PushTimeline(g, g.nodes[user]["UUID"], entries, size)
+    return [{"timelines": len(users)}]
+
+
+@Handler("GetTimeline")
+def _GetTimeline(g, uid, fanoutLimit):
+    user = g.One("User", "UUID", uid)
+    if user is None:
+        return []
+    t = g.One("Timeline", "User", uid)
+    props = g.Props(t) if t is not None else {}
+    large = [g.nodes[n]["Title"] for n in g.Outgoing(user, "SUBSCRIBES")
+             if g.nodes[n].get("Subscribers", 0) > fanoutLimit]
+    return [{"posts": props.get("Posts", []), "times": props.get("Times", []),
+             "subs": props.get("Subs", []), "large": large}]
+
+
+# Posts
+
+def _Visible(props: dict, published, owner):
+    return ((published is None or props.get("Published") == published)
+            and (owner is None or props.get("Owner") == owner))
+
+
+@Handler("GetPost")
+def _GetPost(g, uid, published, owner):
+    return [{"post": g.Props(n)} for n in g.Find("Post", "UUID", uid)
+            if _Visible(g.nodes[n], published, owner)]
+
+
+@Handler("GetPostByTitle")
+def _GetPostByTitle(g, title, published, owner):
+    return [{"post": g.Props(n)} for n in g.Find("Post", "Title", title)
+            if _Visible(g.nodes[n], published, owner)]
+
+
+def _Ranking(props: dict):
+    return {key: props.get(key) for key in (
+        "UUID", "CreatedDate", "Votes", "Likes", "Dislikes", "Published",
+        "RankedAt")}
+
+
+@Handler("GetPostRankings")
+def _GetPostRankings(g, title):
+    sub = g.One("Sub", "Title", title)
+    if sub is None:
+        return []
+    return [{"post": _Ranking(g.nodes[n])} for n in g.Incoming(sub, "ON")
+            if g.nodes[n].get("Published") is True]
+
+
+@Handler("GetPostRankingChanges")
+def _GetPostRankingChanges(g, title, since):
+    sub = g.One("Sub", "Title", title)
+    if sub is None:
+        return []
+    return [{"post": _Ranking(g.nodes[n])} for n in g.Incoming(sub, "ON")
+            if (g.nodes[n].get("RankedAt") or 0) > since]
+
+
+@Handler("GetPostsByUUID")
+def _GetPostsByUUID(g, uuids):
+    return [{"post": g.Props(n)} for uid in uuids
+            for n in g.Find("Post", "UUID", uid)]
+
+
+@Handler("GetPostVoteStates")
+def _GetPostVoteStates(g, uid, uuids):
+    user = g.One("User", "UUID", uid)
+    if user is None:
+        return []
+    out = []
+    for postUUID in uuids:
+        for n in g.Find("Post", "UUID", postUUID):
+            for rtype in ("LIKES", "DISLIKES"):
+                if g.Related(user, rtype, n):
+                    out.append({"uuid": postUUID, "vote": rtype})
+    return out
+
+
+def _ListPosts(key: str, admin: bool):
+    """Returns the handler of ListPostsBy<key> or ListAllPostsBy<key>."""
+    def handler(g, after, afterUUID, limit, uid=None):
+        posts = [n for n in g.All("Post")
+                 if admin or g.nodes[n].get("Published") is True
+                 or (uid is not None and uid in (g.nodes[n].get("Owner"),
+                                                 g.nodes[n].get("Creator")))]
+        return [{"post": g.Props(n)} for n in
+                _Keyset(g, posts, key, "UUID", after, afterUUID, limit)]
+    return handler
+
+
+for key in POST_LIST_ORDERS:
+    Handler(f"ListAllPostsBy{key}")(_ListPosts(key, admin=True))
+    Handler(f"ListPostsBy{key}")(_ListPosts(key, admin=False))
+
+
+@Handler("CreatePost")
+def _CreatePost(g, uid, files, subTitle, params):
+    user = g.One("User", "UUID", uid)
+    if user is None:
+        return []
+    post = g.Create("Post", dict(params, RankedAt=_Timestamp()))
+    g.Relate(user, "OWNS", post)
+    g.Relate(user, "AUTHOR", post)
+    _Attach(g, post, files)
+    sub = g.One("Sub", "Title", subTitle) if subTitle else None
+    if sub is not None:
+        g.Relate(post, "ON", sub)
+        _Count(g, sub, "PostCount", 1)
+    return [{"post": g.Props(post)}]
+
+
+@Handler("UpdatePost")
+def _UpdatePost(g, uid, attributes, modifier, date, published):
+    out = []
+    for n in g.Find("Post", "UUID", uid):
+        g.Set(n, attributes)
+        g.Set(n, {"Modifier": modifier, "ModifiedDate": date})
+        if published is not None:
+            g.Set(n, {"Published": published})
+        if published:
+            g.Set(n, {"PublishedDate": date})
+        g.Set(n, {"RankedAt": _Timestamp()})
+        subs = g.Outgoing(n, "ON")
+        out.append({"post": g.Props(n),
+                    "sub": g.nodes[subs[0]]["Title"] if subs else None})
+    return out
+
+
+@Handler("DeletePost")
+def _DeletePost(g, uid):
+    out = []
+    for n in g.Find("Post", "UUID", uid):
+        subs = g.Outgoing(n, "ON")
+        for sub in subs:
+            _Count(g, sub, "PostCount", -1)
+        out.append({"sub": g.nodes[subs[0]]["Title"] if subs else None})
+        g.Delete(n)
+    return out
+
+
+@Handler("VotePost")
+def _VotePost(g, uid, target, vote, toggle):
+    return _Vote(g, "Post", uid, target, vote, toggle)
+
+
+@Handler("RecordPostVote")
+def _RecordPostVote(g, uid, target, vote, toggle):
+    return _Vote(g, "Post", uid, target, vote, toggle, counters=False)
+
+
+@Handler("ApplyPostVoteDeltas")
+def _ApplyPostVoteDeltas(g, deltas):
+    return _ApplyVoteDeltas(g, "Post", deltas)
+
+
+@Handler("SearchPosts")
+def _SearchPosts(g, keywords):
+    terms = (keywords or "").lower().split()
+    out = []
+    for n in g.All("Post"):
+        props = g.nodes[n]
+        text = " ".join([str(props.get("Title", "")),
+                         str(props.get("Content", ""))]
+                        + list(props.get("Keywords", []))).lower()
+        if terms and any(term in text for term in terms):
+            out.append({"node": g.Props(n)})
+    return out
+
+
+# Comments
+
+@Handler("GetComment")
+def _GetComment(g, uid):
+    out = []
+    for n in g.Find("Comment", "UUID", uid):
+        files = g.Outgoing(n, "ATTACHES")
+        if not files:
+            out.append({"comment": g.Props(n), "f": None})
+        for f in files:
+            out.append({"comment": g.Props(n), "f": g.Props(f)})
+    return out
+
+
+@Handler("CreateComment")
+def _CreateComment(g, uid, commentOn, files, params):
+    user = g.One("User", "UUID", uid)
+    target = _Target(g, commentOn)
+    if user is None or target is None:
+        return []
+    comment = g.Create("Comment", params)
+    g.Relate(user, "OWNS", comment)
+    g.Relate(comment, "ON", target)
+    _Attach(g, comment, files)
+    post = _RootPost(g, comment)
+    if post is not None:
+        _Count(g, post, "CommentCount", 1)
+    return [{"comment": g.Props(comment),
+             "post": g.nodes[post]["UUID"] if post is not None else None}]
+
+
+@Handler("ListComments")
+def _ListComments(g, uid, after, afterUUID, limit):
+    target = _Target(g, uid)
+    if target is None:
+        return []
+    comments = [n for n in g.Incoming(target, "ON")
+                if g.labels[n] == "Comment"]
+    return [{"comment": g.Props(n)} for n in
+            _Keyset(g, comments, "CreatedDate", "UUID", after, afterUUID,
+                    limit)]
+
+
+def _CommentReplies(g: MemoryGraph, parents: list, after, afterUUID,
+                    limit: int, key, descending: bool):
+    out = []
+    for parentUUID in parents:
+        parent = _Target(g, parentUUID)
+        if parent is None:
+            continue
+        replies = [n for n in g.Incoming(parent, "ON")
+                   if g.labels[n] == "Comment"]
+        comments = []
+        for n in replies:
+            props = g.nodes[n]
+            if props.get("Published", True) is not True:
+                continue
+            value = key(props)
+            if after is not None and not (
+                    (value < after if descending else value > after)
+                    or (value == after and props["UUID"] > afterUUID)):
+                continue
+            comments.append(n)
+        comments.sort(key=lambda n: g.nodes[n]["UUID"])
+        comments.sort(key=lambda n: key(g.nodes[n]), reverse=descending)
+        out.append({"parent": parentUUID,
+                    "comments": [g.Props(n) for n in comments[:limit]],
+                    "replies": len(replies)})
+    return out
+
+
+@Handler("GetCommentRepliesTop")
+def _GetCommentRepliesTop(g, parents, after, afterUUID, limit):
+    return _CommentReplies(g, parents, after, afterUUID, limit,
+                           lambda props: props.get("Votes") or 0, True)
+
+
+@Handler("GetCommentRepliesNew")
+def _GetCommentRepliesNew(g, parents, after, afterUUID, limit):
+    return _CommentReplies(g, parents, after, afterUUID, limit,
+                           lambda props: props.get("CreatedDate"), True)
+
+
+@Handler("GetCommentRepliesOld")
+def _GetCommentRepliesOld(g, parents, after, afterUUID, limit):
+    return _CommentReplies(g, parents, after, afterUUID, limit,
+                           lambda props: props.get("CreatedDate"), False)
+
+
+@Handler("UpdateComment")
+def _UpdateComment(g, uid, files, attributes):
+    out = []
+    for n in g.Find("Comment", "UUID", uid):
+        _Attach(g, n, files)
+        g.Set(n, attributes)
+        out.append({"comment": g.Props(n)})
+    return out
+
+
+@Handler("DeleteComment")
+def _DeleteComment(g, uid):
+    out = []
+    for n in g.Find("Comment", "UUID", uid):
+        post = _RootPost(g, n)
+        parents = g.Outgoing(n, "ON")
+        if post is not None:
+            _Count(g, post, "CommentCount", -1 - len(_Replies(g, n)))
+        out.append({
+            "post": g.nodes[post]["UUID"] if post is not None else None,
+            "parent": g.nodes[parents[0]]["UUID"] if parents else None})
+        g.Delete(n)
+    return out
+
+
+@Handler("VoteComment")
+def _VoteComment(g, uid, target, vote, toggle):
+    return _Vote(g, "Comment", uid, target, vote, toggle)
+
+
+@Handler("RecordCommentVote")
+def _RecordCommentVote(g, uid, target, vote, toggle):
+    return _Vote(g, "Comment", uid, target, vote, toggle, counters=False)
+
+
+@Handler("ApplyCommentVoteDeltas")
+def _ApplyCommentVoteDeltas(g, deltas):
+    return _ApplyVoteDeltas(g, "Comment", deltas)
+
+
+# Files
+
+@Handler("GetFile")
+def _GetFile(g, uid):
+    return [{"file": g.Props(n)} for n in g.Find("File", "UUID", uid)]
+
+
+@Handler("GetFileByName")
+def _GetFileByName(g, filename):
+    return [{"file": g.Props(n)} for n in g.Find("File", "Filename", filename)[:1]]
+
+
+@Handler("CreateFile")
+def _CreateFile(g, uid, params):
+    user = g.One("User", "UUID", uid)
+    if user is None:
+        return []
+    f = g.Create("File", params)
+    g.Relate(user, "OWNS", f)
+    return [{"file": g.Props(f)}]
+
+
+@Handler("ListFiles")
+def _ListFiles(g, after, limit):
+    return [{"file": g.Props(n)} for n in
+            _Keyset(g, g.All("File"), "UUID", "UUID", after, after, limit)]
+
+
+@Handler("DeleteFile")
+def _DeleteFile(g, uid):
+    for n in g.Find("File", "UUID", uid):
+        g.Delete(n)
+    return []
+
+
+@Handler("AttachBlob")
+def _AttachBlob(g, uid, hash, size):
+    f = g.One("File", "UUID", uid)
+    if f is None:
+        return []
+    blob = g.One("Blob", "Hash", hash)
+    if blob is None:
+        blob = g.Create("Blob", {"Hash": hash, "References": 0,
+                                 "SizeBytes": size})
+    g.Set(blob, {"References": g.nodes[blob]["References"] + 1})
+    g.Set(f, {"Blob": hash, "Hash": hash})
+    g.Relate(f, "CONTENT", blob)
+    return [{"file": g.Props(f), "references": g.nodes[blob]["References"]}]
+
+
+@Handler("DetachBlob")
+def _DetachBlob(g, uid):
+    f = g.One("File", "UUID", uid)
+    blobs = g.Outgoing(f, "CONTENT") if f is not None else []
+    out = []
+    for blob in blobs:
+        references = g.nodes[blob]["References"] - 1
+        hash = g.nodes[blob]["Hash"]
+        g.Unrelate(f, "CONTENT", blob)
+        g.Set(f, {"Blob": None})
+        if references <= 0:
+            g.Delete(blob)
+        else:
+            g.Set(blob, {"References": references})
+        out.append({"hash": hash, "references": references})
+    return out
+
+
+@Handler("LockBlob")
+def _LockBlob(g, hash):
+    blob = g.One("Blob", "Hash", hash)
+    if blob is None:
+        blob = g.Create("Blob", {"Hash": hash, "References": 0})
+    return [{"references": g.nodes[blob]["References"]}]
+
+
+@Handler("DeleteUnusedBlob")
+def _DeleteUnusedBlob(g, hash):
+    blob = g.One("Blob", "Hash", hash)
+    if blob is not None and g.nodes[blob]["References"] <= 0:
+        g.Delete(blob)
+    return []
+
+
+@Handler("ListFilesWithoutBlob")
+def _ListFilesWithoutBlob(g, after, limit):
+    files = [n for n in g.All("File") if g.nodes[n].get("Blob") is None]
+    return [{"file": g.Props(n)} for n in
+            _Keyset(g, files, "UUID", "UUID", after, after, limit)]
+
+
+# Counter repair
+
+def _Repaired(g: MemoryGraph, nodes: list, key: str, counts):
+    repaired = 0
+    for n in nodes:
+        values = counts(n)
+        if any(g.nodes[n].get(prop, -1) != value
+               for prop, value in values.items()):
+            repaired += 1
+        g.Set(n, values)
+    return [{"last": g.nodes[nodes[-1]][key] if nodes else None,
+             "checked": len(nodes), "repaired": repaired}]
+
+
+@Handler("RepairPostCounters")
+def _RepairPostCounters(g, after, limit):
+    posts = _Keyset(g, g.All("Post"), "UUID", "UUID", after, after, limit)
+    return _Repaired(g, posts, "UUID", lambda n: {
+        "CommentCount": len(_Replies(g, n))})
+
+
+@Handler("RepairSubCounters")
+def _RepairSubCounters(g, after, limit):
+    subs = _Keyset(g, g.All("Sub"), "Title", "Title", after, after, limit)
+    return _Repaired(g, subs, "Title", lambda n: {
+        "PostCount": len([p for p in g.Incoming(n, "ON")
+                          if g.labels[p] == "Post"]),
+        "Subscribers": len(g.Incoming(n, "SUBSCRIBES"))})
+
+
+# Schema migrations
+
+@Handler("GetSchemaMigrations")
+def _GetSchemaMigrations(g):
+    return [{"version": g.nodes[n]["Version"]} for n in g.All("SchemaMigration")]
+
+
+@Handler("RecordSchemaMigration")
+def _RecordSchemaMigration(g, version, description, date):
+    n = g.One("SchemaMigration", "Version", version)
+    if n is None:
+        n = g.Create("SchemaMigration", {"Version": version})
+    g.Set(n, {"Description": description, "AppliedDate": date})
+    return [{"m": g.Props(n)}]
+
+
+async def _RunCallbacks(callbacks: list):
+    for callback in callbacks:
+        result = callback()
+        if inspect.isawaitable(result):
+            await result
+
+
+class MemoryUnitOfWork:
+    """MemoryUnitOfWork mirrors UnitOfWork for the in-memory backend.
+
+    Handlers run synchronously, so each query is applied immediately, but
+    the graph journals every write made through Write(). Rollback() undoes
+    them newest first, so a failed request leaves the graph as it found it.
+    """
+
+    def __init__(self, db: "MemoryDatabase"):
+        self.db = db
+        self.writing = False
+        self.callbacks = []
+        self.rollbacks = []
+        self.undo = []
+
+    def Bind(self, uid: str):
+        return None
+
+    def AfterCommit(self, callback):
+        self.callbacks.append(callback)
+
+    def AfterRollback(self, callback):
+        self.rollbacks.append(callback)
+
+    def Invalidate(self, *tags: str):
+        if self.db.cache is not None:
+            self.AfterCommit(lambda: self.db.cache.Invalidate(*tags))
+
+    async def Read(self, name: str, parameters: dict = None):
+        cache = None if self.writing else self.db.cache
+        if cache is not None:
+            tick = cache.Tick()
+            records = cache.Get(name, parameters)
+            if records is not None:
+                return records
+        records = self.db._Run(name, parameters)
+        if cache is not None:
+            cache.Put(name, parameters, records, tick)
+        return records
+
+    async def Write(self, name: str, parameters: dict = None):
+        self.writing = True
+        graph = self.db.graph
+        graph.journal = self.undo
+        try:
+            return self.db._Run(name, parameters)
+        finally:
+            graph.journal = None
+
+    async def Commit(self):
+        self.writing = False
+        self.undo = []
+        self.rollbacks = []
+        callbacks, self.callbacks = self.callbacks, []
+        await _RunCallbacks(callbacks)
+
+    async def Rollback(self):
+        self.writing = False
+        self.callbacks = []
+        undo, self.undo = self.undo, []
+        for entry in reversed(undo):
+            entry()
+        if undo and self.db.cache is not None:
+            # Other requests may have cached what was just undone
+            self.db.cache.Clear()
+        rollbacks, self.rollbacks = self.rollbacks, []
+        await _RunCallbacks(rollbacks)
+
+    async def Close(self):
+        await self.Rollback()
+
+
+class MemoryDatabase:
+    """MemoryDatabase is a drop-in replacement for Database backed by a
+    MemoryGraph.
+
+        Usage:
+            DB = MemoryDatabase()
+            records = await DB.Read("GetUser", {"uid": uid})
+    """
+
+    def __init__(self, slow_query_ms: float = 250, cache: QueryCache = None):
+        missing = set(QUERIES.queries) - set(HANDLERS)
+        if missing:
+            raise NotImplementedError(
+                "No in-memory handler for: " + ", ".join(sorted(missing)))
+        self.name = "MEMORY DRIVER"
+        self.graph = MemoryGraph()
+        # There are no plans to PROFILE, timings are still recorded
+        self.metrics = QueryMetrics(0.0, slow_query_ms)
+        self.cache = cache
+
+    def _Run(self, name: str, parameters: dict = None):
+        QUERIES.Get(name)
+        start = time.perf_counter()
+        try:
+            records = HANDLERS[name](self.graph, **(parameters or {}))
+        except Exception as e:
+            self.metrics.RecordError(name, e)
+            raise
+        self.metrics.Record(name, latency=(time.perf_counter() - start) * 1000,
+                            rows=len(records), consume=0.0)
+        return records
+
+    async def Read(self, name: str, parameters: dict = None):
+        """Read - Runs the handler for a named read-only query.
+        """
+        return self._Run(name, parameters)
+
+    async def Write(self, name: str, parameters: dict = None):
+        """Write - Runs the handler for a named mutating query.
+        """
+        return self._Run(name, parameters)
+
+    def Session(self):
+        """Session - Returns a new unit of work on this database.
+        """
+        return MemoryUnitOfWork(self)
+
+    async def RunSchema(self, statement: str):
+        """RunSchema - Schema statements are a no-op; the graph keeps
+        its own hash indexes (see INDEXED).
+        """
+        return None
+
+    async def Close(self):
+        return None
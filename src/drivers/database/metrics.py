@@ -0,0 +1,162 @@
+"""drivers/database/metrics.py
+
+Per-query instrumentation for the VioletHawk data-access layer.
+
+Every named query records its latency, rows returned and the time spent
+consuming its result. A sampled fraction of requests is run with PROFILE
+so the newest plan of each query can be inspected from the admin API.
+"""
+import json
+import logging
+import random
+
+LOGGER = logging.getLogger("violethawk.database")
+
+# Histogram bucket upper bounds, in milliseconds
+BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+def _Plan(profile):
+    """_Plan - Reduces a PROFILE plan to the fields worth keeping.
+    """
+    if not profile:
+        return None
+    return {
+        "Operator": profile.get("operatorType"),
+        "Rows": profile.get("rows"),
+        "DbHits": profile.get("dbHits"),
+        "Identifiers": profile.get("identifiers"),
+        "Children": [_Plan(child) for child in profile.get("children", [])],
+    }
+
+
+class QueryStats:
+    """QueryStats accumulates the measurements of a single named query.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.latency = 0.0
+        self.consume = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def Add(self, latency: float, rows: int, consume: float):
+        self.count += 1
+        self.rows += rows
+        self.latency += latency
+        self.consume += consume
+        self.maximum = max(self.maximum, latency)
+        for i, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def Percentile(self, p: float):
+        """Percentile - Upper bucket bound holding the p-th percentile.
+        """
+        if not self.count:
+            return 0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.maximum
+        return self.maximum
+
+    def Summary(self):
+        count = self.count or 1
+        return {
+            "Count": self.count,
+            "Errors": self.errors,
+            "Rows": self.rows,
+            "MeanRows": self.rows / count,
+            "MeanMs": self.latency / count,
+            "MeanConsumeMs": self.consume / count,
+            "MaxMs": self.maximum,
+            "P50Ms": self.Percentile(0.50),
+            "P95Ms": self.Percentile(0.95),
+            "P99Ms": self.Percentile(0.99),
+            "Histogram": dict(zip([str(b) for b in BUCKETS] + ["+Inf"],
+                                  self.buckets)),
+        }
+
+
+class QueryMetrics:
+    """QueryMetrics records per-query latency histograms and PROFILE plans.
+
+        sample_rate: float - Fraction of requests run with PROFILE
+        slow_query_ms: float - Queries slower than this are logged as warnings
+
+        Usage:
+            metrics.Record("GetUser", latency=1.2, rows=1, consume=0.1)
+            worst = metrics.Snapshot()["Queries"]
+    """
+
+    def __init__(self, sample_rate: float = 0.0, slow_query_ms: float = 250):
+        self.sample_rate = sample_rate
+        self.slow_query_ms = slow_query_ms
+        self.queries = {}
+        self.profiles = {}
+
+    def _Stats(self, name: str):
+        if name not in self.queries:
+            self.queries[name] = QueryStats()
+        return self.queries[name]
+
+    def Sample(self):
+        """Sample - Decides whether the next request is profiled.
+        """
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def Record(self, name: str, latency: float, rows: int, consume: float):
+        """Record - Adds one execution of a named query.
+            latency: float - Milliseconds from sending to fully consumed
+            rows: int - Records returned
+            consume: float - Milliseconds spent fetching the records
+        """
+        self._Stats(name).Add(latency, rows, consume)
+        entry = {"Query": name, "Ms": round(latency, 3), "Rows": rows,
+                 "ConsumeMs": round(consume, 3)}
+        if latency >= self.slow_query_ms:
+            LOGGER.warning(json.dumps(dict(entry, Event="SlowQuery")))
+        elif LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(json.dumps(dict(entry, Event="Query")))
+
+    def RecordError(self, name: str, error: Exception):
+        """RecordError - Counts a failed execution of a named query.
+        """
+        self._Stats(name).errors += 1
+        LOGGER.error(json.dumps({"Event": "QueryError", "Query": name,
+                                 "Error": type(error).__name__}))
+
+    def Profile(self, name: str, profile):
+        """Profile - Keeps the newest PROFILE plan of a named query.
+        """
+        plan = _Plan(profile)
+        self.profiles[name] = plan
+        LOGGER.info(json.dumps({"Event": "QueryProfile", "Query": name,
+                                "Plan": plan}))
+
+    def Snapshot(self):
+        """Snapshot - Returns every query's summary, slowest p99 first.
+        """
+        queries = {name: stats.Summary() for name, stats in
+                   sorted(self.queries.items(),
+                          key=lambda item: item[1].Percentile(0.99),
+                          reverse=True)}
+        return {
+            "SampleRate": self.sample_rate,
+            "SlowQueryMs": self.slow_query_ms,
+            "Queries": queries,
+        }
+
+    def Reset(self):
+        """Reset - Drops every measurement and captured plan.
+        """
+        self.queries = {}
+        self.profiles = {}
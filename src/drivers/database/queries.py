@@ -0,0 +1,628 @@
+"""drivers/database/queries.py
+
+Registry of every named Cypher template used by VioletHawk.
+
+Templates are constant strings and all values are passed as parameters,
+so Neo4j plans each query once and serves every later execution from its
+query-plan cache.
+"""
+
+
+class QueryRegistry:
+    """QueryRegistry maps query names to fully parameterized Cypher templates.
+
+        Usage:
+            QUERIES.Register("GetUser", "MATCH (user:User {UUID: $uid}) RETURN user")
+            cypher = QUERIES.Get("GetUser")
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.executions = {}
+
+    def Register(self, name: str, cypher: str):
+        """Register - Adds a named template to the registry.
+            name: str - Unique query name
+            cypher: str - Parameterized Cypher text
+        """
+        if name in self.queries:
+            raise KeyError(f"Query {name} is already registered.")
+        self.queries[name] = cypher
+        self.executions[name] = 0
+
+    def Get(self, name: str):
+        """Get - Returns the template for a name and counts the execution.
+        """
+        cypher = self.queries[name]
+        self.executions[name] += 1
+        return cypher
+
+    def Stats(self):
+        """Stats - Returns execution counts per template.
+
+        Every template has a single, constant text, so each execution after
+        the first reuses a cached plan. ReuseRatio is the average number of
+        executions per planned template.
+        """
+        total = sum(self.executions.values())
+        used = len([n for n in self.executions.values() if n])
+        return {
+            "Templates": len(self.queries),
+            "Executions": total,
+            "ReuseRatio": total / used if used else 0,
+            "Queries": dict(self.executions),
+        }
+
+
+QUERIES = QueryRegistry()
+
+# Users
+
+QUERIES.Register("GetUser", """MATCH (user:User {UUID: $uid})
+RETURN user""")
+
+QUERIES.Register("GetUserByEmail", """MATCH (user:User {Email: $email})
+RETURN user""")
+
+QUERIES.Register("CreateUser", """CREATE (user:User $params)
+RETURN user""")
+
+# Any change to a user outdates the claims of its access tokens, see
+# drivers.auth.utils.ClaimsUser
+QUERIES.Register("UpdateUser", """MATCH (user:User {UUID: $uid})
+SET user += $attributes
+SET user.SecurityVersion = coalesce(user.SecurityVersion, 0) + 1
+RETURN user""")
+
+QUERIES.Register("DeleteUser", """MATCH (user:User {UUID: $uid})
+OPTIONAL MATCH (file:File {Creator: $uid})
+WITH user, collect(file) AS files
+OPTIONAL MATCH (comment:Comment {Creator: $uid})
+WITH user, files, collect(comment) AS comments
+OPTIONAL MATCH (post:Post {Owner: $uid})
+WITH user, files, comments, collect(post) AS posts
+FOREACH (n IN comments + posts | DETACH DELETE n)
+DETACH DELETE user
+WITH files
+UNWIND files AS file
+RETURN file""")
+
+QUERIES.Register("BlockUser", """MATCH (user:User {UUID: $uid})
+MATCH (blocked:User {UUID: $blocked})
+SET user.Blocked = coalesce(user.Blocked, []) + $blocked
+SET user.SecurityVersion = coalesce(user.SecurityVersion, 0) + 1
+CREATE (user)-[rel:BLOCKED]->(blocked)
+RETURN user""")
+
+# Refresh tokens
+# Only a SHA-256 digest of each token is stored. Creating a token also
+# drops the user's expired ones.
+
+QUERIES.Register("CreateRefreshToken", """CREATE (token:RefreshToken $params)
+WITH token
+OPTIONAL MATCH (old:RefreshToken {User: token.User})
+WHERE old.Expires < $now
+DETACH DELETE old
+RETURN DISTINCT token""")
+
+# The token is locked before it is checked, so a token is only ever
+# rotated once. raced is true for a token rotated after $since, i.e. by a
+# concurrent request of the same client.
+QUERIES.Register("RotateRefreshToken", """MATCH (token:RefreshToken {Hash: $hash})
+SET token._lock = true
+REMOVE token._lock
+WITH token, token.Revoked IS NULL AND token.Expires > $now AS valid,
+     token.ReplacedBy IS NOT NULL AS rotated,
+     token.ReplacedBy IS NOT NULL AND token.Revoked > $since AS raced
+SET token.Revoked = coalesce(token.Revoked, $now)
+FOREACH (_ IN CASE WHEN valid THEN [1] ELSE [] END |
+    SET token.ReplacedBy = $params.Hash
+    CREATE (next:RefreshToken $params)
+    SET next.User = token.User, next.Family = token.Family)
+RETURN token.User AS user, valid, rotated, raced""")
+
+QUERIES.Register("RevokeRefreshFamily", """MATCH (token:RefreshToken {Hash: $hash})
+MATCH (each:RefreshToken {Family: token.Family})
+WHERE each.Revoked IS NULL
+SET each.Revoked = $now
+RETURN count(each) AS revoked""")
+
+QUERIES.Register("RevokeUserRefreshTokens", """MATCH (token:RefreshToken {User: $uid})
+WHERE token.Revoked IS NULL
+SET token.Revoked = $now
+RETURN count(token) AS revoked""")
+
+# Subs
+
+QUERIES.Register("GetSub", """MATCH (v:Sub {Title: $title})
+RETURN v""")
+
+QUERIES.Register("CreateSub", """MATCH (user:User {UUID: $uid})
+CREATE (v:Sub $params)
+CREATE (user)-[relationship:OWNS]->(v)
+CREATE (user)-[subscribes:SUBSCRIBES]->(v)
+SET v.Subscribers = 1, v.PostCount = 0
+RETURN v""")
+
+QUERIES.Register("ListSubs", """MATCH (v:Sub)
+WHERE $after IS NULL OR v.Title > $after
+RETURN v
+ORDER BY v.Title
+LIMIT $limit""")
+
+QUERIES.Register("GetSubRelationship", """MATCH (user:User {UUID: $uid})-[relationship]->(v:Sub {Title: $title})
+RETURN relationship""")
+
+QUERIES.Register("UpdateSub", """MATCH (v:Sub {Title: $title})
+SET v += $attributes
+SET v.Modifier = $modifier, v.ModifiedDate = $date
+RETURN v""")
+
+QUERIES.Register("DeleteSub", """MATCH (v:Sub {Title: $title})
+DETACH DELETE v""")
+
+# Subscriptions
+
+# The sub is locked before the relationship is checked, so concurrent
+# (un)subscribes keep Subscribers exact
+QUERIES.Register("SubscribeSub", """MATCH (user:User {UUID: $uid})
+MATCH (v:Sub {Title: $title})
+SET v._lock = true
+REMOVE v._lock
+WITH user, v
+OPTIONAL MATCH (user)-[old:SUBSCRIBES]->(v)
+WITH user, v, old IS NULL AS subscribed
+FOREACH (_ IN CASE WHEN subscribed THEN [1] ELSE [] END |
+    CREATE (user)-[:SUBSCRIBES {CreatedDate: $date}]->(v)
+    SET v.Subscribers = coalesce(v.Subscribers, 0) + 1)
+RETURN v, subscribed""")
+
+# Also drops the sub's posts from the user's timeline
+QUERIES.Register("UnsubscribeSub", """MATCH (user:User {UUID: $uid})
+MATCH (v:Sub {Title: $title})
+SET v._lock = true
+REMOVE v._lock
+WITH user, v
+OPTIONAL MATCH (user)-[old:SUBSCRIBES]->(v)
+WITH user, v, old, old IS NOT NULL AS unsubscribed
+DELETE old
+FOREACH (_ IN CASE WHEN unsubscribed THEN [1] ELSE [] END |
+    SET v.Subscribers = coalesce(v.Subscribers, 1) - 1)
+WITH v, unsubscribed
+OPTIONAL MATCH (t:Timeline {User: $uid})
+WITH v, unsubscribed, t,
+    [i IN range(0, size(coalesce(t.Posts, [])) - 1)
+        WHERE t.Subs[i] <> v.Title] AS keep
+FOREACH (timeline IN CASE WHEN t IS NULL THEN [] ELSE [t] END |
+    SET timeline.Posts = [i IN keep | timeline.Posts[i]],
+        timeline.Times = [i IN keep | timeline.Times[i]],
+        timeline.Subs = [i IN keep | timeline.Subs[i]])
+RETURN v, unsubscribed""")
+
+# Timelines
+
+# A (:Timeline) holds a user's home feed as three parallel lists: post
+# UUIDs, their CreatedDate as epoch seconds and their sub titles, newest
+# first and at most $size long. $entries is a list of {post, time, sub}
+# merged into each matched user's timeline.
+TIMELINE_PUSH = """%(match)s
+MERGE (t:Timeline {User: user.UUID})
+SET t._lock = true
+REMOVE t._lock
+WITH t
+CALL {
+    WITH t
+    UNWIND range(0, size(coalesce(t.Posts, [])) - 1) AS i
+    RETURN t.Posts[i] AS post, t.Times[i] AS time, t.Subs[i] AS sub
+    UNION
+    WITH t
+    UNWIND $entries AS entry
+    RETURN entry.post AS post, entry.time AS time, entry.sub AS sub
+}
+WITH t, post, time, sub
+ORDER BY time DESC, post
+WITH t, collect(post)[0..$size] AS posts, collect(time)[0..$size] AS times,
+    collect(sub)[0..$size] AS subs
+SET t.Posts = posts, t.Times = times, t.Subs = subs
+RETURN count(t) AS timelines"""
+
+QUERIES.Register("PushTimeline", TIMELINE_PUSH % {
+    "match": "MATCH (user:User {UUID: $uid})"})
+
+# Fan-out on write, only for subs with at most $fanoutLimit subscribers
+QUERIES.Register("FanOutPost", TIMELINE_PUSH % {
+    "match": """MATCH (v:Sub {Title: $title})
+WHERE coalesce(v.Subscribers, 0) <= $fanoutLimit
+MATCH (user:User)-[:SUBSCRIBES]->(v)"""})
+
+# Large subs are not fanned out, their titles are returned to be merged
+# in at read time
+QUERIES.Register("GetTimeline", """MATCH (user:User {UUID: $uid})
+OPTIONAL MATCH (t:Timeline {User: $uid})
+OPTIONAL MATCH (user)-[:SUBSCRIBES]->(v:Sub)
+WHERE coalesce(v.Subscribers, 0) > $fanoutLimit
+RETURN coalesce(t.Posts, []) AS posts, coalesce(t.Times, []) AS times,
+    coalesce(t.Subs, []) AS subs, collect(v.Title) AS large""")
+
+# Posts
+
+QUERIES.Register("GetPost", """MATCH (post:Post {UUID: $uid})
+WHERE ($published IS NULL OR post.Published = $published)
+AND ($owner IS NULL OR post.Owner = $owner)
+RETURN post""")
+
+QUERIES.Register("GetPostByTitle", """MATCH (post:Post {Title: $title})
+WHERE ($published IS NULL OR post.Published = $published)
+AND ($owner IS NULL OR post.Owner = $owner)
+RETURN post""")
+
+# Writes that change a post's ranking stamp it with RankedAt (epoch
+# milliseconds), so drivers.database.rankings can pick up the posts of a
+# sub changed since its last sync through the postRankedAt index
+QUERIES.Register("GetPostRankings", """MATCH (post:Post)-[r:ON]->(n:Sub {Title: $title})
+WHERE post.Published = true
+RETURN post {.UUID, .CreatedDate, .Votes, .Likes, .Dislikes, .Published,
+    .RankedAt} AS post""")
+
+QUERIES.Register("GetPostRankingChanges", """MATCH (post:Post)
+USING INDEX post:Post(RankedAt)
+WHERE post.RankedAt > $since
+MATCH (post)-[r:ON]->(n:Sub {Title: $title})
+RETURN post {.UUID, .CreatedDate, .Votes, .Likes, .Dislikes, .Published,
+    .RankedAt} AS post""")
+
+# UNWIND keeps the order of $uuids, so pages come back in ranked order
+QUERIES.Register("GetPostsByUUID", """UNWIND $uuids AS postUUID
+MATCH (post:Post {UUID: postUUID})
+RETURN post""")
+
+# Both ends are looked up through their UUID constraints, so checking a
+# page of posts is one index seek per post plus an expand-into
+QUERIES.Register("GetPostVoteStates", """MATCH (user:User {UUID: $uid})
+UNWIND $uuids AS postUUID
+MATCH (post:Post {UUID: postUUID})
+MATCH (user)-[rel:LIKES|DISLIKES]->(post)
+RETURN post.UUID AS uuid, type(rel) AS vote""")
+
+# Keyset pagination: ($after, $afterUUID) is the last row of the previous
+# page. Each sort key has its own template, so the range predicate and
+# ORDER BY are served by its (key, UUID) index (schema migration 7); the
+# first page starts after the key's smallest value in POST_LIST_ORDERS.
+# Posts without the key are left out.
+LIST_POSTS = """MATCH (post:Post)
+WHERE post.%(key)s >= $after AND post.UUID IS NOT NULL
+AND (post.%(key)s > $after OR post.UUID > $afterUUID)%(visible)s
+RETURN post
+ORDER BY post.%(key)s, post.UUID
+LIMIT $limit"""
+
+# Sort key -> smallest value, the cursor of the first page
+POST_LIST_ORDERS = {
+    "CreatedDate": "",
+    "ModifiedDate": "",
+    "Title": "",
+    "Votes": -2**63,
+}
+
+for key in POST_LIST_ORDERS:
+    # Admins see every post, everyone else published and their own ones
+    QUERIES.Register(f"ListAllPostsBy{key}", LIST_POSTS % {
+        "key": key, "visible": ""})
+    QUERIES.Register(f"ListPostsBy{key}", LIST_POSTS % {
+        "key": key, "visible": """
+AND (post.Published = true OR post.Owner = $uid OR post.Creator = $uid)"""})
+
+QUERIES.Register("CreatePost", """MATCH (user:User {UUID: $uid})
+CREATE (post:Post $params)
+SET post.RankedAt = timestamp()
+CREATE (user)-[relationship:OWNS]->(post)
+CREATE (user)-[relationship2:AUTHOR]->(post)
+WITH post
+CALL {
+    WITH post
+    UNWIND $files AS fileUUID
+    MATCH (file:File {UUID: fileUUID})
+    CREATE (post)-[linksToFile:ATTACHES]->(file)
+}
+CALL {
+    WITH post
+    MATCH (v:Sub {Title: $subTitle})
+    CREATE (post)-[relationship3:ON]->(v)
+    SET v.PostCount = coalesce(v.PostCount, 0) + 1
+}
+RETURN post""")
+
+QUERIES.Register("UpdatePost", """MATCH (post:Post {UUID: $uid})
+SET post += $attributes
+SET post.Modifier = $modifier, post.ModifiedDate = $date
+SET post.Published = coalesce($published, post.Published)
+SET post.PublishedDate = CASE WHEN $published THEN $date
+    ELSE post.PublishedDate END
+SET post.RankedAt = timestamp()
+WITH post
+OPTIONAL MATCH (post)-[r:ON]->(v:Sub)
+RETURN post, v.Title AS sub""")
+
+QUERIES.Register("DeletePost", """MATCH (post:Post {UUID: $uid})
+OPTIONAL MATCH (post)-[:ON]->(v:Sub)
+SET v.PostCount = coalesce(v.PostCount, 1) - 1
+DETACH DELETE post
+RETURN v.Title AS sub""")
+
+QUERIES.Register("SearchPosts", """CALL db.index.fulltext.queryNodes("postKeywords", $keywords)
+YIELD node
+RETURN node""")
+
+# Votes
+
+# $vote is 1 (like), -1 (dislike) or 0 (none). With $toggle, repeating
+# the current vote clears it. The locked node is written before the vote
+# relationships are read, so concurrent votes on it are serialized.
+VOTE_RELATE = """MATCH (user:User {UUID: $uid})
+MATCH (target:%(label)s {UUID: $target})
+WHERE target.Published = true
+SET %(lock)s._lock = true
+REMOVE %(lock)s._lock
+WITH user, target
+OPTIONAL MATCH (user)-[old:LIKES|DISLIKES]->(target)
+WITH user, target, collect(old) AS olds
+WITH user, target, olds, CASE
+    WHEN any(r IN olds WHERE type(r) = "LIKES") THEN 1
+    WHEN any(r IN olds WHERE type(r) = "DISLIKES") THEN -1
+    ELSE 0 END AS previous
+WITH user, target, olds, previous, CASE
+    WHEN $toggle AND previous = $vote THEN 0
+    ELSE $vote END AS vote
+FOREACH (rel IN [r IN olds WHERE vote <> previous] | DELETE rel)
+FOREACH (_ IN CASE WHEN vote = 1 THEN [1] ELSE [] END |
+    MERGE (user)-[:LIKES]->(target))
+FOREACH (_ IN CASE WHEN vote = -1 THEN [1] ELSE [] END |
+    MERGE (user)-[:DISLIKES]->(target))
+"""
+
+# Locks the target and updates its counters in the same write
+VOTE = VOTE_RELATE + """SET target.Votes = coalesce(target.Votes, 0) + vote - previous,
+    target.Likes = coalesce(target.Likes, 0)
+        + CASE vote WHEN 1 THEN 1 ELSE 0 END
+        - CASE previous WHEN 1 THEN 1 ELSE 0 END,
+    target.Dislikes = coalesce(target.Dislikes, 0)
+        + CASE vote WHEN -1 THEN 1 ELSE 0 END
+        - CASE previous WHEN -1 THEN 1 ELSE 0 END,
+    target.RankedAt = timestamp()
+RETURN target, previous, vote"""
+
+# Write-behind: only the voter is locked, the counter deltas are
+# buffered by drivers.database.votes and applied in batches
+RECORD_VOTE = VOTE_RELATE + """RETURN target, previous, vote"""
+
+# $deltas is a list of {uuid, votes, likes, dislikes}, sorted by uuid so
+# concurrent flushes always lock targets in the same order
+APPLY_VOTE_DELTAS = """UNWIND $deltas AS delta
+MATCH (target:%(label)s {UUID: delta.uuid})
+SET target.Votes = coalesce(target.Votes, 0) + delta.votes,
+    target.Likes = coalesce(target.Likes, 0) + delta.likes,
+    target.Dislikes = coalesce(target.Dislikes, 0) + delta.dislikes,
+    target.RankedAt = timestamp()
+RETURN count(target) AS applied"""
+
+for label in ("Post", "Comment"):
+    QUERIES.Register(f"Vote{label}",
+                     VOTE % {"label": label, "lock": "target"})
+    QUERIES.Register(f"Record{label}Vote",
+                     RECORD_VOTE % {"label": label, "lock": "user"})
+    QUERIES.Register(f"Apply{label}VoteDeltas",
+                     APPLY_VOTE_DELTAS % {"label": label})
+
+# Comments
+
+QUERIES.Register("GetComment", """MATCH (comment:Comment {UUID: $uid})
+OPTIONAL MATCH (comment)-[r:ATTACHES]->(f:File)
+RETURN comment, f""")
+
+QUERIES.Register("CreateComment", """MATCH (user:User {UUID: $uid})
+CALL {
+    MATCH (target:Post {UUID: $commentOn}) RETURN target
+    UNION
+    MATCH (target:Comment {UUID: $commentOn}) RETURN target
+}
+CREATE (comment:Comment $params)
+CREATE (user)-[madeComment:OWNS]->(comment)
+CREATE (comment)-[isOn:ON]->(target)
+WITH comment
+CALL {
+    WITH comment
+    UNWIND $files AS fileUUID
+    MATCH (file:File {UUID: fileUUID})
+    CREATE (comment)-[linksToFile:ATTACHES]->(file)
+}
+WITH comment
+OPTIONAL MATCH (comment)-[:ON*]->(post:Post)
+SET post.CommentCount = coalesce(post.CommentCount, 0) + 1
+RETURN comment, post.UUID AS post""")
+
+QUERIES.Register("ListComments", """CALL {
+    MATCH (target:Post {UUID: $uid}) RETURN target
+    UNION
+    MATCH (target:Comment {UUID: $uid}) RETURN target
+}
+MATCH (comment:Comment)-[r:ON]->(target)
+WHERE $after IS NULL OR comment.CreatedDate > $after
+OR (comment.CreatedDate = $after AND comment.UUID > $afterUUID)
+RETURN comment
+ORDER BY comment.CreatedDate, comment.UUID
+LIMIT $limit""")
+
+# Deepest reply level a comment tree can be read to, one query per level
+COMMENT_TREE_MAX_DEPTH = 10
+
+# Comment trees are read one reply level at a time: $parents are the
+# UUIDs of the post or comments shown on the level above, and each gets
+# its first $limit published replies, after the keyset cursor ($after,
+# $afterUUID) when one is given. replies counts every reply of a parent,
+# published or not, so it is a degree lookup rather than a scan.
+COMMENT_REPLIES = """UNWIND $parents AS parentUUID
+CALL {
+    WITH parentUUID
+    MATCH (parent:Post {UUID: parentUUID}) RETURN parent
+    UNION
+    WITH parentUUID
+    MATCH (parent:Comment {UUID: parentUUID}) RETURN parent
+}
+CALL {
+    WITH parent
+    MATCH (comment:Comment)-[:ON]->(parent)
+    WHERE coalesce(comment.Published, true) = true
+    AND ($after IS NULL OR %(key)s %(cmp)s $after
+        OR (%(key)s = $after AND comment.UUID > $afterUUID))
+    WITH comment
+    ORDER BY %(key)s %(direction)s, comment.UUID
+    LIMIT $limit
+    RETURN collect(comment) AS comments
+}
+RETURN parentUUID AS parent, comments,
+    COUNT { (reply:Comment)-[:ON]->(parent) } AS replies"""
+
+# Sort -> (key, direction) of comment tree levels
+COMMENT_TREE_SORTS = {
+    "Top": ("coalesce(comment.Votes, 0)", "DESC"),
+    "New": ("comment.CreatedDate", "DESC"),
+    "Old": ("comment.CreatedDate", "ASC"),
+}
+
+for sort, (key, direction) in COMMENT_TREE_SORTS.items():
+    QUERIES.Register(f"GetCommentReplies{sort}", COMMENT_REPLIES % {
+        "key": key, "direction": direction,
+        "cmp": "<" if direction == "DESC" else ">"})
+
+QUERIES.Register("UpdateComment", """MATCH (comment:Comment {UUID: $uid})
+CALL {
+    WITH comment
+    UNWIND $files AS fileUUID
+    MATCH (file:File {UUID: fileUUID})
+    CREATE (comment)-[linksToFile:ATTACHES]->(file)
+}
+SET comment += $attributes
+RETURN comment""")
+
+# Replies of a deleted comment are cut off from the post, so they stop
+# counting towards its CommentCount as well
+QUERIES.Register("DeleteComment", """MATCH (comment:Comment {UUID: $uid})
+OPTIONAL MATCH (comment)-[:ON]->(parent)
+OPTIONAL MATCH (comment)-[:ON*]->(post:Post)
+OPTIONAL MATCH (reply:Comment)-[:ON*]->(comment)
+WITH comment, parent, post, count(reply) AS replies
+SET post.CommentCount = coalesce(post.CommentCount, 1 + replies) - 1 - replies
+DETACH DELETE comment
+RETURN post.UUID AS post, parent.UUID AS parent""")
+
+# Files
+
+QUERIES.Register("GetFile", """MATCH (file:File {UUID: $uid})
+RETURN file""")
+
+QUERIES.Register("GetFileByName", """MATCH (file:File {Filename: $filename})
+RETURN file
+LIMIT 1""")
+
+QUERIES.Register("CreateFile", """MATCH (user:User {UUID: $uid})
+CREATE (file:File $params)
+CREATE (user)-[relationship:OWNS]->(file)
+RETURN file""")
+
+QUERIES.Register("ListFiles", """MATCH (file:File)
+WHERE $after IS NULL OR file.UUID > $after
+RETURN file
+ORDER BY file.UUID
+LIMIT $limit""")
+
+QUERIES.Register("DeleteFile", """MATCH (file:File {UUID: $uid})
+DETACH DELETE file""")
+
+# Content-addressed blobs
+# With STORAGE_DEDUPE files are stored once per digest. Blob.References
+# counts the File nodes pointing at a blob; DetachBlob deletes the blob
+# node with its last reference and returns references <= 0 so the
+# caller removes the stored content too.
+
+QUERIES.Register("AttachBlob", """MATCH (file:File {UUID: $uid})
+MERGE (blob:Blob {Hash: $hash})
+ON CREATE SET blob.References = 0, blob.SizeBytes = $size
+SET blob.References = blob.References + 1
+SET file.Blob = $hash, file.Hash = $hash
+CREATE (file)-[content:CONTENT]->(blob)
+RETURN file, blob.References AS references""")
+
+QUERIES.Register("DetachBlob", """MATCH (file:File {UUID: $uid})-[content:CONTENT]->(blob:Blob)
+SET blob.References = blob.References - 1
+DELETE content
+REMOVE file.Blob
+WITH blob, blob.Hash AS hash, blob.References AS references
+FOREACH (_ IN CASE WHEN references <= 0 THEN [1] ELSE [] END |
+    DELETE blob)
+RETURN hash, references""")
+
+# Content is only removed while holding the blob's write lock, so an
+# upload attaching the same digest meanwhile waits for it (see RemoveBlob)
+QUERIES.Register("LockBlob", """MERGE (blob:Blob {Hash: $hash})
+ON CREATE SET blob.References = 0
+SET blob.References = blob.References
+RETURN blob.References AS references""")
+
+QUERIES.Register("DeleteUnusedBlob", """MATCH (blob:Blob {Hash: $hash})
+WHERE blob.References <= 0
+DETACH DELETE blob""")
+
+QUERIES.Register("ListFilesWithoutBlob", """MATCH (file:File)
+WHERE ($after IS NULL OR file.UUID > $after) AND file.Blob IS NULL
+RETURN file
+ORDER BY file.UUID
+LIMIT $limit""")
+
+# Counter repair
+
+# Each batch recomputes the counters of $limit nodes after the key
+# $after, RETURNing the last key so the next batch can continue from it
+QUERIES.Register("RepairPostCounters", """MATCH (post:Post)
+WHERE $after IS NULL OR post.UUID > $after
+WITH post
+ORDER BY post.UUID
+LIMIT $limit
+CALL {
+    WITH post
+    OPTIONAL MATCH (comment:Comment)-[:ON*]->(post)
+    RETURN count(comment) AS comments
+}
+WITH post, comments, coalesce(post.CommentCount, -1) <> comments AS changed
+SET post.CommentCount = comments
+RETURN max(post.UUID) AS last, count(post) AS checked,
+    sum(CASE WHEN changed THEN 1 ELSE 0 END) AS repaired""")
+
+QUERIES.Register("RepairSubCounters", """MATCH (v:Sub)
+WHERE $after IS NULL OR v.Title > $after
+WITH v
+ORDER BY v.Title
+LIMIT $limit
+CALL {
+    WITH v
+    OPTIONAL MATCH (post:Post)-[:ON]->(v)
+    RETURN count(post) AS posts
+}
+CALL {
+    WITH v
+    OPTIONAL MATCH (user:User)-[:SUBSCRIBES]->(v)
+    RETURN count(user) AS subscribers
+}
+WITH v, posts, subscribers, coalesce(v.PostCount, -1) <> posts
+    OR coalesce(v.Subscribers, -1) <> subscribers AS changed
+SET v.PostCount = posts, v.Subscribers = subscribers
+RETURN max(v.Title) AS last, count(v) AS checked,
+    sum(CASE WHEN changed THEN 1 ELSE 0 END) AS repaired""")
+
+# Schema migrations
+
+QUERIES.Register("GetSchemaMigrations", """MATCH (m:SchemaMigration)
+RETURN m.Version AS version""")
+
+QUERIES.Register("RecordSchemaMigration", """MERGE (m:SchemaMigration {Version: $version})
+SET m.Description = $description, m.AppliedDate = $date
+RETURN m""")
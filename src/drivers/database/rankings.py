@@ -0,0 +1,288 @@
+"""drivers/database/rankings.py
+
+Precomputed hot/top/new/controversial rankings of the posts in each sub.
+
+Each sub keeps one sorted index per ranking mode, plus windowed top and
+controversial indexes holding only the posts created within each window.
+Creating, publishing, voting on or deleting a post moves only that post
+within the indexes, so a page of any feed - windowed or not - is a slice
+of a sorted list instead of a sort over every post in the sub.
+
+A sub's indexes are built from the database the first time it is read.
+Writes stamp the post with RankedAt, and every sync_interval seconds a
+sub being read picks up the posts stamped since its last sync, i.e.
+changes made through other workers. The indexes are rebuilt after
+max_age seconds, which also drops posts deleted elsewhere. At most
+max_subs subs are kept, least recently read dropped first.
+"""
+import math
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+MODES = ("hot", "top", "new", "controversial")
+
+# Modes that can be limited to a window
+WINDOWED = ("top", "controversial")
+
+# Windows for top and controversial
+WINDOWS = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+    "month": timedelta(days=30),
+    "year": timedelta(days=365),
+    "all": None,
+}
+
+# Seconds of age worth one order of magnitude of votes in hot
+HOT_DECAY_SECONDS = 45000
+HOT_EPOCH = 1134028003
+
+# Milliseconds a sync reaches back before the newest RankedAt it has
+# seen, so writes committed out of order are not missed
+SYNC_OVERLAP_MS = 10000
+
+
+def Timestamp(created):
+    """Timestamp - Seconds since the epoch of a CreatedDate.
+    """
+    if isinstance(created, datetime):
+        return created.timestamp()
+    try:
+        return datetime.fromisoformat(str(created)).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def Hot(votes: int, created: float):
+    """Hot - Logarithmic score with a linear time bonus.
+
+    Newer posts get a constant head start instead of older posts being
+    decayed, so a score only changes when the post's votes change.
+    """
+    order = math.log10(max(abs(votes), 1))
+    sign = 1 if votes > 0 else -1 if votes < 0 else 0
+    return sign * order + (created - HOT_EPOCH) / HOT_DECAY_SECONDS
+
+
+def Controversial(likes: int, dislikes: int):
+    """Controversial - Many votes, split close to evenly.
+    """
+    if likes <= 0 or dislikes <= 0:
+        return 0.0
+    balance = min(likes, dislikes) / max(likes, dislikes)
+    return (likes + dislikes) ** balance
+
+
+class RankedIndex:
+    """RankedIndex keeps UUIDs sorted by descending score.
+
+    Ties are broken by UUID so every key is unique and stable.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.scores = {}
+
+    def Set(self, uuid: str, score: float):
+        self.Remove(uuid)
+        self.scores[uuid] = score
+        insort(self.keys, (-score, uuid))
+
+    def Remove(self, uuid: str):
+        if uuid in self.scores:
+            key = (-self.scores.pop(uuid), uuid)
+            del self.keys[bisect_left(self.keys, key)]
+
+    def Seek(self, after: tuple = None):
+        """Seek - Position just past the (score, uuid) key after.
+        """
+        if after is None:
+            return 0
+        score, uuid = after
+        return bisect_right(self.keys, (-score, uuid))
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class SubRanking:
+    """SubRanking holds every ranking mode of a single sub.
+    """
+
+    def __init__(self):
+        self.loaded = self.synced = time.monotonic()
+        self.since = 0  # Newest RankedAt seen
+        self.posts = {}  # UUID -> (created, votes, likes, dislikes)
+        self.indexes = {mode: RankedIndex() for mode in MODES}
+        # Window -> ((created, uuid) of its posts, oldest first,
+        #            {mode: RankedIndex of its posts})
+        self.windows = {window: ([], {mode: RankedIndex() for mode in WINDOWED})
+                        for window, span in WINDOWS.items() if span}
+
+    def Set(self, uuid: str, created: float, votes: int, likes: int,
+            dislikes: int):
+        self.posts[uuid] = (created, votes, likes, dislikes)
+        scores = {
+            "hot": Hot(votes, created),
+            "top": votes,
+            "new": created,
+            "controversial": Controversial(likes, dislikes),
+        }
+        for mode, index in self.indexes.items():
+            index.Set(uuid, scores[mode])
+        now = time.time()
+        for window, (members, indexes) in self.windows.items():
+            if created < now - WINDOWS[window].total_seconds():
+                continue
+            if uuid not in indexes["top"].scores:
+                insort(members, (created, uuid))
+            for mode, index in indexes.items():
+                index.Set(uuid, scores[mode])
+
+    def Remove(self, uuid: str):
+        post = self.posts.pop(uuid, None)
+        for index in self.indexes.values():
+            index.Remove(uuid)
+        if post is None:
+            return
+        for members, indexes in self.windows.values():
+            if uuid in indexes["top"].scores:
+                del members[bisect_left(members, (post[0], uuid))]
+                for index in indexes.values():
+                    index.Remove(uuid)
+
+    def _Expire(self, window: str):
+        """_Expire - Drops the posts that have aged out of a window."""
+        members, indexes = self.windows[window]
+        oldest = time.time() - WINDOWS[window].total_seconds()
+        expired = bisect_left(members, (oldest,))
+        for _, uuid in members[:expired]:
+            for index in indexes.values():
+                index.Remove(uuid)
+        del members[:expired]
+
+    def Page(self, mode: str, after: tuple, count: int, window: str = "all"):
+        """Page - Returns up to count (score, uuid) keys ranked after the
+        key after, or from the top when after is None.
+        """
+        index = self.indexes[mode]
+        if mode in WINDOWED and WINDOWS.get(window):
+            self._Expire(window)
+            index = self.windows[window][1][mode]
+        start = index.Seek(after)
+        return [(-score, uuid)
+                for score, uuid in index.keys[start:start + count]]
+
+
+class Rankings:
+    """Rankings maps sub titles to their ranked post indexes.
+
+        buffer: VoteBuffer - Pending vote deltas merged in when loading
+        max_age: float - Seconds before a sub's indexes are rebuilt
+        sync_interval: float - Seconds between reads of the posts changed
+                               through other workers
+        max_subs: int - Subs kept, least recently read dropped first
+
+        Usage:
+            keys = await RANKINGS.Page(db, "pics", "hot", None, 25)
+            RANKINGS.Update("pics", post)
+    """
+
+    def __init__(self, buffer=None, max_age: float = 300,
+                 sync_interval: float = 5, max_subs: int = 1000):
+        self.buffer = buffer
+        self.max_age = max_age
+        self.sync_interval = sync_interval
+        self.max_subs = max_subs
+        self.subs = OrderedDict()
+        self.postSub = {}  # Post UUID -> sub title, for loaded subs only
+
+    def _Apply(self, title: str, ranking: SubRanking, post: dict):
+        """_Apply - Ranks a post read from the database."""
+        if self.buffer is not None:
+            self.buffer.Apply("Post", post)
+        ranking.since = max(ranking.since, post.get("RankedAt") or 0)
+        if post.get("Published") is not True:
+            ranking.Remove(post["UUID"])
+            self.postSub.pop(post["UUID"], None)
+            return
+        ranking.Set(post["UUID"], Timestamp(post.get("CreatedDate")),
+                    post.get("Votes") or 0, post.get("Likes") or 0,
+                    post.get("Dislikes") or 0)
+        self.postSub[post["UUID"]] = title
+
+    async def Load(self, db, title: str):
+        """Load - Builds the indexes of a sub from its published posts.
+        """
+        ranking = SubRanking()
+        res = await db.Read("GetPostRankings", {"title": title})
+        old = self.subs.pop(title, None)
+        if old is not None:
+            for uuid in old.posts:
+                self.postSub.pop(uuid, None)
+        for each in res:
+            self._Apply(title, ranking, each["post"])
+        self.subs[title] = ranking
+        while len(self.subs) > self.max_subs:
+            _, evicted = self.subs.popitem(last=False)
+            for uuid in evicted.posts:
+                self.postSub.pop(uuid, None)
+        return ranking
+
+    async def Sync(self, db, title: str, ranking: SubRanking):
+        """Sync - Re-ranks the posts of a sub changed since its last sync.
+        """
+        res = await db.Read("GetPostRankingChanges", {
+            "title": title, "since": ranking.since - SYNC_OVERLAP_MS})
+        for each in res:
+            self._Apply(title, ranking, each["post"])
+        ranking.synced = time.monotonic()
+
+    async def Get(self, db, title: str):
+        """Get - Returns the indexes of a sub, loading them if missing
+        or older than max_age and syncing them every sync_interval.
+        """
+        ranking = self.subs.get(title)
+        now = time.monotonic()
+        if ranking is None or now - ranking.loaded > self.max_age:
+            ranking = await self.Load(db, title)
+        elif now - ranking.synced > self.sync_interval:
+            await self.Sync(db, title, ranking)
+        self.subs.move_to_end(title)
+        return ranking
+
+    async def Page(self, db, title: str, mode: str, after: tuple,
+                   count: int, window: str = "all"):
+        """Page - Returns the (score, uuid) keys of up to count posts of a
+        sub, ranked after the key after.
+        """
+        ranking = await self.Get(db, title)
+        return ranking.Page(mode, after, count, window)
+
+    def Update(self, title: str, post: dict):
+        """Update - Re-ranks a post after it was created, edited or voted on.
+            title: Optional[str] - Sub title, looked up when None
+            post: dict - Post properties
+        """
+        title = title or self.postSub.get(post["UUID"])
+        ranking = self.subs.get(title)
+        if ranking is None:
+            # Not loaded yet, the next read builds it from the database
+            return
+        if post.get("Published") is not True:
+            self.Remove(post["UUID"])
+            return
+        ranking.Set(post["UUID"], Timestamp(post.get("CreatedDate")),
+                    post.get("Votes") or 0, post.get("Likes") or 0,
+                    post.get("Dislikes") or 0)
+        self.postSub[post["UUID"]] = title
+
+    def Remove(self, uuid: str):
+        """Remove - Drops a deleted or unpublished post from its sub.
+        """
+        title = self.postSub.pop(uuid, None)
+        if title in self.subs:
+            self.subs[title].Remove(uuid)
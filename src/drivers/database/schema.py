@@ -0,0 +1,106 @@
+"""drivers/database/schema.py
+
+Versioned, idempotent schema migrations for the VioletHawk graph.
+
+Each migration is applied once and recorded as a (:SchemaMigration) node.
+Every statement uses IF NOT EXISTS, so re-running a migration (or several
+workers starting at once) is harmless.
+"""
+from datetime import datetime
+from config import settings
+
+# (Version, Description, Statements)
+MIGRATIONS = [
+    (1, "Uniqueness constraints on lookup keys", [
+        """CREATE CONSTRAINT schemaMigrationVersion IF NOT EXISTS
+        FOR (n:SchemaMigration) REQUIRE n.Version IS UNIQUE""",
+        """CREATE CONSTRAINT userUUID IF NOT EXISTS
+        FOR (n:User) REQUIRE n.UUID IS UNIQUE""",
+        """CREATE CONSTRAINT userEmail IF NOT EXISTS
+        FOR (n:User) REQUIRE n.Email IS UNIQUE""",
+        """CREATE CONSTRAINT subTitle IF NOT EXISTS
+        FOR (n:Sub) REQUIRE n.Title IS UNIQUE""",
+        """CREATE CONSTRAINT postUUID IF NOT EXISTS
+        FOR (n:Post) REQUIRE n.UUID IS UNIQUE""",
+        """CREATE CONSTRAINT commentUUID IF NOT EXISTS
+        FOR (n:Comment) REQUIRE n.UUID IS UNIQUE""",
+        """CREATE CONSTRAINT fileUUID IF NOT EXISTS
+        FOR (n:File) REQUIRE n.UUID IS UNIQUE""",
+    ]),
+    (2, "Range indexes for feeds and ownership lookups", [
+        """CREATE INDEX postModifiedDate IF NOT EXISTS
+        FOR (n:Post) ON (n.ModifiedDate)""",
+        """CREATE INDEX postOwner IF NOT EXISTS
+        FOR (n:Post) ON (n.Owner)""",
+        """CREATE INDEX commentCreator IF NOT EXISTS
+        FOR (n:Comment) ON (n.Creator)""",
+    ]),
+    (3, "Post keyword fulltext index", [
+        """CREATE FULLTEXT INDEX postKeywords IF NOT EXISTS
+        FOR (n:Post) ON EACH [n.Title, n.Content, n.Keywords]""",
+    ]),
+    (4, "One home timeline per user", [
+        """CREATE CONSTRAINT timelineUser IF NOT EXISTS
+        FOR (n:Timeline) REQUIRE n.User IS UNIQUE""",
+    ]),
+    (5, "Refresh token lookups", [
+        """CREATE CONSTRAINT refreshTokenHash IF NOT EXISTS
+        FOR (n:RefreshToken) REQUIRE n.Hash IS UNIQUE""",
+        """CREATE INDEX refreshTokenFamily IF NOT EXISTS
+        FOR (n:RefreshToken) ON (n.Family)""",
+        """CREATE INDEX refreshTokenUser IF NOT EXISTS
+        FOR (n:RefreshToken) ON (n.User)""",
+    ]),
+    (6, "One blob per content digest", [
+        """CREATE CONSTRAINT blobHash IF NOT EXISTS
+        FOR (n:Blob) REQUIRE n.Hash IS UNIQUE""",
+    ]),
+    (7, "Keyset indexes for post listings", [
+        """CREATE INDEX postCreatedDateUUID IF NOT EXISTS
+        FOR (n:Post) ON (n.CreatedDate, n.UUID)""",
+        """CREATE INDEX postModifiedDateUUID IF NOT EXISTS
+        FOR (n:Post) ON (n.ModifiedDate, n.UUID)""",
+        """CREATE INDEX postTitleUUID IF NOT EXISTS
+        FOR (n:Post) ON (n.Title, n.UUID)""",
+        """CREATE INDEX postVotesUUID IF NOT EXISTS
+        FOR (n:Post) ON (n.Votes, n.UUID)""",
+    ]),
+    (8, "Ranking changes of posts", [
+        """CREATE INDEX postRankedAt IF NOT EXISTS
+        FOR (n:Post) ON (n.RankedAt)""",
+    ]),
+]
+
+
+async def GetAppliedMigrations(db):
+    """GetAppliedMigrations - Returns the set of applied migration versions.
+        db: Database - settings.DB
+    """
+    res = await db.Read("GetSchemaMigrations")
+    return {each["version"] for each in res}
+
+
+async def Migrate(db, target: int = None):
+    """Migrate - Applies every pending migration up to target, in order.
+        db: Database - settings.DB
+        target: Optional[int] - Last version to apply, defaults to all
+
+        Usage:
+            applied = await Migrate(settings.DB)
+    """
+    done = await GetAppliedMigrations(db)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version in done:
+            continue
+        if target is not None and version > target:
+            break
+        for statement in statements:
+            await db.RunSchema(statement)
+        await db.Write("RecordSchemaMigration", {
+            "version": version,
+            "description": description,
+            "date": str(datetime.now(settings.TIMEZONE)),
+        })
+        applied.append(version)
+    return applied
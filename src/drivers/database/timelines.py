@@ -0,0 +1,107 @@
+"""drivers/database/timelines.py
+
+Personalized home feeds built from a user's sub subscriptions.
+
+Posts published in a sub with at most fanout_limit subscribers are
+pushed into every subscriber's (:Timeline) node (fan-out on write), so a
+logged-in front page is a single lookup of one bounded list. Subs above
+the limit would cost one timeline write per subscriber for every post;
+their newest posts are merged in at read time from the sub's "new"
+ranking instead (fan-out on read).
+"""
+import asyncio
+import json
+import logging
+from drivers.database.rankings import Timestamp
+
+LOGGER = logging.getLogger("violethawk.database")
+
+
+class Timelines:
+    """Timelines delivers published posts and pages home feeds.
+
+        rankings: Rankings - Newest posts of subs merged in at read time
+        size: int - Entries kept per timeline, oldest dropped first
+        fanout_limit: int - Largest sub, by Subscribers, fanned out on write
+
+        Usage:
+            db.AfterCommit(lambda: TIMELINES.Deliver(settings.DB, title, post))
+            keys = await TIMELINES.Page(db, user.UUID, None, 25)
+    """
+
+    def __init__(self, rankings, size: int = 500, fanout_limit: int = 10000):
+        self.rankings = rankings
+        self.size = size
+        self.fanout_limit = fanout_limit
+        self.tasks = set()
+
+    async def FanOut(self, db, title: str, post: dict):
+        """FanOut - Pushes a post into the timeline of every subscriber
+        of a small sub and returns how many timelines were written.
+            db: Database - settings.DB
+        """
+        entry = {"post": post["UUID"], "sub": title,
+                 "time": Timestamp(post.get("CreatedDate"))}
+        try:
+            res = await db.Write("FanOutPost", {"title": title,
+                                                "entries": [entry],
+                                                "size": self.size,
+                                                "fanoutLimit": self.fanout_limit})
+        except Exception as e:
+            LOGGER.error(json.dumps({"Event": "FanOutError", "Sub": title,
+                                     "Error": type(e).__name__}))
+            return 0
+        return res[0]["timelines"] if res else 0
+
+    def Deliver(self, db, title: str, post: dict):
+        """Deliver - Fans a published post out in the background, so the
+        request that published it does not wait on the subscribers.
+        Call it once the post is committed.
+        """
+        if not title or post.get("Published") is not True:
+            return
+        task = asyncio.create_task(self.FanOut(db, title, post))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def Backfill(self, db, uid: str, title: str):
+        """Backfill - Pushes the newest posts of a sub the user just
+        subscribed to into their timeline.
+            db: UnitOfWork - The subscribing request's unit of work
+        """
+        ranking = await self.rankings.Get(db, title)
+        keys = ranking.Page("new", None, self.size)
+        if keys:
+            await db.Write("PushTimeline", {
+                "uid": uid,
+                "entries": [{"post": uuid, "time": time, "sub": title}
+                            for time, uuid in keys],
+                "size": self.size,
+            })
+
+    async def Page(self, db, uid: str, after: tuple, count: int):
+        """Page - Returns up to count (time, uuid, sub) entries of a
+        user's home feed, newest first, after the (time, uuid) key after.
+        """
+        res = await db.Read("GetTimeline", {"uid": uid,
+                                            "fanoutLimit": self.fanout_limit})
+        if not res:
+            return []
+        entries = {uuid: (time, sub) for uuid, time, sub in
+                   zip(res[0]["posts"], res[0]["times"], res[0]["subs"])}
+        for title in res[0]["large"]:
+            for time, uuid in await self.rankings.Page(db, title, "new",
+                                                       after, count):
+                entries[uuid] = (time, title)
+        # Same order as a RankedIndex: descending time, then UUID
+        keys = sorted(((-time, uuid), sub)
+                      for uuid, (time, sub) in entries.items())
+        if after is not None:
+            keys = [each for each in keys if each[0] > (-after[0], after[1])]
+        return [(-key[0], key[1], sub) for key, sub in keys[:count]]
+
+    async def Drain(self):
+        """Drain - Waits for every fan-out still running.
+        """
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,93 @@
+"""drivers/database/utils.py
+
+VioletHawk database dependencies.
+"""
+import base64
+import binascii
+import json
+import logging
+from fastapi import HTTPException, Request, status
+from fastapi.routing import APIRoute
+from config import settings
+
+LOGGER = logging.getLogger("violethawk.database")
+
+
+async def GetUnitOfWork(request: Request):
+    """GetUnitOfWork - Provides one UnitOfWork per request.
+
+    FastAPI caches dependencies per request, so the endpoint and every
+    auth dependency share the same session. UnitOfWorkRoute commits the
+    work once the endpoint succeeds, before the response is sent; reads
+    made while a response streams are committed when it ends. Everything
+    is rolled back if the request raises.
+
+        Usage:
+            async def endpoint(db: UnitOfWork = Depends(GetUnitOfWork)):
+                res = await db.Read("GetSub", {"title": title})
+    """
+    db = settings.DB.Session()
+    request.state.unitOfWork = db
+    try:
+        yield db
+        await db.Commit()
+    finally:
+        await db.Close()
+
+
+class UnitOfWorkRoute(APIRoute):
+    """UnitOfWorkRoute commits the request's UnitOfWork as soon as the
+    endpoint returns, so a client is only told about writes that are
+    durable and its next request reads them. A failed commit is answered
+    with a 500 and the work is rolled back.
+
+        Usage:
+            router = APIRouter(route_class=UnitOfWorkRoute)
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def CommitBeforeResponse(request: Request):
+            response = await handler(request)
+            db = getattr(request.state, "unitOfWork", None)
+            if db is not None:
+                try:
+                    await db.Commit()
+                except Exception as e:
+                    LOGGER.error(json.dumps({"Event": "CommitError",
+                                             "Path": request.url.path,
+                                             "Error": type(e).__name__}))
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail="The changes could not be saved."
+                    ) from e
+            return response
+        return CommitBeforeResponse
+
+
+def EncodeCursor(key, uuid: str):
+    """EncodeCursor - Returns an opaque cursor for the item after which
+    the next page starts.
+        key - Sort key of the last item on the page
+        uuid: str - Unique id of the last item, breaks ties between keys
+    """
+    raw = json.dumps([key, uuid], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def DecodeCursor(cursor: str):
+    """DecodeCursor - Returns the (key, uuid) of a cursor, or
+    (None, None) for the first page.
+    """
+    if not cursor:
+        return None, None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key, uuid = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor."
+        ) from e
+    return key, uuid
@@ -0,0 +1,208 @@
+"""drivers/database/votes.py
+
+Write-behind aggregation of vote counters.
+
+Voting on a popular post used to update the post node on every vote, so
+all voters queued on the same node lock. With write-behind enabled, a
+vote only records the voter's LIKES/DISLIKES relationship; the counter
+deltas are summed in memory per target and flushed in one batched UNWIND
+write per label every VOTE_FLUSH_INTERVAL_SECONDS.
+
+Reads merge pending deltas back in through VoteBuffer.Apply(), so a user
+sees their own vote immediately. Deltas are per process: other workers
+see a vote once it has been flushed.
+
+VoteStateCache remembers which posts each user liked or disliked, so a
+feed page only asks the database about posts it has not seen before.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+LOGGER = logging.getLogger("violethawk.database")
+
+# Labels that carry Votes/Likes/Dislikes counters
+LABELS = ("Post", "Comment")
+
+
+class VoteBuffer:
+    """VoteBuffer sums vote counter deltas and flushes them in batches.
+
+        enabled: bool - When False, votes update their counters in place
+        interval: float - Seconds between flushes
+        batch_size: int - Maximum targets per UNWIND write
+
+        Usage:
+            VOTE_BUFFER.Add("Post", uuid, votes=1, likes=1, dislikes=0)
+            post = Post(**VOTE_BUFFER.Apply("Post", record["post"]))
+    """
+
+    def __init__(self, enabled: bool = False, interval: float = 1.0,
+                 batch_size: int = 1000):
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        # label -> UUID -> [votes, likes, dislikes]
+        self.pending = {label: {} for label in LABELS}
+        # Deltas taken by a flush that is still being written
+        self.flushing = {label: {} for label in LABELS}
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def Add(self, label: str, uuid: str, votes: int, likes: int,
+            dislikes: int):
+        """Add - Buffers a counter delta for one target.
+        """
+        if not (votes or likes or dislikes):
+            return
+        delta = self.pending[label].setdefault(uuid, [0, 0, 0])
+        delta[0] += votes
+        delta[1] += likes
+        delta[2] += dislikes
+
+    def Pending(self, label: str, uuid: str):
+        """Pending - Returns the unflushed (votes, likes, dislikes) of a target.
+        """
+        out = [0, 0, 0]
+        for deltas in (self.pending[label], self.flushing[label]):
+            if uuid in deltas:
+                out = [a + b for a, b in zip(out, deltas[uuid])]
+        return out
+
+    def Apply(self, label: str, props: dict):
+        """Apply - Adds pending deltas to a target's properties, in place.
+        """
+        if props and self.enabled and "UUID" in props:
+            votes, likes, dislikes = self.Pending(label, props["UUID"])
+            if votes or likes or dislikes:
+                props["Votes"] = (props.get("Votes") or 0) + votes
+                props["Likes"] = (props.get("Likes") or 0) + likes
+                props["Dislikes"] = (props.get("Dislikes") or 0) + dislikes
+        return props
+
+    async def Flush(self, db):
+        """Flush - Writes every pending delta in batched UNWIND writes.
+            db: Database - settings.DB
+
+        Cached reads of the written targets are dropped, as they no longer
+        add up with the pending deltas. Deltas that fail to write are put
+        back and retried next flush.
+        """
+        async with self.lock:
+            flushed = 0
+            for label in LABELS:
+                self.flushing[label] = self.pending[label]
+                self.pending[label] = {}
+                deltas = [{"uuid": uuid, "votes": d[0], "likes": d[1],
+                           "dislikes": d[2]}
+                          for uuid, d in sorted(self.flushing[label].items())]
+                try:
+                    for i in range(0, len(deltas), self.batch_size):
+                        batch = deltas[i:i + self.batch_size]
+                        await db.Write(f"Apply{label}VoteDeltas",
+                                       {"deltas": batch})
+                        for delta in batch:
+                            del self.flushing[label][delta["uuid"]]
+                        if db.cache is not None:
+                            db.cache.Invalidate(*(f"{label.lower()}:{delta['uuid']}"
+                                                  for delta in batch))
+                        flushed += len(batch)
+                except Exception as e:
+                    LOGGER.error(json.dumps({"Event": "VoteFlushError",
+                                             "Label": label,
+                                             "Error": type(e).__name__}))
+                    for uuid, (votes, likes, dislikes) in self.flushing[label].items():
+                        self.Add(label, uuid, votes, likes, dislikes)
+                finally:
+                    self.flushing[label] = {}
+            return flushed
+
+    async def _Run(self, db):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.Flush(db)
+
+    def Start(self, db):
+        """Start - Starts the periodic flush task on the running loop.
+        """
+        if self.enabled and self.task is None:
+            self.task = asyncio.create_task(self._Run(db))
+
+    async def Stop(self, db):
+        """Stop - Stops the flush task and writes anything still pending.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.Flush(db)
+
+
+class VoteStateCache:
+    """VoteStateCache maps users to their vote on each target they viewed.
+
+    A vote is 1 (like), -1 (dislike) or 0 (none). The vote endpoints
+    write through with Set(), so the cache never lags this process. Votes
+    cast through other workers show up once the user's entry expires.
+
+        max_users: int - Users kept, least recently used dropped first
+        max_targets: int - Targets kept per user
+        ttl: float - Seconds before a user's entry is reloaded
+
+        Usage:
+            states, missing = VOTE_STATES.Get(uid, uuids)
+            VOTE_STATES.Put(uid, missing, fetched)
+    """
+
+    def __init__(self, max_users: int = 10000, max_targets: int = 1000,
+                 ttl: float = 300):
+        self.max_users = max_users
+        self.max_targets = max_targets
+        self.ttl = ttl
+        # uid -> (expires, OrderedDict of UUID -> vote)
+        self.users = OrderedDict()
+
+    def _Entry(self, uid: str, create: bool = False):
+        entry = self.users.get(uid)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.users[uid]
+            entry = None
+        if entry is None and create:
+            entry = (time.monotonic() + self.ttl, OrderedDict())
+            self.users[uid] = entry
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        if entry is not None:
+            self.users.move_to_end(uid)
+        return entry
+
+    def Get(self, uid: str, uuids: list):
+        """Get - Returns ({UUID: vote} for cached targets, [uncached UUIDs]).
+        """
+        entry = self._Entry(uid)
+        if entry is None:
+            return {}, list(uuids)
+        votes = entry[1]
+        states = {uuid: votes[uuid] for uuid in uuids if uuid in votes}
+        return states, [uuid for uuid in uuids if uuid not in votes]
+
+    def Put(self, uid: str, uuids: list, states: dict):
+        """Put - Caches the votes fetched for uuids; targets missing from
+        states were not voted on.
+        """
+        votes = self._Entry(uid, create=True)[1]
+        for uuid in uuids:
+            votes[uuid] = states.get(uuid, 0)
+            votes.move_to_end(uuid)
+        while len(votes) > self.max_targets:
+            votes.popitem(last=False)
+
+    def Set(self, uid: str, uuid: str, vote: int):
+        """Set - Records a vote the user just cast.
+        """
+        self.Put(uid, [uuid], {uuid: vote})
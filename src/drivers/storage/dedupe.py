@@ -0,0 +1,102 @@
+"""storage/dedupe.py
+
+Converts stored files to content-addressed blobs.
+
+Files uploaded without STORAGE_DEDUPE are stored under their UUID.
+DedupeUploads moves them, batch by batch, under their digest in the same
+upload directory: the content is linked to its digest name (unless that
+content is already stored), the File node is attached to its Blob, and
+only then is the UUID name removed. Files keep being served throughout,
+and an interrupted run is resumed by running it again.
+
+RemoveBlob deletes content once nothing refers to it any more.
+"""
+import json
+import logging
+
+LOGGER = logging.getLogger("violethawk.storage")
+
+
+async def DedupeUploads(db, storage, hash_func, batch_size: int = 100):
+    """DedupeUploads - Deduplicates every File not stored as a blob yet
+    and returns how many were checked, deduplicated and missing, and the
+    bytes freed.
+        db: Database - settings.DB
+        storage: StorageDriver - settings.STORAGE_DRIVER
+        hash_func: hashlib constructor - settings.HASH_FUNC
+
+        Usage:
+            summary = await DedupeUploads(settings.DB, settings.STORAGE_DRIVER,
+                                          settings.HASH_FUNC)
+    """
+    summary = {"Checked": 0, "Deduplicated": 0, "Missing": 0,
+               "BytesFreed": 0}
+    after = None
+    while True:
+        res = await db.Read("ListFilesWithoutBlob", {"after": after,
+                                                     "limit": batch_size})
+        for each in res:
+            uid = each["file"]["UUID"]
+            summary["Checked"] += 1
+            try:
+                size, digest = await storage.LinkBlob(uid, hash_func)
+            except FileNotFoundError:
+                # Not stored, or deleted since it was listed
+                summary["Missing"] += 1
+                continue
+            attached = await db.Write("AttachBlob", {"uid": uid,
+                                                     "hash": digest,
+                                                     "size": size})
+            if not attached:
+                # The File was deleted since it was listed; its content
+                # goes unless another File shares it
+                summary["Missing"] += 1
+                await RemoveBlob(db, storage, digest)
+                continue
+            if attached[0]["references"] > 1:
+                summary["Deduplicated"] += 1
+                summary["BytesFreed"] += size
+            try:
+                storage.DeleteFile(uid)
+            except FileNotFoundError:
+                pass  # Deleted meanwhile
+        if len(res) < batch_size:
+            break
+        after = res[-1]["file"]["UUID"]
+    LOGGER.info(json.dumps({"Event": "DedupeUploads", "Summary": summary}))
+    return summary
+
+
+async def RemoveBlob(db, storage, digest: str):
+    """RemoveBlob - Deletes deduplicated content unless a File refers to
+    it again, and returns whether it was deleted.
+
+    The blob is checked and its content removed while holding the blob's
+    write lock: an upload of the same content attaches its File either
+    before, and the content is kept, or after, and finds the content gone
+    (see create_file).
+        db: Database - settings.DB
+        storage: StorageDriver - settings.STORAGE_DRIVER
+
+        Usage:
+            db.AfterCommit(lambda: RemoveBlob(settings.DB,
+                                              settings.STORAGE_DRIVER, digest))
+    """
+    uow = db.Session()
+    try:
+        res = await uow.Write("LockBlob", {"hash": digest})
+        if res and res[0]["references"] > 0:
+            return False
+        try:
+            storage.DeleteFile(digest)
+        except FileNotFoundError:
+            pass
+        await uow.Write("DeleteUnusedBlob", {"hash": digest})
+        await uow.Commit()
+    except Exception as e:
+        LOGGER.error(json.dumps({"Event": "RemoveBlobError", "Hash": digest,
+                                 "Error": type(e).__name__}))
+        return False
+    finally:
+        await uow.Close()
+    return True
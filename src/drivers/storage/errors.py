@@ -5,6 +5,7 @@ __all__ = (
     'UnauthorizedFileType',
     'UploadNotAllowed',
     'OperationNotSupported',
+    'FileTooLarge',
 )
 
 
@@ -35,4 +36,9 @@ class FileNotFound(FSError):
 
 class OperationNotSupported(FSError):
     '''Raised when trying to perform an operation not supported by the current backend'''
-    pass
\ No newline at end of file
+    pass
+
+
+class FileTooLarge(FSError):
+    '''Raised when an upload is larger than the allowed size'''
+    pass
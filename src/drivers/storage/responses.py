@@ -0,0 +1,316 @@
+"""storage/responses.py
+
+Download responses for stored files.
+
+StoredFileResponse answers conditional requests (If-None-Match,
+If-Modified-Since) with 304, byte ranges (Range, If-Range) with 206 -
+multipart/byteranges when several are asked for - and unsatisfiable
+ones with 416. The body is handed to the server with the ASGI zero-copy
+send extension when it offers one, so the kernel copies the file to the
+socket (sendfile); otherwise it is read in chunks off the event loop.
+
+OffloadedFileResponse leaves sending the file to a fronting proxy
+instead (X-Accel-Redirect, X-Sendfile; see STORAGE_OFFLOAD).
+"""
+import asyncio
+import os
+import secrets
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+
+# Ranges honoured per request; more are answered with the whole file
+MAX_RANGES = 16
+
+
+def ParseRange(header: str, size: int):
+    """ParseRange - Returns the (start, end) byte ranges, end inclusive,
+    of a Range header. None means the header is ignored and the whole
+    file is sent; an empty list means no range is satisfiable.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = []
+    for spec in header[len("bytes="):].split(","):
+        start, sep, end = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if start:
+                start = int(start)
+                end = int(end) if end else max(start, size - 1)
+            else:
+                # Suffix range: the last n bytes
+                length = int(end)
+                start, end = max(size - length, 0), size - 1
+                if length == 0:
+                    continue
+        except ValueError:
+            return None
+        if start < 0 or end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def _Tags(header: str):
+    """_Tags - Entity tags of an If-None-Match header, without W/."""
+    return {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+class StoredFileResponse(Response):
+    """StoredFileResponse serves a stored file with range and conditional
+    request support.
+
+        path: str - File on disk
+        filename: str - Download name for Content-Disposition
+        media_type: str - Content-Type
+        etag: str - Content hash (File.Hash); a weak tag from size and
+                    modification time is used without one
+        cache_control: str - Cache-Control header
+
+        Usage:
+            return StoredFileResponse(path, filename=f.Filename,
+                                      etag=f.Hash, media_type=f.Type)
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: str, filename: str = None,
+                 media_type: str = None, etag: str = None,
+                 cache_control: str = None):
+        self.path = path
+        self.filename = filename
+        self.media_type = media_type or "application/octet-stream"
+        self.etag = f'"{etag}"' if etag else None
+        self.cache_control = cache_control
+        self.status_code = 200
+        self.background = None
+        self.body = b""
+        self.raw_headers = []
+
+    def _Headers(self, st):
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": self.etag or f'W/"{st.st_size:x}-{int(st.st_mtime):x}"',
+            "last-modified": formatdate(st.st_mtime, usegmt=True),
+        }
+        if self.cache_control:
+            headers["cache-control"] = self.cache_control
+        if self.filename:
+            quoted = quote(self.filename)
+            if quoted != self.filename:
+                headers["content-disposition"] = f"attachment; filename*=utf-8''{quoted}"
+            else:
+                headers["content-disposition"] = f'attachment; filename="{self.filename}"'
+        return headers
+
+    def _NotModified(self, request: Headers, headers: dict, st):
+        if "if-none-match" in request:
+            tags = _Tags(request["if-none-match"])
+            return "*" in tags or headers["etag"].removeprefix("W/") in tags
+        if "if-modified-since" in request:
+            try:
+                since = parsedate_to_datetime(request["if-modified-since"])
+            except (TypeError, ValueError):
+                return False
+            return int(st.st_mtime) <= since.timestamp()
+        return False
+
+    def _RangeAllowed(self, request: Headers, headers: dict, st):
+        """_RangeAllowed - Whether If-Range (if any) still matches, i.e.
+        the client's partial copy is of the current content.
+        """
+        condition = request.get("if-range")
+        if not condition:
+            return True
+        if condition.startswith('"') or condition.startswith("W/"):
+            # Strong comparison: weak tags never match
+            return self.etag is not None and condition == self.etag
+        try:
+            return parsedate_to_datetime(condition).timestamp() >= int(st.st_mtime)
+        except (TypeError, ValueError):
+            return False
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        request = Headers(scope=scope)
+        try:
+            st = await loop.run_in_executor(None, os.stat, self.path)
+        except FileNotFoundError:
+            await self._Send(send, 404, {})
+            return
+        if not stat.S_ISREG(st.st_mode):
+            await self._Send(send, 404, {})
+            return
+        size = st.st_size
+        headers = self._Headers(st)
+        head = scope.get("method") == "HEAD"
+
+        if self._NotModified(request, headers, st):
+            await self._Send(send, 304, headers)
+            return
+
+        ranges = None
+        if self._RangeAllowed(request, headers, st):
+            ranges = ParseRange(request.get("range"), size)
+        if ranges == []:
+            headers["content-range"] = f"bytes */{size}"
+            await self._Send(send, 416, headers)
+            return
+
+        if ranges is None:
+            headers["content-type"] = self.media_type
+            await self._SendFile(scope, send, 200, headers, [(0, size - 1)],
+                                 size, head)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            headers["content-type"] = self.media_type
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            await self._SendFile(scope, send, 206, headers, ranges, size,
+                                 head)
+        else:
+            await self._SendParts(scope, send, headers, ranges, size, head)
+
+    def _Start(self, status_code: int, headers: dict):
+        raw = [(k.encode("latin-1"), v.encode("latin-1"))
+               for k, v in headers.items()]
+        # e.g. cookies set on the response by the endpoint
+        return {"type": "http.response.start", "status": status_code,
+                "headers": raw + self.raw_headers}
+
+    async def _Send(self, send, status_code: int, headers: dict):
+        """_Send - Sends a response without a body."""
+        if status_code != 304:
+            headers = dict(headers, **{"content-length": "0"})
+        await send(self._Start(status_code, headers))
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _SendFile(self, scope, send, status_code: int, headers: dict,
+                        ranges: list, size: int, head: bool):
+        start, end = ranges[0]
+        length = end - start + 1 if size else 0
+        headers["content-length"] = str(length)
+        await send(self._Start(status_code, headers))
+        if head or not length:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        extensions = scope.get("extensions") or {}
+        if "http.response.pathsend" in extensions and status_code == 200:
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+        await self._SendRange(send, extensions, start, length, last=True)
+
+    async def _SendParts(self, scope, send, headers: dict, ranges: list,
+                         size: int, head: bool):
+        boundary = secrets.token_hex(16)
+        parts = []
+        for start, end in ranges:
+            parts.append((f"--{boundary}\r\n"
+                          f"Content-Type: {self.media_type}\r\n"
+                          f"Content-Range: bytes {start}-{end}/{size}\r\n"
+                          "\r\n").encode("latin-1"))
+        closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        length = (sum(len(p) for p in parts) + 2 * (len(parts) - 1)
+                  + sum(end - start + 1 for start, end in ranges)
+                  + len(closing))
+        headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["content-length"] = str(length)
+        await send(self._Start(206, headers))
+        if head:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        extensions = scope.get("extensions") or {}
+        for i, (start, end) in enumerate(ranges):
+            prefix = (b"\r\n" if i else b"") + parts[i]
+            await send({"type": "http.response.body", "body": prefix,
+                        "more_body": True})
+            await self._SendRange(send, extensions, start, end - start + 1,
+                                  last=False)
+        await send({"type": "http.response.body", "body": closing})
+
+    async def _SendRange(self, send, extensions: dict, offset: int,
+                         count: int, last: bool):
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, self.path, "rb")
+        try:
+            if "http.response.zerocopysend" in extensions:
+                await send({"type": "http.response.zerocopysend", "file": f,
+                            "offset": offset, "count": count,
+                            "more_body": not last})
+                return
+            await loop.run_in_executor(None, f.seek, offset)
+            while count > 0:
+                chunk = await loop.run_in_executor(
+                    None, f.read, min(self.chunk_size, count))
+                if not chunk:
+                    # Truncated meanwhile; end the (short) response
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk,
+                            "more_body": count > 0 or not last})
+        finally:
+            f.close()
+
+
+class OffloadedFileResponse(StoredFileResponse):
+    """OffloadedFileResponse hands a stored file to a fronting proxy:
+    the response carries no body, only a header naming the file, and the
+    proxy (nginx, lighttpd, Apache) streams it - ranges included.
+    Conditional requests are still answered here, without a redirect.
+
+        target: str - Value of the header, see StorageDriver.Offload
+        header: str - "X-Accel-Redirect" (nginx) or "X-Sendfile"
+
+        Usage:
+            return OffloadedFileResponse(path, "/_uploads/3f/a2/name",
+                                         "X-Accel-Redirect", etag=f.Hash)
+    """
+
+    def __init__(self, path: str, target: str, header: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self.target = target
+        self.header = header.lower()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            st = await asyncio.get_running_loop().run_in_executor(
+                None, os.stat, self.path)
+        except FileNotFoundError:
+            await self._Send(send, 404, {})
+            return
+        headers = self._Headers(st)
+        if self._NotModified(Headers(scope=scope), headers, st):
+            await self._Send(send, 304, headers)
+            return
+        headers["content-type"] = self.media_type
+        headers[self.header] = self.target
+        await self._Send(send, 200, headers)
+
+
+class DownloadGZipMiddleware(GZipMiddleware):
+    """DownloadGZipMiddleware is GZipMiddleware that leaves file downloads
+    alone: media is compressed already, compressing it again costs CPU
+    on every request and breaks byte ranges and zero-copy sends.
+
+        exclude: list - Path prefixes passed through unchanged
+    """
+
+    def __init__(self, app, minimum_size: int = 500, exclude: list = (),
+                 **kwargs):
+        super().__init__(app, minimum_size=minimum_size, **kwargs)
+        self.exclude = tuple(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.exclude):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
@@ -1,51 +1,233 @@
 import os
 import os.path
-import shutil
-from fastapi.responses import FileResponse
+import asyncio
+import hashlib
+import secrets
+from urllib.parse import quote
+from drivers.storage.responses import StoredFileResponse, OffloadedFileResponse
 from drivers.storage.utils import secure_filename
-from drivers.storage.errors import FileExists
+from drivers.storage.errors import FileExists, FileTooLarge
+
+# Header a fronting proxy serves the named file from, per offload mode
+OFFLOAD_HEADERS = {
+    "x-accel-redirect": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile",
+}
 
 class StorageDriver:
-    def __init__(self, UPLOAD_DIR):
+    def __init__(self, UPLOAD_DIR, chunk_size=2**20, fsync=True,
+                 dedupe=False, shard_depth=2, offload=None,
+                 offload_path=None):
+        if offload and offload not in OFFLOAD_HEADERS:
+            raise ValueError(f"Unknown download offload mode: {offload}")
         self.name = "LOCAL DRIVER"
         self.upload_dir = UPLOAD_DIR
-        
+        # Let a fronting proxy send downloads (see Offload)
+        self.offload = offload
+        self.offload_path = offload_path
+        # Levels of two hex digit directories files are spread over
+        # (see Path), 0 keeps every file in upload_dir
+        self.shard_depth = shard_depth
+        # Bytes read, hashed and written per step of an upload
+        self.chunk_size = chunk_size
+        # Flush uploads to disk before they become visible
+        self.fsync = fsync
+        # Store content once, named by its digest (see WriteFile)
+        self.dedupe = dedupe
+
+    def Path(self, filename):
+        """Returns where a file is stored: under directories named by the
+        leading hex digits of the md5 of its name, e.g. uploads/3f/a2/name,
+        so no directory grows past a few thousand entries.
+        """
+        if not self.shard_depth:
+            return os.path.join(self.upload_dir, filename)
+        prefix = hashlib.md5(filename.encode(), usedforsecurity=False).hexdigest()
+        shards = [prefix[2 * i:2 * i + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.upload_dir, *shards, filename)
+
+    def Locate(self, filename):
+        """Returns the path of an existing file, or None. Files not moved
+        out of the flat layout yet (see Reshard) are found too.
+        """
+        for fpath in (self.Path(filename),
+                      os.path.join(self.upload_dir, filename)):
+            if os.path.exists(fpath):
+                return fpath
+        return None
+
     def Exists(self, filename):
         """Checks if a file exists.
 
         Overridden by backends.
         """
         filename = secure_filename(filename)
-        return os.path.exists(os.path.join(self.upload_dir, filename))
+        return self.Locate(filename) is not None
 
-    async def WriteFile(self, filename, file, overwrite=False):
+    async def WriteFile(self, filename, file, overwrite=False,
+                        max_bytes=None, hash_func=None):
         """Write content to a file.
 
+        The upload is read once, in chunk_size pieces, on a worker thread:
+        each chunk is size-checked, hashed and written to a temporary file
+        that is renamed into place once complete, so a failed or oversized
+        upload never leaves a partial file behind.
+
         :param str filename: The storage root-relative filename
-        :param file: The file-like object to write in the file
+        :param file: The UploadFile (or file-like object) to write in the file
         :param bool overwrite: Whether to allow overwrite or not
+        :param int max_bytes: Largest allowed size, None for no limit
+        :param hash_func: hashlib constructor to digest the content with
         :raises FileExists: If the file exists and `overwrite` is `False`
+        :raises FileTooLarge: If the file is larger than `max_bytes`
+        :returns: (size in bytes, hex digest or None)
+
+        With `dedupe` set the content is stored under its digest instead
+        of `filename` (`hash_func` is required) and content already stored
+        is not written twice.
 
         Overridden by backends.
         """
+        if self.dedupe and hash_func is None:
+            raise ValueError("Deduplicating storage requires a hash_func.")
         if not overwrite and self.Exists(filename):
             raise FileExists()
         filename = secure_filename(filename)
-        fpath = os.path.join(self.upload_dir, filename)
-        with open(fpath, "wb") as f:
-            shutil.copyfileobj(file.file, f)
+        source = getattr(file, "file", file)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._Write, filename, source, overwrite, max_bytes,
+            hash_func)
+
+    def _Write(self, filename, source, overwrite, max_bytes, hash_func):
+        fpath = self.Path(filename)
+        tmp = os.path.join(self.upload_dir,
+                           f".{filename}.{secrets.token_hex(4)}.part")
+        digest = hash_func() if hash_func else None
+        size = 0
+        source.seek(0)
+        try:
+            with open(tmp, "wb") as f:
+                while True:
+                    chunk = source.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise FileTooLarge(filename)
+                    if digest:
+                        digest.update(chunk)
+                    f.write(chunk)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if self.dedupe:
+                fpath = self.Path(digest.hexdigest())
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            if self.dedupe:
+                try:
+                    os.link(tmp, fpath)
+                except FileExistsError:
+                    pass  # Same content already stored
+                os.remove(tmp)
+            elif overwrite:
+                os.replace(tmp, fpath)
+            else:
+                # Fails instead of replacing a file written meanwhile
+                try:
+                    os.link(tmp, fpath)
+                except FileExistsError:
+                    raise FileExists() from None
+                os.remove(tmp)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self.fsync:
+            self._SyncDir(os.path.dirname(fpath))
+        return size, digest.hexdigest() if digest else None
 
-    def ReadFile(self, filename, db_name=None):
+    async def LinkBlob(self, filename, hash_func):
+        """Stores an existing file under its digest as well, unless that
+        content is already stored. Used to deduplicate files written
+        before `dedupe` was turned on; remove `filename` once nothing
+        refers to it.
+
+        :returns: (size in bytes, hex digest)
+        """
+        filename = secure_filename(filename)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._LinkBlob, filename, hash_func)
+
+    def _LinkBlob(self, filename, hash_func):
+        fpath = self.Locate(filename)
+        if fpath is None:
+            raise FileNotFoundError(filename)
+        digest = hash_func()
+        size = 0
+        with open(fpath, "rb") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                digest.update(chunk)
+        target = self.Path(digest.hexdigest())
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(fpath, target)
+        except FileExistsError:
+            pass
+        else:
+            if self.fsync:
+                self._SyncDir(os.path.dirname(target))
+        return size, digest.hexdigest()
+
+    def _SyncDir(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def ReadFile(self, filename, db_name=None, media_type=None, etag=None,
+                 cache_control=None):
         """Reads a file from the local storage.
 
+        :param str db_name: Download name of the file
+        :param str etag: Content hash used as the strong ETag
+        :returns: StoredFileResponse, which handles Range and conditional
+                  requests itself
+
         Overridden by backends
         """
         filename = secure_filename(filename)
-        fpath = os.path.join(self.upload_dir, filename)
-        if not self.Exists(filename):
+        fpath = self.Locate(filename)
+        if fpath is None:
             raise FileNotFoundError(filename)
-        res = FileResponse(fpath, filename=db_name)
-        return res
+        if self.offload:
+            return OffloadedFileResponse(fpath, self.Offload(fpath),
+                                         OFFLOAD_HEADERS[self.offload],
+                                         filename=db_name,
+                                         media_type=media_type, etag=etag,
+                                         cache_control=cache_control)
+        return StoredFileResponse(fpath, filename=db_name,
+                                  media_type=media_type, etag=etag,
+                                  cache_control=cache_control)
+
+    def Offload(self, fpath):
+        """Maps a stored file to what the proxy is told to send.
+
+        "x-accel-redirect": a URI under offload_path, an internal nginx
+        location aliased to the upload directory, e.g.
+            location /_uploads/ { internal; alias /srv/violethawk/uploads/; }
+        "x-sendfile": the file's path as the proxy sees it, offload_path
+        standing for the upload directory (defaults to its absolute path).
+        """
+        rel = os.path.relpath(fpath, self.upload_dir).replace(os.sep, "/")
+        if self.offload == "x-accel-redirect":
+            return (self.offload_path or "/_uploads").rstrip("/") + "/" + quote(rel)
+        root = self.offload_path or os.path.abspath(self.upload_dir)
+        return os.path.join(root, *rel.split("/"))
 
     def DeleteFile(self, filename):
         """Deletes a given file in the local storage.
@@ -53,14 +235,87 @@ class StorageDriver:
         Overridden by backends.
         """
         filename = secure_filename(filename)
-        path = os.path.join(self.upload_dir, filename)
-        if not self.Exists(filename):
-            raise FileNotFoundError(path)
-        os.remove(path)
+        if self.Locate(filename) is None:
+            raise FileNotFoundError(filename)
+        # Mid-Reshard a file can be stored under both paths. The flat one
+        # goes first: Reshard cannot link it once it is gone, and a link
+        # made before that is removed with the sharded path.
+        for path in dict.fromkeys((os.path.join(self.upload_dir, filename),
+                                   self.Path(filename))):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
-    def ListFiles(self):
-        """Lists all the files in the local storage.
+    def ListFiles(self, after=None):
+        """Lists all the files in the local storage, one directory at a
+        time, in sorted order.
+
+        Yields each file's path relative to the upload directory; pass the
+        last one as `after` to resume listing after it. Uploads still in
+        progress (see WriteFile) are skipped.
 
         Overridden by backends.
         """
-        return os.listdir(self.upload_dir)
\ No newline at end of file
+        after = tuple(after.split("/")) if after else None
+        yield from self._List(self.upload_dir, (), after)
+
+    def _List(self, path, prefix, after):
+        with os.scandir(path) as it:
+            entries = sorted((entry.name, entry.is_dir()) for entry in it
+                             if not entry.name.startswith("."))
+        for name, isDir in entries:
+            key = prefix + (name,)
+            if after is not None and key < after[:len(key)]:
+                continue
+            if isDir:
+                # Only the directory holding the cursor is resumed midway
+                inside = after if after is not None and \
+                    key == after[:len(key)] else None
+                yield from self._List(os.path.join(path, name), key, inside)
+            elif after is None or key > after:
+                yield "/".join(key)
+
+    def Reshard(self, batch_size=10000):
+        """Moves files from the flat layout into their shard directories
+        while the server keeps running, and returns how many were moved
+        and how many were deleted before they could be.
+
+        Each batch is first linked at its new path, then removed from the
+        old one, so readers that located a file a moment earlier can still
+        open it.
+        """
+        summary = {"Moved": 0, "Missing": 0}
+        batch = []
+        for rel in self.ListFiles():
+            name = os.path.basename(rel)
+            source = os.path.join(self.upload_dir, rel)
+            if source != self.Path(name):
+                batch.append((source, self.Path(name)))
+            if len(batch) >= batch_size:
+                self._Move(batch, summary)
+                batch = []
+        self._Move(batch, summary)
+        return summary
+
+    def _Move(self, batch, summary):
+        linked = []
+        for source, target in batch:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(source, target)
+            except FileExistsError:
+                pass  # Linked by an earlier, interrupted run
+            except FileNotFoundError:
+                summary["Missing"] += 1  # Deleted since it was listed
+                continue
+            linked.append((source, target))
+        if self.fsync:
+            for directory in {os.path.dirname(t) for _, t in linked}:
+                self._SyncDir(directory)
+        for source, _ in linked:
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass  # Deleted meanwhile
+        summary["Moved"] += len(linked)
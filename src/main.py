@@ -5,6 +5,8 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from config import settings
 from config.routes import ImportRoutes
+from drivers.auth.middleware import RenewedCookieMiddleware
+from drivers.database.schema import Migrate
 
 # Setup application
 app = FastAPI(
@@ -18,7 +20,7 @@ app = FastAPI(
 
 # Mount static files
 app.mount(settings.STATIC_ROUTE,
-          StaticFiles(directory=settings.STATIC_DIR),
+          StaticFiles(directory=settings.STATIC_DIR, check_dir=False),
           name="static")
 
 # Load middleware
@@ -29,5 +31,27 @@ for ware in settings.MIDDLEWARE:
         **ware
     )
 
+# Send auth cookies renewed from a refresh token while serving a page
+app.add_middleware(RenewedCookieMiddleware)
+
 # Include routes
-ImportRoutes(app)
\ No newline at end of file
+ImportRoutes(app)
+
+# Bootstrap constraints & indexes on startup
+@app.on_event("startup")
+async def migrate_database():
+    if settings.DATABASE_MIGRATE_ON_STARTUP:
+        await Migrate(settings.DB)
+
+# Flush buffered vote counters in the background
+@app.on_event("startup")
+async def start_vote_buffer():
+    settings.VOTE_BUFFER.Start(settings.DB)
+
+# Close pooled database connections on shutdown
+@app.on_event("shutdown")
+async def close_database():
+    await settings.VOTE_BUFFER.Stop(settings.DB)
+    await settings.TIMELINES.Drain()
+    await settings.DB.Close()
+    settings.PASSWORD_HASHER.Close()
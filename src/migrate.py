@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+"""migrate.py
+
+Handy script for applying database schema migrations.
+
+usage:
+    ./migrate.py                # Apply every pending migration
+    ./migrate.py --target 2     # Apply pending migrations up to version 2
+    ./migrate.py --status       # Show applied and pending migrations
+
+"""
+import argparse
+import asyncio
+from config import settings
+from drivers.database.schema import MIGRATIONS, GetAppliedMigrations, Migrate
+
+
+async def main(args):
+    try:
+        if args.status:
+            done = await GetAppliedMigrations(settings.DB)
+            for version, description, _ in MIGRATIONS:
+                state = "applied" if version in done else "pending"
+                print(f"{version:>4}  {state:<8} {description}")
+        else:
+            applied = await Migrate(settings.DB, target=args.target)
+            if applied:
+                print("Applied migrations: " + ", ".join(map(str, applied)))
+            else:
+                print("Schema is up to date.")
+    finally:
+        await settings.DB.Close()
+
+if __name__ in '__main__':
+    parser = argparse.ArgumentParser(description="VioletHawk schema migrations")
+    parser.add_argument("--target", type=int, default=None,
+                        help="Last migration version to apply")
+    parser.add_argument("--status", action="store_true",
+                        help="List applied and pending migrations")
+    asyncio.run(main(parser.parse_args()))
@@ -11,6 +11,13 @@ class Token(BaseModel):
     """
     access_token: str
     token_type: str
+    refresh_token: Optional[str]=None
+
+class RefreshRequest(BaseModel):
+    """RefreshRequest carries a refresh token issued alongside
+    an access token.
+    """
+    refresh_token: str
 
 class TokenData(BaseModel):
     """TokeData contains information about the token that
@@ -18,4 +25,13 @@ class TokenData(BaseModel):
     """
     UUID: Optional[str]=None
     IP: Optional[str]=None
+    # Authorization claims, see drivers.auth.utils.TokenClaims
+    Name: Optional[str]=None
+    Email: Optional[str]=None
+    Admin: Optional[bool]=None
+    Disabled: Optional[bool]=None
+    Banned: Optional[bool]=None
+    Blocked: Optional[List[str]]=None
+    Ver: Optional[int]=None
+    iat: Optional[int]=None
     # Add other stuff for browser fingerprinting as we implement it
\ No newline at end of file
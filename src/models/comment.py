@@ -16,5 +16,18 @@ class Comment(BaseModel):
     # Metadata
     Creator: Optional[str] = None
     Votes: Optional[int] = 0
+    Likes: Optional[int] = 0
+    Dislikes: Optional[int] = 0
     Created: Optional[datetime] = datetime.now(settings.TIMEZONE)
 
+    # Temporary fields (not saved to DB)
+    LIKED: Optional[bool] = None
+    DISLIKED: Optional[bool] = None
+
+
+class CommentPage(BaseModel):
+    """CommentPage is one page of comments. Pass Next as cursor to get the
+    following page; it is None on the last page.
+    """
+    Comments: List[Comment] = []
+    Next: Optional[str] = None
@@ -3,7 +3,7 @@
 This file contains the File models for the
 VioletHawk platform.
 """
-from typing import Optional
+from typing import Optional, List
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -16,6 +16,8 @@ class File(BaseModel):
     Type: str
     SizeBytes: int
     Hash: Optional[str] = None
+    # Digest the content is stored under, when deduplicated
+    Blob: Optional[str] = None
     Description: Optional[str] = None
 
     # User Metadata
@@ -24,4 +26,12 @@ class File(BaseModel):
 
     # Datetime Metadata
     CreatedDate: Optional[datetime] = None
-    ModifiedDate: Optional[datetime] = None
\ No newline at end of file
+    ModifiedDate: Optional[datetime] = None
+
+
+class FilePage(BaseModel):
+    """FilePage is one page of files. Pass Next as cursor to get the
+    following page; it is None on the last page.
+    """
+    Files: List[File] = []
+    Next: Optional[str] = None
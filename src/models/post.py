@@ -28,7 +28,19 @@ class Post(BaseModel):
     # Metadata
     Keywords: Optional[List[str]] = None
     Votes: Optional[int] = 0
+    Likes: Optional[int] = 0
+    Dislikes: Optional[int] = 0
+    CommentCount: Optional[int] = 0
 
     # Temporary fields (not saved to DB)
+    Sub: Optional[str] = None  # Set on home feed posts
     LIKED: Optional[bool] = None
-    DISLIKED: Optional[bool] = None
\ No newline at end of file
+    DISLIKED: Optional[bool] = None
+
+
+class PostPage(BaseModel):
+    """PostPage is one page of posts. Pass Next as cursor to get the
+    following page; it is None on the last page.
+    """
+    Posts: List[Post] = []
+    Next: Optional[str] = None
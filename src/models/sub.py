@@ -24,5 +24,13 @@ class Sub(BaseModel):
     # Metadata
     CreatedDate: Optional[datetime] = datetime.now(settings.TIMEZONE)
     Subscribers: Optional[int] = 0
+    PostCount: Optional[int] = 0
     Keywords: Optional[List[str]] = None
 
+
+class SubPage(BaseModel):
+    """SubPage is one page of subs. Pass Next as cursor to get the
+    following page; it is None on the last page.
+    """
+    Subs: List[Sub] = []
+    Next: Optional[str] = None
@@ -22,6 +22,8 @@ class User(BaseModel):
     Private: Optional[bool] = False
     Disabled: Optional[bool] = False
     Banned: Optional[bool] = False
+    # Bumped on every change, see drivers.auth.utils.ClaimsUser
+    SecurityVersion: Optional[int] = 0
 
     # Metadata
     JoinDate: Optional[datetime] = datetime.now(settings.TIMEZONE)
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+"""reshard.py
+
+Handy script for moving uploads stored in one flat directory into the
+sharded layout (see STORAGE_SHARD_DEPTH). Safe to run while the server
+is up, and to run again after an interruption.
+
+usage:
+    ./reshard.py                    # Move every flat upload
+    ./reshard.py --batch-size 1000  # Files linked before their old names go
+
+"""
+import argparse
+from config import settings
+
+if __name__ in '__main__':
+    parser = argparse.ArgumentParser(description="VioletHawk upload resharding")
+    parser.add_argument("--batch-size", type=int, default=10000,
+                        help="Files linked before their old names are removed")
+    args = parser.parse_args()
+    summary = settings.STORAGE_DRIVER.Reshard(batch_size=args.batch_size)
+    print(f"Moved {summary['Moved']} files into {settings.STORAGE_SHARD_DEPTH} "
+          f"level shard directories, {summary['Missing']} were deleted "
+          f"meanwhile.")
@@ -0,0 +1,99 @@
+"""tests/conftest.py
+
+Runs the app on the in-memory graph (DATABASE_BACKEND=memory), so the
+suite needs no Neo4j server. Each test starts from an empty graph, cache
+and upload directory.
+
+    Usage:
+        cd src && python -m pytest -q
+"""
+import os
+import sys
+import uuid
+
+os.environ["DATABASE_BACKEND"] = "memory"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+from config import settings
+from drivers.database.memory import MemoryGraph
+from main import app
+
+PASSWORD = "Violet#Hawk7"
+
+# The lowest bcrypt cost keeps signing users up fast
+settings.PWD_CONTEXT.update(bcrypt__rounds=4)
+
+
+@pytest.fixture(autouse=True)
+def graph(tmp_path):
+    settings.DB.graph = MemoryGraph()
+    if settings.DB.cache is not None:
+        settings.DB.cache.Clear()
+    settings.RANKINGS.subs.clear()
+    settings.RANKINGS.postSub.clear()
+    settings.STORAGE_DRIVER.upload_dir = str(tmp_path)
+    return settings.DB.graph
+
+
+@pytest.fixture(scope="session")
+def app_client():
+    with TestClient(app, base_url="http://localhost") as client:
+        yield client
+
+
+@pytest.fixture
+def client(app_client):
+    app_client.cookies.clear()
+    return app_client
+
+
+@pytest.fixture
+def register(client, graph):
+    """Returns Register(admin=False), which signs a new user up and in
+    and returns {"UUID", "Email", "Headers", "Access", "Refresh"}.
+    """
+    def Register(admin: bool = False):
+        email = f"{uuid.uuid4().hex[:12]}@violethawk.test"
+        res = client.post(settings.AUTH_ENDPOINT + "/register",
+                          json={"screenName": email.split("@")[0],
+                                "email": email, "password": PASSWORD})
+        assert res.status_code == 200, res.text
+        uid = res.json()["UUID"]
+        if admin:
+            graph.Set(graph.One("User", "UUID", uid), {"Admin": True})
+        res = client.post(settings.TOKEN_ENDPOINT,
+                          data={"username": email, "password": PASSWORD})
+        assert res.status_code == 200, res.text
+        tokens = res.json()
+        return {"UUID": uid, "Email": email,
+                "Headers": {"Authorization": f"Bearer {tokens['access_token']}"},
+                "Access": tokens["access_token"],
+                "Refresh": tokens["refresh_token"]}
+    return Register
+
+
+def CreateSub(client, user: dict, title: str = None):
+    title = title or f"sub{uuid.uuid4().hex[:8]}"
+    res = client.post("/api/v/create", headers=user["Headers"],
+                      params={"title": title, "headline": "Headline"})
+    assert res.status_code == 200, res.text
+    return res.json()
+
+
+def CreatePost(client, user: dict, sub: str, title: str = None,
+               published: bool = True):
+    res = client.post("/api/post/create", headers=user["Headers"],
+                      params={"title": title or f"post{uuid.uuid4().hex[:8]}",
+                              "content": "Content", "subTitle": sub,
+                              "published": published})
+    assert res.status_code == 200, res.text
+    return res.json()
+
+
+def CreateComment(client, user: dict, on: str, message: str = "Comment"):
+    res = client.post("/api/comment/create", headers=user["Headers"],
+                      params={"message": message, "commentOn": on})
+    assert res.status_code == 200, res.text
+    return res.json()
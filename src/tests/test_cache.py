@@ -0,0 +1,223 @@
+"""tests/test_cache.py
+
+Every mutation drops the cached query results it changes: each test
+warms the cache through the API, mutates, and reads again.
+"""
+import asyncio
+
+import pytest
+from config import settings
+from tests.conftest import CreateSub, CreatePost, CreateComment
+
+
+def ReadSub(client, title: str):
+    res = client.post("/api/v/read/", params={"title": title})
+    return res.json() if res.status_code == 200 else None
+
+
+def ListSubs(client):
+    return [sub["Title"] for sub in client.get("/api/v/list/subs").json()["Subs"]]
+
+
+def ReadPost(client, uid: str = None, title: str = None):
+    return client.get("/api/post/read", params={"UUID": uid, "title": title}).json()
+
+
+def ReadComment(client, uid: str):
+    return client.get(f"/api/comment/read/{uid}").json()["Comment"]
+
+
+def ListComments(client, uid: str):
+    return {comment["UUID"]: comment["Message"] for comment in
+            client.get(f"/api/comment/list/{uid}").json()["Comments"]}
+
+
+@pytest.fixture
+def world(client, register):
+    owner = register()
+    sub = CreateSub(client, owner)
+    post = CreatePost(client, owner, sub["Title"])
+    comment = CreateComment(client, owner, post["UUID"])
+    return {"owner": owner, "sub": sub["Title"], "post": post,
+            "comment": comment["UUID"]}
+
+
+def test_reads_are_served_from_the_cache(client, world, graph):
+    assert ReadSub(client, world["sub"])["Headline"] == "Headline"
+    # Changed behind the cache's back, so the cached result is served
+    graph.Set(graph.One("Sub", "Title", world["sub"]), {"Headline": "Stale"})
+    hits = settings.DB.cache.hits
+    assert ReadSub(client, world["sub"])["Headline"] == "Headline"
+    assert settings.DB.cache.hits == hits + 1
+
+
+def test_create_sub(client, world):
+    assert ListSubs(client) == [world["sub"]]
+    title = CreateSub(client, world["owner"])["Title"]
+    assert title in ListSubs(client)
+
+
+def test_update_sub(client, world):
+    ListSubs(client)
+    ReadSub(client, world["sub"])
+    res = client.put(f"/api/v/update/{world['sub']}",
+                     headers=world["owner"]["Headers"],
+                     json={"Headline": "Updated"})
+    assert res.status_code == 200, res.text
+    assert ReadSub(client, world["sub"])["Headline"] == "Updated"
+    assert client.get("/api/v/list/subs").json()["Subs"][0]["Headline"] == "Updated"
+
+
+def test_subscribe_and_unsubscribe(client, world, register):
+    assert ReadSub(client, world["sub"])["Subscribers"] == 1
+    reader = register()
+    client.post(f"/api/v/subscribe/{world['sub']}", headers=reader["Headers"])
+    assert ReadSub(client, world["sub"])["Subscribers"] == 2
+    client.post(f"/api/v/unsubscribe/{world['sub']}", headers=reader["Headers"])
+    assert ReadSub(client, world["sub"])["Subscribers"] == 1
+
+
+def test_delete_sub(client, world):
+    ListSubs(client)
+    ReadSub(client, world["sub"])
+    client.post(f"/api/v/delete/{world['sub']}",
+                headers=world["owner"]["Headers"])
+    assert ReadSub(client, world["sub"]) is None
+    assert ListSubs(client) == []
+
+
+def test_create_post(client, world):
+    assert ReadSub(client, world["sub"])["PostCount"] == 1
+    CreatePost(client, world["owner"], world["sub"])
+    assert ReadSub(client, world["sub"])["PostCount"] == 2
+
+
+def test_update_post(client, world):
+    post = world["post"]
+    ReadPost(client, post["UUID"])
+    ReadPost(client, title=post["Title"])
+    res = client.post(f"/api/post/update/{post['UUID']}",
+                      headers=world["owner"]["Headers"],
+                      json={"Content": "Updated", "Title": "Renamed"})
+    assert res.status_code == 200, res.text
+    assert ReadPost(client, post["UUID"])["Content"] == "Updated"
+    assert ReadPost(client, title=post["Title"]) is None
+    assert ReadPost(client, title="Renamed")["UUID"] == post["UUID"]
+
+
+def test_delete_post(client, world):
+    post = world["post"]
+    ReadPost(client, post["UUID"])
+    ReadPost(client, title=post["Title"])
+    assert ReadSub(client, world["sub"])["PostCount"] == 1
+    assert world["sub"] in ListSubs(client)
+    res = client.post(f"/api/post/delete/{post['UUID']}",
+                      headers=world["owner"]["Headers"])
+    assert res.status_code == 200, res.text
+    assert ReadPost(client, post["UUID"]) is None
+    assert ReadPost(client, title=post["Title"]) is None
+    assert ReadSub(client, world["sub"])["PostCount"] == 0
+    assert client.get("/api/v/list/subs").json()["Subs"][0]["PostCount"] == 0
+
+
+def test_vote_post(client, world):
+    assert ReadPost(client, world["post"]["UUID"])["Votes"] == 0
+    client.cookies.set("JWT", world["owner"]["Access"])
+    client.post(f"/api/post/upvote/{world['post']['UUID']}")
+    assert ReadPost(client, world["post"]["UUID"])["Votes"] == 1
+
+
+def Flush():
+    asyncio.run(settings.VOTE_BUFFER.Flush(settings.DB))
+
+
+@pytest.fixture
+def write_behind(monkeypatch):
+    monkeypatch.setattr(settings.VOTE_BUFFER, "enabled", True)
+    yield
+    Flush()
+
+
+def test_flushed_votes(client, world, write_behind, graph):
+    post, comment = world["post"]["UUID"], world["comment"]
+    assert ReadPost(client, post)["Votes"] == 0
+    ReadPost(client, title=world["post"]["Title"])
+    ListComments(client, post)
+    assert ReadComment(client, comment)["Votes"] == 0
+    client.cookies.set("JWT", world["owner"]["Access"])
+    client.post(f"/api/post/upvote/{post}")
+    client.post(f"/api/comment/upvote/{comment}")
+    client.cookies.clear()
+    # Pending deltas are added to the cached records
+    assert ReadPost(client, post)["Votes"] == 1
+    assert ReadComment(client, comment)["Votes"] == 1
+    Flush()
+    assert graph.nodes[graph.One("Post", "UUID", post)]["Votes"] == 1
+    assert ReadPost(client, post)["Votes"] == 1
+    assert ReadPost(client, title=world["post"]["Title"])["Votes"] == 1
+    assert ReadComment(client, comment)["Votes"] == 1
+    res = client.get(f"/api/comment/list/{post}").json()["Comments"]
+    assert res[0]["Votes"] == 1
+
+
+def test_create_comment(client, world):
+    post = world["post"]["UUID"]
+    assert ReadPost(client, post)["CommentCount"] == 1
+    assert len(ListComments(client, post)) == 1
+    reply = CreateComment(client, world["owner"], world["comment"])
+    assert ReadPost(client, post)["CommentCount"] == 2
+    assert reply["UUID"] in ListComments(client, world["comment"])
+    uid = CreateComment(client, world["owner"], post)["UUID"]
+    assert uid in ListComments(client, post)
+
+
+def test_update_comment(client, world):
+    post = world["post"]["UUID"]
+    ReadComment(client, world["comment"])
+    ListComments(client, post)
+    res = client.put(f"/api/comment/update/{world['comment']}",
+                     headers=world["owner"]["Headers"],
+                     params={"message": "Updated"})
+    assert res.status_code == 200, res.text
+    assert ReadComment(client, world["comment"])["Message"] == "Updated"
+    assert ListComments(client, post)[world["comment"]] == "Updated"
+
+
+def test_vote_comment(client, world):
+    assert ReadComment(client, world["comment"])["Votes"] == 0
+    client.cookies.set("JWT", world["owner"]["Access"])
+    client.post(f"/api/comment/downvote/{world['comment']}")
+    assert ReadComment(client, world["comment"])["Votes"] == -1
+
+
+def test_delete_comment(client, world):
+    post = world["post"]["UUID"]
+    reply = CreateComment(client, world["owner"], world["comment"])["UUID"]
+    ReadComment(client, reply)
+    assert reply in ListComments(client, world["comment"])
+    assert ReadPost(client, post)["CommentCount"] == 2
+    res = client.post(f"/api/comment/delete/{reply}",
+                      headers=world["owner"]["Headers"])
+    assert res.status_code == 200, res.text
+    assert ReadComment(client, reply) is None
+    assert ListComments(client, world["comment"]) == {}
+    assert ReadPost(client, post)["CommentCount"] == 1
+
+
+def test_counter_repair(client, world, register, graph):
+    graph.Set(graph.One("Sub", "Title", world["sub"]), {"PostCount": 7})
+    settings.DB.cache.Clear()
+    assert ReadSub(client, world["sub"])["PostCount"] == 7
+    res = client.post("/api/admin/counters/repair", params={"wait": True},
+                      headers=register(admin=True)["Headers"])
+    assert res.status_code == 200, res.text
+    assert ReadSub(client, world["sub"])["PostCount"] == 1
+
+
+def test_clear_cache(client, world, register, graph):
+    ReadSub(client, world["sub"])
+    graph.Set(graph.One("Sub", "Title", world["sub"]), {"Headline": "Changed"})
+    res = client.post("/api/admin/database/cache/clear",
+                      headers=register(admin=True)["Headers"])
+    assert res.status_code == 200, res.text
+    assert ReadSub(client, world["sub"])["Headline"] == "Changed"
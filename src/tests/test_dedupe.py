@@ -0,0 +1,155 @@
+"""tests/test_dedupe.py
+
+Content-addressed storage (STORAGE_DEDUPE): shared content is stored
+once and removed with its last File.
+"""
+import asyncio
+
+import pytest
+from config import settings
+from drivers.storage.dedupe import DedupeUploads, RemoveBlob
+
+CONTENT = b"shared content"
+
+
+@pytest.fixture
+def dedupe(monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_DEDUPE", True)
+    monkeypatch.setattr(settings.STORAGE_DRIVER, "dedupe", True)
+    return settings.HASH_FUNC(CONTENT).hexdigest()
+
+
+def Upload(client, user: dict):
+    res = client.post("/api/file/create", headers=user["Headers"],
+                      files={"file": ("shared.txt", CONTENT, "text/plain")})
+    assert res.status_code == 200, res.text
+    return res.json()["UUID"]
+
+
+def Delete(client, user: dict, uid: str):
+    res = client.post(f"/api/file/delete/{uid}", headers=user["Headers"])
+    assert res.status_code == 200, res.text
+
+
+def test_content_is_removed_with_its_last_file(client, register, graph,
+                                               dedupe):
+    user = register()
+    first, second = Upload(client, user), Upload(client, user)
+    assert graph.nodes[graph.One("Blob", "Hash", dedupe)]["References"] == 2
+    Delete(client, user, first)
+    assert settings.STORAGE_DRIVER.Exists(dedupe)
+    Delete(client, user, second)
+    assert not settings.STORAGE_DRIVER.Exists(dedupe)
+    assert graph.One("Blob", "Hash", dedupe) is None
+
+
+def test_remove_blob_keeps_referenced_content(client, register, dedupe):
+    Upload(client, register())
+    removed = asyncio.run(RemoveBlob(settings.DB, settings.STORAGE_DRIVER,
+                                     dedupe))
+    assert not removed
+    assert settings.STORAGE_DRIVER.Exists(dedupe)
+
+
+def test_upload_restores_content_removed_meanwhile(client, register, dedupe):
+    user = register()
+    uid = Upload(client, user)
+    # Unlinked by a delete whose RemoveBlob ran just before this upload
+    settings.STORAGE_DRIVER.DeleteFile(dedupe)
+    Upload(client, user)
+    assert settings.STORAGE_DRIVER.Exists(dedupe)
+    res = client.get("/api/file/read/", params={"UUID": uid})
+    assert res.content == CONTENT
+
+
+def test_dedupe_uploads_counts_missing_files(client, register, graph,
+                                             monkeypatch):
+    user = register()
+    # Stored under their UUIDs before dedupe was turned on
+    kept, missing = Upload(client, user), Upload(client, user)
+    storage = settings.STORAGE_DRIVER
+    storage.DeleteFile(missing)
+    monkeypatch.setattr(storage, "dedupe", True)
+    summary = asyncio.run(DedupeUploads(settings.DB, storage,
+                                        settings.HASH_FUNC))
+
+    assert summary["Checked"] == 2 and summary["Missing"] == 1
+    digest = settings.HASH_FUNC(CONTENT).hexdigest()
+    assert graph.nodes[graph.One("File", "UUID", kept)]["Blob"] == digest
+    assert storage.Exists(digest) and not storage.Exists(kept)
+
+
+def test_dedupe_uploads_links_stored_files(client, register, graph,
+                                           monkeypatch):
+    user = register()
+    # Stored under their UUIDs before dedupe was turned on
+    first, second = Upload(client, user), Upload(client, user)
+    storage = settings.STORAGE_DRIVER
+    monkeypatch.setattr(storage, "dedupe", True)
+    summary = asyncio.run(DedupeUploads(settings.DB, storage,
+                                        settings.HASH_FUNC))
+
+    assert summary == {"Checked": 2, "Deduplicated": 1, "Missing": 0,
+                       "BytesFreed": len(CONTENT)}
+    digest = settings.HASH_FUNC(CONTENT).hexdigest()
+    assert graph.nodes[graph.One("Blob", "Hash", digest)]["References"] == 2
+    assert storage.Exists(digest)
+    assert not storage.Exists(first) and not storage.Exists(second)
+
+
+def test_dedupe_uploads_counts_files_deleted_meanwhile(client, register,
+                                                       monkeypatch):
+    user = register()
+    uid = Upload(client, user)
+    storage = settings.STORAGE_DRIVER
+    storage.DeleteFile(uid)
+    # Listed as stored, then deleted before it is linked
+    monkeypatch.setattr(storage, "Exists", lambda filename: True)
+    monkeypatch.setattr(storage, "dedupe", True)
+    summary = asyncio.run(DedupeUploads(settings.DB, storage,
+                                        settings.HASH_FUNC))
+
+    assert summary["Checked"] == 1 and summary["Missing"] == 1
+
+
+def test_dedupe_uploads_removes_content_of_files_deleted_meanwhile(
+        client, register, graph, monkeypatch):
+    user = register()
+    uid = Upload(client, user)
+    storage = settings.STORAGE_DRIVER
+    link = storage.LinkBlob
+
+    async def LinkBlob(filename, hash_func):
+        linked = await link(filename, hash_func)
+        # The File is deleted between linking and attaching its content
+        graph.Delete(graph.One("File", "UUID", uid))
+        return linked
+    monkeypatch.setattr(storage, "LinkBlob", LinkBlob)
+    monkeypatch.setattr(storage, "dedupe", True)
+    summary = asyncio.run(DedupeUploads(settings.DB, storage,
+                                        settings.HASH_FUNC))
+
+    assert summary["Missing"] == 1
+    digest = settings.HASH_FUNC(CONTENT).hexdigest()
+    assert not storage.Exists(digest)
+    assert graph.One("Blob", "Hash", digest) is None
+
+
+def test_dedupe_uploads_tolerates_names_removed_meanwhile(client, register,
+                                                          monkeypatch):
+    uid = Upload(client, register())
+    storage = settings.STORAGE_DRIVER
+    link = storage.LinkBlob
+
+    async def LinkBlob(filename, hash_func):
+        linked = await link(filename, hash_func)
+        storage.DeleteFile(filename)
+        return linked
+    monkeypatch.setattr(storage, "LinkBlob", LinkBlob)
+    monkeypatch.setattr(storage, "dedupe", True)
+    summary = asyncio.run(DedupeUploads(settings.DB, storage,
+                                        settings.HASH_FUNC))
+
+    assert summary["Checked"] == 1 and summary["Missing"] == 0
+    assert storage.Exists(settings.HASH_FUNC(CONTENT).hexdigest())
+    assert not storage.Exists(uid)
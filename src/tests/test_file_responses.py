@@ -0,0 +1,109 @@
+"""tests/test_file_responses.py
+
+Downloads answer byte ranges with 206 (or 416), and conditional requests
+with 304.
+"""
+import pytest
+from config import settings
+
+CONTENT = bytes(range(256)) * 8
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    monkeypatch.setattr(settings, "HASH_FILES", True)
+
+
+@pytest.fixture
+def upload(client, register):
+    user = register()
+    res = client.post("/api/file/create", headers=user["Headers"],
+                      files={"file": ("data.bin", CONTENT,
+                                      "application/octet-stream")})
+    assert res.status_code == 200, res.text
+    return res.json()
+
+
+def Download(client, uid: str, method: str = "GET", **headers):
+    return client.request(method, "/api/file/read/", params={"UUID": uid},
+                          headers=headers)
+
+
+def test_full_download(client, upload):
+    res = Download(client, upload["UUID"])
+    assert res.status_code == 200
+    assert res.content == CONTENT
+    assert res.headers["accept-ranges"] == "bytes"
+    assert res.headers["etag"]
+
+
+def test_head_sends_no_body(client, upload):
+    res = Download(client, upload["UUID"], "HEAD")
+    assert res.status_code == 200
+    assert res.content == b""
+    assert res.headers["content-length"] == str(len(CONTENT))
+
+
+@pytest.mark.parametrize("header, start, end", [
+    ("bytes=0-99", 0, 99),
+    ("bytes=100-", 100, len(CONTENT) - 1),
+    ("bytes=-10", len(CONTENT) - 10, len(CONTENT) - 1),
+    ("bytes=2000-9999", 2000, len(CONTENT) - 1),
+])
+def test_single_range(client, upload, header, start, end):
+    res = Download(client, upload["UUID"], Range=header)
+    assert res.status_code == 206
+    assert res.content == CONTENT[start:end + 1]
+    assert res.headers["content-range"] == f"bytes {start}-{end}/{len(CONTENT)}"
+
+
+def test_multiple_ranges(client, upload):
+    res = Download(client, upload["UUID"], Range="bytes=0-9,20-29")
+    assert res.status_code == 206
+    assert res.headers["content-type"].startswith("multipart/byteranges")
+    assert CONTENT[0:10] in res.content and CONTENT[20:30] in res.content
+
+
+def test_unsatisfiable_range(client, upload):
+    res = Download(client, upload["UUID"], Range=f"bytes={len(CONTENT)}-")
+    assert res.status_code == 416
+    assert res.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+
+def test_if_none_match(client, upload):
+    etag = Download(client, upload["UUID"]).headers["etag"]
+    res = Download(client, upload["UUID"], **{"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.content == b""
+    res = Download(client, upload["UUID"], **{"If-None-Match": '"other"'})
+    assert res.status_code == 200
+
+
+def test_if_modified_since(client, upload):
+    modified = Download(client, upload["UUID"]).headers["last-modified"]
+    res = Download(client, upload["UUID"], **{"If-Modified-Since": modified})
+    assert res.status_code == 304
+    res = Download(client, upload["UUID"],
+                   **{"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})
+    assert res.status_code == 200
+
+
+def test_hashed_files_have_strong_etags(client, hashed, upload):
+    res = Download(client, upload["UUID"])
+    assert res.headers["etag"] == f'"{upload["Hash"]}"'
+    # If-Range only honours the range while the content is unchanged
+    res = Download(client, upload["UUID"], Range="bytes=0-9",
+                   **{"If-Range": res.headers["etag"]})
+    assert res.status_code == 206
+    res = Download(client, upload["UUID"], Range="bytes=0-9",
+                   **{"If-Range": '"changed"'})
+    assert res.status_code == 200
+    assert res.content == CONTENT
+
+
+def test_weak_etags_never_match_if_range(client, upload):
+    etag = Download(client, upload["UUID"]).headers["etag"]
+    assert etag.startswith("W/")
+    res = Download(client, upload["UUID"], Range="bytes=0-9",
+                   **{"If-Range": etag})
+    assert res.status_code == 200
@@ -0,0 +1,107 @@
+"""tests/test_memory_backend.py
+
+The in-memory graph keeps its indexes and adjacency in step with every
+mutation, and runs the app end to end without a Neo4j server.
+"""
+import asyncio
+
+from config import settings
+from drivers.database.memory import MemoryDatabase, MemoryGraph, HANDLERS
+from drivers.database.queries import QUERIES
+from tests.conftest import CreateSub, CreatePost, CreateComment
+
+
+def test_every_query_has_a_handler():
+    assert set(QUERIES.queries) <= set(HANDLERS)
+    MemoryDatabase()
+
+
+def test_indexes_follow_property_changes():
+    g = MemoryGraph()
+    nid = g.Create("User", {"UUID": "a", "Email": "a@violethawk.test"})
+    assert g.One("User", "Email", "a@violethawk.test") == nid
+    g.Set(nid, {"Email": "b@violethawk.test"})
+    assert g.Find("User", "Email", "a@violethawk.test") == []
+    assert g.One("User", "Email", "b@violethawk.test") == nid
+    g.Delete(nid)
+    assert g.One("User", "UUID", "a") is None
+    assert g.All("User") == []
+
+
+def test_delete_detaches_relationships():
+    g = MemoryGraph()
+    user = g.Create("User", {"UUID": "u"})
+    post = g.Create("Post", {"UUID": "p"})
+    g.Relate(user, "AUTHOR", post)
+    assert g.Related(user, "AUTHOR", post)
+    assert g.Incoming(post, "AUTHOR") == [user]
+    g.Delete(post)
+    assert g.Outgoing(user, "AUTHOR") == []
+
+
+def test_props_are_copies():
+    g = MemoryGraph()
+    nid = g.Create("Sub", {"Title": "t", "Keywords": ["a"]})
+    g.Props(nid)["Keywords"].append("b")
+    assert g.Props(nid)["Keywords"] == ["a"]
+
+
+def State(g: MemoryGraph):
+    """Everything a query can observe, without empty index buckets."""
+    def Adjacency(adjacency):
+        return sorted((nid, t, sorted(ids)) for nid, types in adjacency.items()
+                      for t, ids in types.items() if ids)
+    return (sorted(g.nodes.items()), sorted(g.labels.items()),
+            {label: list(ids) for label, ids in g.byLabel.items() if ids},
+            sorted((key, repr(v), sorted(ids)) for key, values in g.indexes.items()
+                   for v, ids in values.items() if ids),
+            Adjacency(g.out), Adjacency(g.inc))
+
+
+def test_rollback_undoes_every_write(client, register, graph):
+    owner, other = register(), register()
+    sub = CreateSub(client, owner)
+    post = CreatePost(client, owner, sub["Title"])
+    CreateComment(client, other, post["UUID"])
+    CreateComment(client, owner, post["UUID"])
+    client.post(f"/api/v/subscribe/{sub['Title']}", headers=other["Headers"])
+    before = State(graph)
+
+    async def Work(commit: bool):
+        uow = settings.DB.Session()
+        await uow.Write("UpdateUser", {"uid": other["UUID"],
+                                       "attributes": {"Bio": "Changed"}})
+        await uow.Write("DeleteUser", {"uid": owner["UUID"]})
+        await uow.Write("CreateUser", {"params": {"UUID": "new"}})
+        await uow.Write("UnsubscribeSub", {"uid": other["UUID"],
+                                           "title": sub["Title"]})
+        if commit:
+            await uow.Commit()
+        await uow.Close()
+    asyncio.run(Work(commit=False))
+    assert State(graph) == before
+
+    asyncio.run(Work(commit=True))
+    assert graph.One("User", "UUID", owner["UUID"]) is None
+    assert graph.One("User", "UUID", "new") is not None
+
+
+def test_reads_and_writes_run_the_handlers():
+    db = MemoryDatabase()
+    asyncio.run(db.Write("CreateUser", {"params": {"UUID": "u", "Email": "e"}}))
+    res = asyncio.run(db.Read("GetUser", {"uid": "u"}))
+    assert res[0]["user"]["Email"] == "e"
+
+
+def test_app_round_trip(client, register):
+    user = register()
+    sub = CreateSub(client, user)
+    post = CreatePost(client, user, sub["Title"])
+    CreateComment(client, user, post["UUID"])
+    res = client.get("/api/post/read", params={"UUID": post["UUID"]})
+    assert res.status_code == 200, res.text
+    assert res.json()["Title"] == post["Title"]
+    client.cookies.set("JWT", user["Access"])
+    res = client.post(f"/api/post/upvote/{post['UUID']}")
+    assert res.status_code == 200, res.text
+    assert res.json()["Votes"] == 1
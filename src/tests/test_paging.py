@@ -0,0 +1,100 @@
+"""tests/test_paging.py
+
+Cursor (keyset) paging of post, sub, comment and file listings: every item is
+listed once, in order, whatever the page size.
+"""
+import pytest
+from tests.conftest import CreateSub, CreatePost, CreateComment
+
+
+def Pages(client, path: str, field: str, limit: int, headers: dict = None,
+          method: str = "GET", **params):
+    items, cursor = [], None
+    while True:
+        if cursor:
+            params["cursor"] = cursor
+        res = client.request(method, path, headers=headers,
+                             params={**params, "limit": limit})
+        assert res.status_code == 200, res.text
+        page = res.json()
+        assert len(page[field]) <= limit
+        items += page[field]
+        cursor = page["Next"]
+        if not cursor:
+            return items
+
+
+@pytest.fixture
+def posts(client, register, graph):
+    owner = register()
+    sub = CreateSub(client, owner)
+    created = [CreatePost(client, owner, sub["Title"], title=f"post{i:02}",
+                          published=i % 4 != 0)
+               for i in range(11)]
+    # Distinct and tied vote counts
+    for i, post in enumerate(created):
+        graph.Set(graph.One("Post", "UUID", post["UUID"]), {"Votes": i % 3})
+    return owner, created
+
+
+@pytest.mark.parametrize("limit", [1, 3, 25])
+@pytest.mark.parametrize("order", ["CreatedDate", "Title", "Votes"])
+def test_post_pages_list_published_posts_once(client, posts, graph,
+                                              limit, order):
+    _, created = posts
+    listed = Pages(client, "/api/post/list", "Posts", limit, order_by=order)
+    published = [post for post in created if post["Published"]]
+    keys = {post["UUID"]: (graph.nodes[graph.One("Post", "UUID", post["UUID"])][order],
+                           post["UUID"])
+            for post in published}
+    assert [post["UUID"] for post in listed] == sorted(keys, key=keys.get)
+
+
+def test_post_pages_show_owners_and_admins_unpublished_posts(client, posts,
+                                                             register):
+    owner, created = posts
+    listed = Pages(client, "/api/post/list", "Posts", 4,
+                   headers=owner["Headers"])
+    assert len(listed) == len(created)
+    listed = Pages(client, "/api/post/list", "Posts", 4,
+                   headers=register()["Headers"])
+    assert len(listed) == len([post for post in created if post["Published"]])
+    listed = Pages(client, "/api/post/list", "Posts", 4,
+                   headers=register(admin=True)["Headers"])
+    assert len(listed) == len(created)
+
+
+def test_post_pages_reject_unknown_orders(client, posts):
+    res = client.get("/api/post/list", params={"order_by": "Owner"})
+    assert res.status_code == 400
+
+
+def test_sub_pages(client, register):
+    owner = register()
+    titles = sorted(CreateSub(client, owner)["Title"] for _ in range(7))
+    listed = Pages(client, "/api/v/list/subs", "Subs", 2)
+    assert [sub["Title"] for sub in listed] == titles
+
+
+def test_comment_pages(client, posts, graph):
+    owner, created = posts
+    post = created[1]["UUID"]
+    comments = [CreateComment(client, owner, post, f"comment{i}")["UUID"]
+                for i in range(6)]
+    listed = Pages(client, f"/api/comment/list/{post}", "Comments", 4)
+    # Oldest first, ties broken by UUID
+    keys = {uid: (graph.nodes[graph.One("Comment", "UUID", uid)]["CreatedDate"],
+                  uid)
+            for uid in comments}
+    assert [comment["UUID"] for comment in listed] == sorted(keys, key=keys.get)
+
+
+def test_file_pages(client, register):
+    owner = register()
+    uploaded = sorted(
+        client.post("/api/file/create", headers=owner["Headers"],
+                    files={"file": (f"{i}.txt", b"content", "text/plain")}
+                    ).json()["UUID"]
+        for i in range(5))
+    listed = Pages(client, "/api/file/list", "Files", 2, method="POST")
+    assert [f["UUID"] for f in listed] == uploaded
@@ -0,0 +1,89 @@
+"""tests/test_refresh_tokens.py
+
+Refresh token rotation and reuse detection: a rotated token presented
+again after the grace period revokes its whole session.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from config import settings
+from tests.conftest import PASSWORD
+
+
+def Refresh(client, token: str):
+    return client.post(settings.REFRESH_ENDPOINT, json={"refresh_token": token})
+
+
+@pytest.fixture
+def no_grace(monkeypatch):
+    monkeypatch.setattr(settings, "REFRESH_TOKEN_REUSE_GRACE_SECONDS", 0)
+
+
+def test_refresh_rotates_the_token(client, register):
+    user = register()
+    res = Refresh(client, user["Refresh"])
+    assert res.status_code == 200, res.text
+    renewed = res.json()
+    assert renewed["access_token"]
+    assert renewed["refresh_token"] not in (None, user["Refresh"])
+    res = Refresh(client, renewed["refresh_token"])
+    assert res.status_code == 200, res.text
+
+
+def Reused(caplog):
+    return [r for r in caplog.records if "RefreshTokenReuse" in r.getMessage()]
+
+
+def test_reused_token_revokes_the_session(client, register, no_grace, caplog):
+    user = register()
+    renewed = Refresh(client, user["Refresh"]).json()["refresh_token"]
+    # The first token is presented again, e.g. after being stolen
+    assert Refresh(client, user["Refresh"]).status_code == 401
+    # ...so the token it was rotated into stops working too
+    assert Refresh(client, renewed).status_code == 401
+    assert len(Reused(caplog)) == 1
+
+
+def test_reuse_within_grace_keeps_the_session(client, register):
+    user = register()
+    renewed = Refresh(client, user["Refresh"]).json()["refresh_token"]
+    # A concurrent request raced the rotation: no new token, no revocation
+    assert Refresh(client, user["Refresh"]).status_code == 401
+    assert Refresh(client, renewed).status_code == 200
+
+
+def test_reuse_only_revokes_its_own_session(client, register, no_grace):
+    user = register()
+    # A second login starts a second session
+    res = client.post(settings.TOKEN_ENDPOINT,
+                      data={"username": user["Email"], "password": PASSWORD})
+    other = res.json()["refresh_token"]
+    Refresh(client, user["Refresh"])
+    assert Refresh(client, user["Refresh"]).status_code == 401
+    assert Refresh(client, other).status_code == 200
+
+
+def test_revoked_token_is_rejected(client, register, caplog):
+    user = register()
+    res = client.post(settings.AUTH_ENDPOINT + "/revoke",
+                      json={"refresh_token": user["Refresh"]})
+    assert res.status_code == 200, res.text
+    assert Refresh(client, user["Refresh"]).status_code == 401
+    assert Reused(caplog) == []
+
+
+def test_expired_token_is_rejected_without_revoking(client, register, graph,
+                                                    caplog):
+    user = register()
+    renewed = Refresh(client, user["Refresh"]).json()["refresh_token"]
+    expired = graph.All("RefreshToken")[-1]
+    graph.Set(expired, {"Expires": datetime.now(settings.TIMEZONE)
+                        - timedelta(days=1)})
+    assert Refresh(client, renewed).status_code == 401
+    # Never rotated, so not a reuse: the session is not revoked
+    assert Reused(caplog) == []
+    assert graph.nodes[expired].get("ReplacedBy") is None
+
+
+def test_unknown_token_is_rejected(client):
+    assert Refresh(client, "unknown").status_code == 401
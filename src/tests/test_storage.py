@@ -0,0 +1,105 @@
+"""tests/test_storage.py
+
+Stored files only change once their File's changes commit, and
+resharding moves flat uploads into their shard directories while files
+keep being deleted.
+"""
+import os
+
+import pytest
+from config import settings
+from drivers.database.memory import MemoryUnitOfWork
+from drivers.storage import storage as storage_module
+from drivers.storage.storage import StorageDriver
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return StorageDriver(str(tmp_path), fsync=False, shard_depth=2)
+
+
+@pytest.fixture
+def failing_commit(monkeypatch):
+    async def Fail(self):
+        raise RuntimeError("commit failed")
+    monkeypatch.setattr(MemoryUnitOfWork, "Commit", Fail)
+
+
+def Upload(client, user: dict):
+    res = client.post("/api/file/create", headers=user["Headers"],
+                      files={"file": ("note.txt", b"note", "text/plain")})
+    assert res.status_code == 200, res.text
+    return res.json()["UUID"]
+
+
+def test_failed_upload_leaves_no_content(client, register, graph, request):
+    user = register()
+    request.getfixturevalue("failing_commit")
+    res = client.post("/api/file/create", headers=user["Headers"],
+                      files={"file": ("note.txt", b"note", "text/plain")})
+    assert res.status_code == 500
+    assert graph.All("File") == []
+    assert list(settings.STORAGE_DRIVER.ListFiles()) == []
+
+
+def test_delete_removes_content_once_committed(client, register):
+    user = register()
+    uid = Upload(client, user)
+    res = client.post(f"/api/file/delete/{uid}", headers=user["Headers"])
+    assert res.status_code == 200, res.text
+    assert not settings.STORAGE_DRIVER.Exists(uid)
+
+
+def test_failed_delete_keeps_content(client, register, graph, request):
+    user = register()
+    uid = Upload(client, user)
+    request.getfixturevalue("failing_commit")
+    res = client.post(f"/api/file/delete/{uid}", headers=user["Headers"])
+    assert res.status_code == 500
+    assert graph.One("File", "UUID", uid) is not None
+    assert settings.STORAGE_DRIVER.Exists(uid)
+
+
+def Flat(storage, name: str):
+    """Stores a file the way it was before sharding."""
+    path = os.path.join(storage.upload_dir, name)
+    with open(path, "wb") as f:
+        f.write(name.encode())
+    return path
+
+
+def test_reshard_moves_flat_files(storage):
+    for name in ("a", "b", "c"):
+        Flat(storage, name)
+    assert storage.Reshard(batch_size=2) == {"Moved": 3, "Missing": 0}
+    for name in ("a", "b", "c"):
+        assert storage.Locate(name) == storage.Path(name)
+    assert storage.Reshard() == {"Moved": 0, "Missing": 0}
+
+
+def test_reshard_skips_files_deleted_since_listed(storage, monkeypatch):
+    Flat(storage, "kept")
+    deleted = Flat(storage, "deleted")
+    listed = list(storage.ListFiles())
+    os.remove(deleted)
+    monkeypatch.setattr(storage, "ListFiles", lambda after=None: iter(listed))
+
+    assert storage.Reshard() == {"Moved": 1, "Missing": 1}
+    assert storage.Locate("kept") == storage.Path("kept")
+    assert not os.path.exists(storage.Path("deleted"))
+
+
+def test_delete_during_reshard_leaves_no_copy(storage, monkeypatch):
+    flat = Flat(storage, "name")
+    remove = os.remove
+
+    def Remove(path):
+        if path == flat:
+            # Reshard links the file just before it is deleted
+            os.makedirs(os.path.dirname(storage.Path("name")), exist_ok=True)
+            os.link(flat, storage.Path("name"))
+        remove(path)
+    monkeypatch.setattr(storage_module.os, "remove", Remove)
+
+    storage.DeleteFile("name")
+    assert not storage.Exists("name")
@@ -0,0 +1,22 @@
+"""tests/test_sub_feed.py
+
+Sub pages are rendered from the per-sub ranked indexes, which a new post
+joins once its request has committed.
+"""
+from tests.conftest import CreateSub
+
+
+def test_posting_from_the_sub_page_redirects_to_the_new_post(client,
+                                                             register):
+    user = register()
+    sub = CreateSub(client, user)["Title"]
+    client.cookies.set("JWT", user["Access"])
+    res = client.post(f"/v/{sub}/new",
+                      data={"title": "Fresh post", "content": "Content"},
+                      files={"file": ("note.txt", b"note", "text/plain")},
+                      follow_redirects=False)
+    assert res.status_code == 303
+    assert res.headers["location"] == f"/v/{sub}?sort=new"
+    res = client.get(res.headers["location"])
+    assert res.status_code == 200
+    assert "Fresh post" in res.text
@@ -0,0 +1,233 @@
+"""tests/test_unit_of_work.py
+
+Commit and rollback paths of UnitOfWork, against a stand-in for the neo4j
+driver, and of MemoryUnitOfWork, GetUnitOfWork and UnitOfWorkRoute.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from neo4j import READ_ACCESS, WRITE_ACCESS
+from drivers.database.database import (UnitOfWork, BookmarkStore,
+                                       ROUTING_CLUSTER, ROUTING_LEADER)
+from drivers.database.metrics import QueryMetrics
+from drivers.database.memory import MemoryDatabase, MemoryUnitOfWork
+from drivers.database import utils
+from config import settings
+from tests.conftest import PASSWORD
+
+
+class FakeResult:
+    async def data(self):
+        return [{"ok": True}]
+
+
+class FakeTransaction:
+    def __init__(self, log: list, fail: bool = False):
+        self.log = log
+        self.fail = fail
+
+    async def run(self, query, parameters):
+        self.log.append("run")
+        return FakeResult()
+
+    async def commit(self):
+        self.log.append("commit")
+        if self.fail:
+            raise RuntimeError("commit failed")
+
+    async def rollback(self):
+        self.log.append("rollback")
+
+
+class FakeSession:
+    def __init__(self, log: list, fail: bool = False):
+        self.log = log
+        self.fail = fail
+
+    async def begin_transaction(self):
+        self.log.append("begin")
+        return FakeTransaction(self.log, self.fail)
+
+    async def last_bookmarks(self):
+        return ["bookmark"]
+
+    async def close(self):
+        self.log.append("close")
+
+
+def FakeDatabase(routing: str = ROUTING_LEADER, fail: bool = False):
+    log = []
+    driver = SimpleNamespace(
+        session=lambda **kwargs: FakeSession(log, fail))
+    db = SimpleNamespace(driver=driver, database=None, routing=routing,
+                         bookmarks=BookmarkStore(), cache=None,
+                         metrics=QueryMetrics(0, 250))
+    return db, log
+
+
+def Run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_commit_runs_after_commit_callbacks_only():
+    db, log = FakeDatabase()
+    uow = UnitOfWork(db)
+    done = []
+
+    async def Work():
+        await uow.Read("GetUser", {"uid": "u"})
+        await uow.Write("UpdateUser", {"uid": "u", "attributes": {}})
+        uow.AfterCommit(lambda: done.append("committed"))
+        uow.AfterRollback(lambda: done.append("rolled back"))
+        await uow.Commit()
+        await uow.Close()
+    Run(Work())
+
+    # The read transaction is committed before the write transaction opens
+    assert log == ["begin", "run", "commit", "begin", "run", "commit",
+                   "close"]
+    assert done == ["committed"]
+
+
+def test_close_without_commit_rolls_back():
+    db, log = FakeDatabase()
+    uow = UnitOfWork(db)
+    done = []
+
+    async def Work():
+        await uow.Write("UpdateUser", {"uid": "u", "attributes": {}})
+        uow.AfterCommit(lambda: done.append("committed"))
+        uow.AfterRollback(lambda: done.append("rolled back"))
+        await uow.Close()
+    Run(Work())
+
+    assert log == ["begin", "run", "rollback", "close"]
+    assert done == ["rolled back"]
+
+
+def test_failed_commit_runs_after_rollback_callbacks():
+    db, log = FakeDatabase(fail=True)
+    uow = UnitOfWork(db)
+    done = []
+
+    async def Work():
+        await uow.Write("UpdateUser", {"uid": "u", "attributes": {}})
+        uow.AfterCommit(lambda: done.append("committed"))
+        uow.AfterRollback(lambda: done.append("rolled back"))
+        with pytest.raises(RuntimeError):
+            await uow.Commit()
+        await uow.Close()
+    Run(Work())
+
+    assert log == ["begin", "run", "commit", "close"]
+    assert done == ["rolled back"]
+
+
+def test_awaitable_callbacks_are_awaited():
+    db, _ = FakeDatabase()
+    uow = UnitOfWork(db)
+    done = []
+
+    async def Callback():
+        done.append("awaited")
+
+    async def Work():
+        await uow.Write("UpdateUser", {"uid": "u", "attributes": {}})
+        uow.AfterCommit(Callback)
+        await uow.Commit()
+    Run(Work())
+
+    assert done == ["awaited"]
+
+
+def test_commit_stores_bound_users_bookmarks():
+    db, _ = FakeDatabase()
+    uow = UnitOfWork(db)
+    uow.Bind("u")
+
+    async def Work():
+        await uow.Write("UpdateUser", {"uid": "u", "attributes": {}})
+        await uow.Commit()
+    Run(Work())
+
+    assert db.bookmarks.Get("u") == ["bookmark"]
+
+
+def test_cluster_routing_reads_from_followers():
+    db, log = FakeDatabase(ROUTING_CLUSTER)
+    modes = []
+    session = db.driver.session
+    db.driver.session = lambda **kwargs: (
+        modes.append((kwargs["default_access_mode"], kwargs["bookmarks"]))
+        or session(**kwargs))
+    uow = UnitOfWork(db)
+
+    async def Work():
+        await uow.Read("GetUser", {"uid": "u"})
+        await uow.Write("UpdateUser", {"uid": "u", "attributes": {}})
+        await uow.Commit()
+        await uow.Close()
+    Run(Work())
+
+    # The write session continues from the read session's bookmarks
+    assert modes == [(READ_ACCESS, None), (WRITE_ACCESS, ["bookmark"])]
+    assert log == ["begin", "run", "commit", "close", "begin", "run",
+                   "commit", "close"]
+
+
+def test_memory_unit_of_work_callbacks():
+    db = MemoryDatabase()
+    done = []
+
+    async def Work():
+        committed = db.Session()
+        committed.AfterCommit(lambda: done.append("committed"))
+        committed.AfterRollback(lambda: done.append("not rolled back"))
+        await committed.Commit()
+        await committed.Close()
+        rolledBack = db.Session()
+        rolledBack.AfterCommit(lambda: done.append("not committed"))
+        rolledBack.AfterRollback(lambda: done.append("rolled back"))
+        await rolledBack.Close()
+    Run(Work())
+
+    assert done == ["committed", "rolled back"]
+
+
+def test_get_unit_of_work_commits_on_success_only(monkeypatch):
+    db, log = FakeDatabase()
+    monkeypatch.setattr(settings, "DB",
+                        SimpleNamespace(Session=lambda: UnitOfWork(db)))
+
+    async def Request(fail: bool):
+        request = SimpleNamespace(state=SimpleNamespace())
+        dependency = utils.GetUnitOfWork(request)
+        uow = await dependency.__anext__()
+        await uow.Write("UpdateUser", {"uid": "u", "attributes": {}})
+        if fail:
+            with pytest.raises(RuntimeError):
+                await dependency.athrow(RuntimeError("handler failed"))
+        else:
+            with pytest.raises(StopAsyncIteration):
+                await dependency.__anext__()
+    Run(Request(fail=False))
+    assert log == ["begin", "run", "commit", "close"]
+    log.clear()
+    Run(Request(fail=True))
+    assert log == ["begin", "run", "rollback", "close"]
+
+
+def test_failed_commit_fails_the_request(client, graph, monkeypatch, caplog):
+    async def Fail(self):
+        raise RuntimeError("commit failed")
+    monkeypatch.setattr(MemoryUnitOfWork, "Commit", Fail)
+    res = client.post(settings.AUTH_ENDPOINT + "/register",
+                      json={"screenName": "someone",
+                            "email": "someone@violethawk.test",
+                            "password": PASSWORD})
+
+    # The client is not told about a write that did not happen
+    assert res.status_code == 500
+    assert graph.All("User") == []
+    assert "CommitError" in caplog.text
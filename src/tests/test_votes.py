@@ -0,0 +1,70 @@
+"""tests/test_votes.py
+
+Upvote/downvote toggle and the idempotent vote endpoint, for posts and
+comments. Votes are cast from the "JWT" cookie.
+"""
+import pytest
+from tests.conftest import CreateSub, CreatePost, CreateComment
+
+
+@pytest.fixture
+def targets(client, register):
+    owner = register()
+    sub = CreateSub(client, owner)
+    post = CreatePost(client, owner, sub["Title"])
+    comment = CreateComment(client, owner, post["UUID"])
+    voter = register()
+    client.cookies.set("JWT", voter["Access"])
+    return {"post": post["UUID"], "comment": comment["UUID"]}
+
+
+def Vote(client, kind: str, uid: str, action: str, vote: int = None):
+    params = {"vote": vote} if vote is not None else None
+    res = client.post(f"/api/{kind}/{action}/{uid}", params=params)
+    assert res.status_code == 200, res.text
+    body = res.json()
+    return body["Votes"], body["Likes"], body["Dislikes"]
+
+
+@pytest.mark.parametrize("kind", ["post", "comment"])
+def test_repeating_a_vote_clears_it(client, targets, kind):
+    uid = targets[kind]
+    assert Vote(client, kind, uid, "upvote") == (1, 1, 0)
+    assert Vote(client, kind, uid, "upvote") == (0, 0, 0)
+    assert Vote(client, kind, uid, "downvote") == (-1, 0, 1)
+    assert Vote(client, kind, uid, "downvote") == (0, 0, 0)
+
+
+@pytest.mark.parametrize("kind", ["post", "comment"])
+def test_switching_a_vote_moves_it(client, targets, kind):
+    uid = targets[kind]
+    assert Vote(client, kind, uid, "upvote") == (1, 1, 0)
+    assert Vote(client, kind, uid, "downvote") == (-1, 0, 1)
+    assert Vote(client, kind, uid, "upvote") == (1, 1, 0)
+
+
+@pytest.mark.parametrize("kind", ["post", "comment"])
+def test_vote_endpoint_sets_the_vote(client, targets, kind):
+    uid = targets[kind]
+    assert Vote(client, kind, uid, "vote", 1) == (1, 1, 0)
+    assert Vote(client, kind, uid, "vote", 1) == (1, 1, 0)
+    assert Vote(client, kind, uid, "vote", -1) == (-1, 0, 1)
+    assert Vote(client, kind, uid, "vote", 0) == (0, 0, 0)
+    assert Vote(client, kind, uid, "vote", 0) == (0, 0, 0)
+
+
+def test_votes_are_shown_on_reads(client, targets):
+    Vote(client, "post", targets["post"], "upvote")
+    post = client.get("/api/post/read", params={"UUID": targets["post"]})
+    assert post.json()["Votes"] == 1
+    Vote(client, "post", targets["post"], "upvote")
+    post = client.get("/api/post/read", params={"UUID": targets["post"]})
+    assert post.json()["Votes"] == 0
+
+
+def test_guests_cannot_vote(client, targets):
+    client.cookies.clear()
+    res = client.post(f"/api/post/upvote/{targets['post']}")
+    assert res.status_code == 401
+    res = client.post(f"/api/post/vote/{targets['post']}", params={"vote": 2})
+    assert res.status_code == 400
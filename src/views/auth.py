@@ -6,8 +6,10 @@ from config import settings
 from models.user import User, UserRegister
 from drivers.auth import utils
 from drivers.auth import auth
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import GetUnitOfWork, UnitOfWorkRoute
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 
 @router.get("/login", response_class=HTMLResponse)
 async def get_login(request:Request, user:User = Depends(utils.GetCookieUserAllowGuest)):
@@ -20,22 +22,27 @@ async def get_login(request:Request, user:User = Depends(utils.GetCookieUserAllo
 @router.post("/login")
 async def post_login_page(request: Request,
                           email: str = Form(),
-                          password: str = Form()):
-    user = utils.AuthenticateUser(email, password)
+                          password: str = Form(),
+                          db: UnitOfWork = Depends(GetUnitOfWork)):
+    user = await utils.AuthenticateUser(db, email, password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password."
         )
-    token = utils.CreateAccessToken(data={"UUID":user.UUID, "IP":request.client.host})
+    token = utils.CreateAccessToken(data=utils.TokenClaims(user, request.client.host))
+    refresh = await utils.CreateRefreshToken(db, user.UUID)
     response = RedirectResponse("/")
-    response.set_cookie(key="JWT", value=token, httponly=True, samesite="lax")
+    utils.SetAuthCookies(response, {"JWT": token, "Refresh": refresh})
     return response
 
 @router.get("/logout")
-async def get_logout_page(request:Request):
+async def get_logout_page(request:Request,
+                          db: UnitOfWork = Depends(GetUnitOfWork)):
+    if "Refresh" in request.cookies:
+        await utils.RevokeRefreshToken(db, request.cookies["Refresh"])
     response = RedirectResponse("/")
-    response.delete_cookie("JWT")
+    utils.SetAuthCookies(response, {"JWT": None, "Refresh": None})
     return response
 
 @router.post("/register")
@@ -47,7 +54,8 @@ async def post_register_page(request:Request,
                             mname: str = Form(None),
                             lname: str = Form(None),
                             phone: str = Form(None),
-                            user:User = Depends(utils.GetCookieUserAllowGuest)):
+                            user:User = Depends(utils.GetCookieUserAllowGuest),
+                            db: UnitOfWork = Depends(GetUnitOfWork)):
     if user:
         return RedirectResponse("/")
     newUser = UserRegister(
@@ -59,10 +67,11 @@ async def post_register_page(request:Request,
         mname=mname,
         lname=lname
     )
-    user = auth.register_user(newUser)
-    token = utils.CreateAccessToken(data={"UUID":user.UUID, "IP":request.client.host})
+    user = await auth.register_user(request, newUser, db=db)
+    token = utils.CreateAccessToken(data=utils.TokenClaims(user, request.client.host))
+    refresh = await utils.CreateRefreshToken(db, user.UUID)
     response = RedirectResponse("/")
-    response.set_cookie(key="JWT",value=token, httponly=True, samesite="lax")
+    utils.SetAuthCookies(response, {"JWT": token, "Refresh": refresh})
     return response #settings.TEMPLATES.TemplateResponse("register.html", {"request":request, "user":user})
 
 @router.get("/register")
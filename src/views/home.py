@@ -4,14 +4,40 @@ from fastapi.responses import HTMLResponse
 from config import settings
 from models.user import User
 from drivers.auth import utils
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import GetUnitOfWork, UnitOfWorkRoute
+from api.post import GetHomeFeed
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 
 
 @router.get("/", response_class=HTMLResponse)
 @router.post("/", response_class=HTMLResponse)
-async def home_page(request: Request, user:User = Depends(utils.GetCookieUserAllowGuest)):
-    return settings.TEMPLATES.TemplateResponse("index.html", {"request":request, "user":user})
+async def home_page(request: Request,
+                    user:User = Depends(utils.GetCookieUserAllowGuest),
+                    db: UnitOfWork = Depends(GetUnitOfWork)):
+    posts, next = [], None
+    if user:
+        page = await GetHomeFeed(db, user)
+        posts, next = page.Posts, page.Next
+    return settings.TEMPLATES.TemplateResponse("index.html", {"request":request, "user":user, "posts":posts, "next":next})
+
+
+@router.get("/feed", response_class=HTMLResponse)
+async def home_feed_page(request: Request,
+                         cursor: str,
+                         user:User = Depends(utils.GetCookieUserAllowGuest),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Renders the next page of the home feed for infinite scroll. The
+    cursor for the page after it is sent in the X-Next-Cursor header.
+    """
+    if not user:
+        return HTMLResponse("")
+    page = await GetHomeFeed(db, user, cursor=cursor)
+    response = settings.TEMPLATES.TemplateResponse("partials/feed.html", context={"request":request, "user":user, "posts":page.Posts})
+    if page.Next:
+        response.headers["X-Next-Cursor"] = page.Next
+    return response
 
 
 
@@ -20,18 +46,8 @@ async def home_page(request: Request, user:User = Depends(utils.GetCookieUserAll
 async def search_page(request: Request,
                       category:str=None,
                       keywords:str=None,
-                      user:User = Depends(utils.GetCookieUserAllowGuest)):
-    cypher = """CREATE FULLTEXT INDEX postKeywords
-    IF NOT EXISTS
-    FOR (n:Post) ON EACH [n.Title, n.Content, n.Keywords]
-    """
-    cypher = f"""CALL
-    db.index.fulltext.queryNodes("postKeywords", "{keywords}")
-    YIELD node
-    RETURN node
-    """
-    with settings.DB.session() as session:
-        res = session.run(query=cypher)
-        out = res.data()
+                      user:User = Depends(utils.GetCookieUserAllowGuest),
+                      db: UnitOfWork = Depends(GetUnitOfWork)):
+    out = await db.Read("SearchPosts", {"keywords": keywords})
 
     return settings.TEMPLATES.TemplateResponse("search/results.html", context={"request":request, "user":user, "category":category, "keywords":keywords, "results":out})
@@ -5,6 +5,7 @@ subreddits
 """
 
 import uuid
+from urllib.parse import quote
 from typing import Optional, List
 from datetime import datetime
 from fastapi import APIRouter, Depends, Request, status, Form, UploadFile, File
@@ -13,12 +14,14 @@ from config import settings
 from models.user import User
 from models.sub import Sub
 from drivers.auth.utils import GetCookieUserAllowGuest
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import GetUnitOfWork, UnitOfWorkRoute
 from api.sub import read_sub, create_sub
 from api.post import create_post, GetPostsOnSub, GetPost
 #from sub import read_page, create_page
 #from post import GetPostsOnPage, create_blog_post, GetBlogPost
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 ROUTE = {
     "router":router,
     "prefix":"/v",
@@ -28,10 +31,32 @@ ROUTE = {
 @router.get("/{title}", response_class=HTMLResponse)
 async def read_subreddit(request:Request,
                          title:str,
-                         user:User = Depends(GetCookieUserAllowGuest)):
-    sub = await read_sub(title)
-    posts = GetPostsOnSub(title=title,likes=True,user=user)
-    return settings.TEMPLATES.TemplateResponse("sub.html", context={"request":request,"user":user,"sub":sub,"posts":posts})
+                         sort:str = "hot",
+                         window:str = "all",
+                         user:User = Depends(GetCookieUserAllowGuest),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
+    sub = await read_sub(title, db=db)
+    page = await GetPostsOnSub(db, title=title,likes=True,user=user,
+                               sort=sort,window=window)
+    return settings.TEMPLATES.TemplateResponse("sub.html", context={"request":request,"user":user,"sub":sub,"posts":page.Posts,"next":page.Next,"sort":sort})
+
+@router.get("/{title}/page", response_class=HTMLResponse)
+async def read_subreddit_page(request:Request,
+                              title:str,
+                              cursor:str,
+                              sort:str = "hot",
+                              window:str = "all",
+                              user:User = Depends(GetCookieUserAllowGuest),
+                              db: UnitOfWork = Depends(GetUnitOfWork)):
+    """Renders the next page of a sub's feed for infinite scroll. The
+    cursor for the page after it is sent in the X-Next-Cursor header.
+    """
+    page = await GetPostsOnSub(db, title=title,likes=True,user=user,
+                               sort=sort,window=window,cursor=cursor)
+    response = settings.TEMPLATES.TemplateResponse("partials/feed.html", context={"request":request,"user":user,"sub":{"Title":title},"posts":page.Posts})
+    if page.Next:
+        response.headers["X-Next-Cursor"] = page.Next
+    return response
 
 @router.post("/{subTitle}/new", response_class=HTMLResponse)
 async def post_subreddit(request:Request,
@@ -39,17 +64,19 @@ async def post_subreddit(request:Request,
                          file: Optional[List[UploadFile]] = File(),
                          title = Form(),
                          content = Form(""),
-                         user:User = Depends(GetCookieUserAllowGuest)):
+                         user:User = Depends(GetCookieUserAllowGuest),
+                         db: UnitOfWork = Depends(GetUnitOfWork)):
     print(file[0].filename)
     if not user:
         return RedirectResponse("/login",status_code=status.HTTP_401_UNAUTHORIZED)
     if file[0].filename:
         await create_post(title=title, content=content, published=True,
-                          subTitle=subTitle, linkedFiles=file, user=user)
+                          subTitle=subTitle, linkedFiles=file, user=user, db=db)
     else:
         await create_post(title=title, content=content, published=True,
-                          subTitle=subTitle, user=user)
-    sub = await(read_sub(subTitle))
-    posts = GetPostsOnSub(title=title,likes=True,user=user)
-    return settings.TEMPLATES.TemplateResponse("sub.html", context={"request":request,"user":user,"sub":sub,"posts":posts})
+                          subTitle=subTitle, user=user, db=db)
+    # The post joins the sub's ranked feed once committed, so it is
+    # rendered by the redirected request rather than this one
+    return RedirectResponse(f"/v/{quote(subTitle)}?sort=new",
+                            status_code=status.HTTP_303_SEE_OTHER)
 
@@ -13,12 +13,14 @@ from config import settings
 from models.user import User, BlockedUser
 from models.sub import Sub
 from drivers.auth.utils import GetCookieUserAllowGuest, GetUser
+from drivers.database.database import UnitOfWork
+from drivers.database.utils import GetUnitOfWork, UnitOfWorkRoute
 from api.sub import read_sub, create_sub
 from api.post import create_post, GetPostsOnSub, GetPost
 #from sub import read_page, create_page
 #from post import GetPostsOnPage, create_blog_post, GetBlogPost
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 ROUTE = {
     "router":router,
     "prefix":"/user",
@@ -30,8 +32,9 @@ async def get_home(request:Request):
     return RedirectResponse("/")
 
 @router.get("/{UUID}", response_class=HTMLResponse)
-async def get_user(request:Request, UUID:str, user:User = Depends(GetCookieUserAllowGuest)):
-    viewed = GetUser(UUID)
+async def get_user(request:Request, UUID:str, user:User = Depends(GetCookieUserAllowGuest),
+                   db: UnitOfWork = Depends(GetUnitOfWork)):
+    viewed = await GetUser(db, UUID)
     print(viewed)
     if viewed:
         if user: